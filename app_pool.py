@@ -0,0 +1,273 @@
+import logging
+import signal
+import subprocess
+import threading
+import typing
+
+from colorama import Fore, Style
+from log_pump import LogPump, PumpStream
+
+# Time given to an app to exit after SIGINT before it is killed
+APP_STOP_TIMEOUT_SEC = 30
+
+
+class SwitchableOutput:
+    """
+    Output stream forwarding writes to a target that can be changed between
+    runs. Writes are dropped while no target is set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._target: typing.Optional[typing.BinaryIO] = None
+
+    def set_target(self, target: typing.Optional[typing.BinaryIO]) -> None:
+        with self._lock:
+            self._target = target
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            if self._target is not None:
+                self._target.write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._target is not None:
+                self._target.flush()
+
+
+class SwitchableArchive:
+    """
+    Log archive forwarding lines to a target that can be changed between
+    runs. Lines are dropped while no target is set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._target = None
+
+    def set_target(self, target) -> None:
+        with self._lock:
+            self._target = target
+
+    def append_lines(self, stream: str, lines: typing.List[bytes]) -> None:
+        with self._lock:
+            if self._target is not None:
+                self._target.append_lines(stream, lines)
+
+
+class PooledApp:
+    """
+    An app process kept alive across runs by an AppPool.
+    """
+
+    def __init__(self, command: typing.Tuple[str, ...], process: subprocess.Popen,
+                 output: SwitchableOutput, archive: SwitchableArchive, streams: typing.List[PumpStream]):
+        self.command = command
+        self.process = process
+        self.output = output
+        self.archive = archive
+        self.streams = streams
+        self.runs_served = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+
+class AppPool:
+    """
+    Keeps app processes alive across runs that use the same app command,
+    so that consecutive runs skip the app startup.
+
+    An app is recycled when it crashed, when a run asks for a factory reset,
+    or once it served `max_runs_per_app` runs.
+
+    A pool may be shared by runs executing concurrently in threads. Runs of
+    the same app command take turns, since they share its state and port.
+    """
+
+    def __init__(self, max_runs_per_app: int = 0):
+        """
+        Parameters:
+
+        max_runs_per_app:
+         Number of runs an app serves before it is restarted, 0 means unlimited.
+        """
+        self.max_runs_per_app = max_runs_per_app
+        self._apps: typing.Dict[typing.Tuple[str, ...], PooledApp] = {}
+        self._log_pump: typing.Optional[LogPump] = None
+        self._lock = threading.Condition()
+        # Commands of the apps acquired by a run and not released yet
+        self._in_use: typing.Set[typing.Tuple[str, ...]] = set()
+
+    def acquire(self, command: typing.List[str], env: typing.Optional[typing.Dict[str, str]],
+                output: typing.BinaryIO, watch=None, archive=None) -> PooledApp:
+        """
+        Returns a running app for `command`, starting one if no healthy app
+        is pooled for it. The app output goes to `output` until release().
+        Waits while another run holds the app of the same command.
+
+        Parameters:
+
+        command:
+         Fully resolved app command, the pool key
+
+        env:
+         Environment of the app process if a new one is started
+
+        output:
+         Stream receiving the app output during this run
+
+        watch:
+         Raw line watcher attached to the output of a newly started app
+
+        archive:
+         Log archive receiving the app output during this run
+        """
+        key = tuple(command)
+        with self._lock:
+            while key in self._in_use:
+                self._lock.wait()
+            self._in_use.add(key)
+            if self._log_pump is None:
+                self._log_pump = LogPump()
+
+        try:
+            pooled = self.__get_or_start__(key, env, watch)
+        except BaseException:
+            self.__done_with__(key)
+            raise
+
+        pooled.output.set_target(output)
+        pooled.archive.set_target(archive)
+        return pooled
+
+    def __get_or_start__(self, key: typing.Tuple[str, ...], env: typing.Optional[typing.Dict[str, str]],
+                         watch) -> PooledApp:
+        pooled = self._apps.get(key)
+
+        if pooled is not None and not pooled.alive:
+            logging.warning(f"Pooled app {pooled.pid} exited with {pooled.process.returncode}, restarting it")
+            self.__finish__(pooled)
+            pooled = None
+
+        if pooled is None:
+            app_output = SwitchableOutput()
+            app_archive = SwitchableArchive()
+            process = subprocess.Popen(list(key), stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, env=env)
+            streams = self._log_pump.add_process(Fore.GREEN + "APP " + Style.RESET_ALL, process, app_output, watch,
+                                                 app_archive, "APP")
+            pooled = self._apps[key] = PooledApp(key, process, app_output, app_archive, streams)
+        else:
+            logging.info(f"Reusing app {pooled.pid} after {pooled.runs_served} runs")
+        return pooled
+
+    def __done_with__(self, key: typing.Tuple[str, ...]) -> None:
+        with self._lock:
+            self._in_use.discard(key)
+            self._lock.notify_all()
+
+    def release(self, pooled: PooledApp, recycle: bool = False) -> int:
+        """
+        Returns an app to the pool at the end of a run.
+
+        Parameters:
+
+        pooled:
+         The app returned by acquire()
+
+        recycle:
+         Stop the app instead of keeping it, for example when it never
+         became ready
+
+        Return:
+
+        int
+         0 if the app is healthy, otherwise its exit code. An app reaching
+         max_runs_per_app, or recycled, is stopped and its exit code returned.
+        """
+        pooled.runs_served += 1
+        exit_code = 0
+
+        if recycle:
+            exit_code = self.__stop__(pooled)
+        elif not pooled.alive:
+            exit_code = pooled.process.returncode
+            logging.error(f"Pooled app {pooled.pid} exited with {exit_code} during the run")
+            self.__finish__(pooled)
+        elif self.max_runs_per_app and pooled.runs_served >= self.max_runs_per_app:
+            exit_code = self.__stop__(pooled)
+
+        pooled.output.set_target(None)
+        pooled.archive.set_target(None)
+        self.__done_with__(pooled.command)
+        return exit_code
+
+    def recycle(self, command: typing.List[str]) -> int:
+        """
+        Stops the pooled app for `command`, if any, for example before a
+        factory reset removes its state.
+
+        Return:
+
+        int
+         Exit code of the stopped app, 0 if none was pooled
+        """
+        key = tuple(command)
+        with self._lock:
+            while key in self._in_use:
+                self._lock.wait()
+            self._in_use.add(key)
+        try:
+            pooled = self._apps.get(key)
+            if pooled is None:
+                return 0
+            return self.__stop__(pooled)
+        finally:
+            self.__done_with__(key)
+
+    def shutdown(self) -> int:
+        """
+        Stops all pooled apps.
+
+        Return:
+
+        int
+         First non-zero app exit code, 0 if all apps exited cleanly
+        """
+        exit_code = 0
+        for pooled in list(self._apps.values()):
+            code = self.__stop__(pooled)
+            exit_code = exit_code or code
+
+        if self._log_pump is not None:
+            self._log_pump.close()
+            self._log_pump = None
+
+        return exit_code
+
+    def __stop__(self, pooled: PooledApp) -> int:
+        if pooled.alive:
+            logging.warning(f"Stopping pooled app {pooled.pid} with SIGINT")
+            pooled.process.send_signal(signal.SIGINT.value)
+            try:
+                pooled.process.wait(APP_STOP_TIMEOUT_SEC)
+            except subprocess.TimeoutExpired:
+                logging.error(f"Pooled app {pooled.pid} did not stop, killing it")
+                pooled.process.kill()
+                pooled.process.wait()
+
+        self.__finish__(pooled)
+        return pooled.process.returncode
+
+    def __finish__(self, pooled: PooledApp) -> None:
+        # Make sure all the output of the app was written before forgetting it
+        for stream in pooled.streams:
+            stream.done.wait()
+        self._apps.pop(pooled.command, None)
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import re
+import subprocess
+import threading
+import time
+import typing
+
+# How often the port and the app process are polled while waiting
+POLL_INTERVAL_SEC = 0.05
+
+# Socket tables of a network namespace, below /proc/net or /proc/<pid>/net
+PROC_NET_TABLES = ("udp", "udp6", "tcp", "tcp6")
+# State of a listening TCP socket in the socket tables
+TCP_LISTEN = "0A"
+
+
+class AppReadinessError(Exception):
+    """
+    Raised when an app does not become ready before its deadline.
+    """
+
+
+class ReadinessWatcher:
+    """
+    Watches the raw output lines of an app for a readiness pattern. It is
+    called from the LogPump thread and wakes up an asyncio waiter thread-safely.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = re.compile(pattern.encode())
+        self._matched = threading.Event()
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._future: typing.Optional[asyncio.Future] = None
+        self._lock = threading.Lock()
+
+    @property
+    def matched(self) -> bool:
+        return self._matched.is_set()
+
+    def __call__(self, lines: typing.List[bytes]) -> None:
+        if self._matched.is_set():
+            return
+
+        if any(self.pattern.search(line) for line in lines):
+            with self._lock:
+                self._matched.set()
+                if self._future is not None:
+                    self._loop.call_soon_threadsafe(self.__resolve__)
+
+    def __resolve__(self) -> None:
+        if not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self) -> None:
+        """
+        Returns once the pattern was seen in the app output.
+        """
+        with self._lock:
+            if self._matched.is_set():
+                return
+            self._loop = asyncio.get_running_loop()
+            self._future = self._loop.create_future()
+        await self._future
+
+
+def is_port_bound(port: int, pid: typing.Optional[int] = None) -> bool:
+    """
+    Checks whether a UDP socket is bound to, or a TCP socket listens on, the
+    given port. The socket tables are read instead of binding the port, so
+    the probe neither races the app for the port nor depends on the network
+    namespace of the caller: with `pid`, the tables of that process's
+    network namespace are read.
+    """
+    net_dir = f"/proc/{pid}/net" if pid else "/proc/net"
+    for table in PROC_NET_TABLES:
+        try:
+            with open(os.path.join(net_dir, table), 'r') as stream:
+                next(stream, None)
+                for line in stream:
+                    fields = line.split()
+                    if int(fields[1].rsplit(':', 1)[1], 16) != port:
+                        continue
+                    if table.startswith("udp") or fields[3] == TCP_LISTEN:
+                        return True
+        except OSError:
+            continue
+    return False
+
+
+async def wait_for_port(port: int, pid: typing.Optional[int] = None) -> None:
+    """
+    Returns once something is bound to the given UDP or TCP port, see is_port_bound.
+    """
+    while not is_port_bound(port, pid):
+        await asyncio.sleep(POLL_INTERVAL_SEC)
+
+
+async def wait_for_exit(process: subprocess.Popen) -> int:
+    """
+    Returns the exit code of a process once it exited.
+    """
+    while process.poll() is None:
+        await asyncio.sleep(POLL_INTERVAL_SEC)
+    return process.returncode
+
+
+async def wait_until_ready(process: subprocess.Popen, timeout: float,
+                           watcher: typing.Optional[ReadinessWatcher] = None,
+                           port: typing.Optional[int] = None) -> float:
+    """
+    Waits until the app is ready. If both are given, the app must have
+    printed the readiness pattern and bound the port.
+
+    Parameters:
+
+    process:
+     The running app
+
+    timeout:
+     Deadline in seconds
+
+    watcher:
+     Watcher of the app output registered with the log pump
+
+    port:
+     UDP or TCP port the app is expected to bind
+
+    Return:
+
+    float
+     Seconds it took for the app to become ready
+
+    Raises AppReadinessError when the app exits or the deadline passes first.
+    """
+    start = time.monotonic()
+
+    conditions = []
+    if watcher is not None:
+        conditions.append(asyncio.ensure_future(watcher.wait()))
+    if port:
+        conditions.append(asyncio.ensure_future(wait_for_port(port, process.pid)))
+
+    async def all_conditions():
+        for condition in conditions:
+            await condition
+
+    ready = asyncio.ensure_future(all_conditions())
+    exited = asyncio.ensure_future(wait_for_exit(process))
+
+    try:
+        done, _ = await asyncio.wait([ready, exited], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in conditions + [ready, exited]:
+            task.cancel()
+
+    if ready in done:
+        return time.monotonic() - start
+
+    if exited in done:
+        raise AppReadinessError(f"App exited with code {exited.result()} before becoming ready")
+
+    what = []
+    if watcher is not None and not watcher.matched:
+        what.append(f"output matching '{watcher.pattern.pattern.decode()}'")
+    if port and not is_port_bound(port, process.pid):
+        what.append(f"port {port} to be bound")
+    raise AppReadinessError(f"App not ready after {timeout}s, waiting for {' and '.join(what)}")
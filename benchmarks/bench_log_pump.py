@@ -0,0 +1,131 @@
+"""
+Throughput benchmark of the log cooking path: one reader thread per pipe,
+the way run_python_test.py copied output before LogPump, against the
+single-threaded LogPump.
+
+Usage: python benchmarks/bench_log_pump.py [--lines N] [--pipes N] [--output results.json]
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from log_pump import LogPump  # noqa: E402
+
+CHIP_LOG_LINES = [
+    b"[1646290606.901990][12345:12350] CHIP:DMG: Received Command Response Data, Endpoint=0 Cluster=0x0000_0030 Command=0x0000_0001\n",
+    b"[1646290606.902011][12345:12350] CHIP:EM: <<< [E:6311r S:21839 M:25063211 (Ack:141052446)] (S) Msg TX to 1:00000000000001B0 [D21C] --- Type 0001:05 (IM:WriteRequest)\n",
+    b"[1646290606.902245][12345:12350] CHIP:IN: (S) Sending msg 25063211 on secure session with LSID: 21839\n",
+    b"[1646290606.903101][12345:12350] CHIP:DL: HandlePlatformSpecificBLEEvent 32783\n",
+]
+
+
+def enqueue_log_output(fp, tag: bytes, output_stream) -> None:
+    """
+    The former per-pipe reader of run_python_test.py, kept as the reference
+    the pump is measured against.
+    """
+    for line in iter(fp.readline, b''):
+        timestamp = time.time()
+        if len(line) > len('[1646290606.901990]') and line[0:1] == b'[':
+            try:
+                timestamp = float(line[1:18].decode())
+                line = line[19:]
+            except Exception:
+                pass
+        output_stream.write(
+            (f"[{datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')}]").encode() + tag + line)
+        sys.stdout.flush()
+    fp.close()
+
+
+def make_payload(lines: int) -> bytes:
+    return b''.join(CHIP_LOG_LINES[i % len(CHIP_LOG_LINES)] for i in range(lines))
+
+
+def feed(write_fd: int, payload: bytes) -> None:
+    with os.fdopen(write_fd, 'wb') as fp:
+        fp.write(payload)
+
+
+def run_feeders(payload: bytes, pipes: int):
+    readers = []
+    feeders = []
+    for _ in range(pipes):
+        read_fd, write_fd = os.pipe()
+        readers.append(os.fdopen(read_fd, 'rb', buffering=0))
+        feeders.append(threading.Thread(target=feed, args=(write_fd, payload)))
+    return readers, feeders
+
+
+def bench_threads(payload: bytes, pipes: int) -> float:
+    readers, feeders = run_feeders(payload, pipes)
+    output = io.BytesIO()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=enqueue_log_output, args=(fp, b"[APP ][STDOUT]", output)) for fp in readers]
+    for thread in threads + feeders:
+        thread.start()
+    for thread in threads + feeders:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_pump(payload: bytes, pipes: int) -> float:
+    readers, feeders = run_feeders(payload, pipes)
+    output = io.BytesIO()
+    pump = LogPump()
+
+    start = time.perf_counter()
+    streams = [pump.add(fp, b"[APP ][STDOUT]", output) for fp in readers]
+    for feeder in feeders:
+        feeder.start()
+    for stream in streams:
+        stream.done.wait()
+    elapsed = time.perf_counter() - start
+
+    for feeder in feeders:
+        feeder.join()
+    pump.close()
+    return elapsed
+
+
+def run(lines: int = 200000, pipes: int = 4):
+    payload = make_payload(lines)
+    total_lines = lines * pipes
+    threads_sec = bench_threads(payload, pipes)
+    pump_sec = bench_pump(payload, pipes)
+    return {
+        "benchmark": "log_cooking",
+        "lines": total_lines,
+        "pipes": pipes,
+        "threads_lines_per_sec": total_lines / threads_sec,
+        "pump_lines_per_sec": total_lines / pump_sec,
+        "speedup": threads_sec / pump_sec,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark log cooking throughput.')
+    parser.add_argument('--lines', type=int, default=200000, help='Lines written to each pipe')
+    parser.add_argument('--pipes', type=int, default=4, help='Number of concurrently written pipes')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    result = run(args.lines, args.pipes)
+    print(json.dumps(result, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
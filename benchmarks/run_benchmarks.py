@@ -0,0 +1,208 @@
+"""
+Microbenchmarks of the runner's own hot paths:
+
+- MetadataReader.parse_script on synthetic scripts of varying size and directive counts
+- MetadataReader.__resolve_env_vals__ with large environment files
+- TestRunner.generate_run_commands
+- The former per-pipe log reader and LogPump with realistic chip log lines
+
+Results are written as JSON so they can be committed and compared across
+changes. With --baseline, benchmarks whose throughput dropped by more than
+--tolerance are reported and the script exits with an error.
+
+Usage: python benchmarks/run_benchmarks.py [--output results.json] [--baseline baseline.json]
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bench_log_pump  # noqa: E402
+from metadata import MetadataReader  # noqa: E402
+from test_runner import TestRunner  # noqa: E402
+
+# Body line repeated to make scripts of realistic size
+SCRIPT_BODY_LINE = "        await client_list[0].WriteAttribute(self.dut_node_id, [(0, Clusters.BasicInformation.Attributes.NodeLabel(value=AFTER_LABEL))])\n"
+
+
+def measure(fn: typing.Callable[[], typing.Any], operations: int, repeat: int) -> typing.Dict[str, float]:
+    """
+    Runs `fn` `repeat` times and reports the throughput of the median run,
+    where a single call of `fn` performs `operations` operations.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return {
+        "operations": operations,
+        "median_sec": median,
+        "min_sec": min(timings),
+        "ops_per_sec": operations / median,
+    }
+
+
+def make_env(directory: str, keys: int) -> str:
+    env_path = os.path.join(directory, f"env-{keys}.yaml")
+    with open(env_path, 'w') as env:
+        env.write("ALL_CLUSTERS_APP: out/linux-x64-all-clusters-ipv6only-no-ble-no-wifi-tsan-clang-test/chip-all-clusters-app\n")
+        env.write("TRACE_APP: out/trace_data/app-{SCRIPT_BASE_NAME}\n")
+        env.write("TRACE_TEST_JSON: out/trace_data/test-{SCRIPT_BASE_NAME}\n")
+        for i in range(keys):
+            env.write(f"EXTRA_VARIABLE_{i}: out/linux-x64-extra-{i}/chip-extra-app\n")
+    return env_path
+
+
+def make_script(directory: str, runs: int, body_lines: int) -> str:
+    script_path = os.path.join(directory, f"TC_BENCH_{runs}_{body_lines}.py")
+    with open(script_path, 'w') as script:
+        script.write(f"# test-runner-runs: {' '.join(f'run{i}' for i in range(runs))}\n")
+        for i in range(runs):
+            script.write(f"# test-runner-run/run{i}/app: ${{ALL_CLUSTERS_APP}}\n")
+            script.write(f"# test-runner-run/run{i}/factoryreset: True\n")
+            script.write(f"# test-runner-run/run{i}/app-args: --discriminator 1234 --KVS kvs1 --trace-to json:${{TRACE_APP}}.json\n")
+            script.write(f"# test-runner-run/run{i}/script-args: --storage-path admin_storage.json --commissioning-method on-network "
+                         f"--discriminator 1234 --passcode 20202021 --trace-to json:${{TRACE_TEST_JSON}}.json\n")
+        script.write("\nimport asyncio\n\n")
+        script.write(SCRIPT_BODY_LINE * body_lines)
+    return script_path
+
+
+def bench_parse_script(directory: str, repeat: int) -> typing.Dict[str, typing.Any]:
+    env_path = make_env(directory, 10)
+    results = {}
+    for runs, body_lines in ((1, 100), (1, 10000), (10, 100), (10, 10000)):
+        script_path = make_script(directory, runs, body_lines)
+        calls = 200
+        reader = MetadataReader(env_path)
+        results[f"runs={runs},body_lines={body_lines}"] = measure(
+            lambda: [reader.parse_script(script_path) for _ in range(calls)], calls, repeat)
+    return results
+
+
+def bench_resolve_env_vals(directory: str, repeat: int) -> typing.Dict[str, typing.Any]:
+    results = {}
+    for keys in (10, 100, 1000):
+        reader = MetadataReader(make_env(directory, keys))
+        calls = 1000
+        # Every call resolves arguments never seen before, so that the reader's
+        # template and value caches do not turn the benchmark into dict lookups
+        serial = itertools.count()
+
+        def resolve():
+            for _ in range(calls):
+                n = next(serial)
+                reader.__resolve_env_vals__({
+                    "app": f"${{ALL_CLUSTERS_APP}}/{n}",
+                    "app-args": f"--discriminator {n} --KVS kvs1 --trace-to json:${{TRACE_APP}}.json",
+                    "script-args": f"--storage-path admin_storage_{n}.json --trace-to json:${{TRACE_TEST_JSON}}.json",
+                }, {"SCRIPT_BASE_NAME": "TC_BENCH"})
+
+        results[f"env_keys={keys}"] = measure(resolve, calls, repeat)
+    return results
+
+
+def bench_generate_run_commands(directory: str, repeat: int) -> typing.Dict[str, typing.Any]:
+    runner = TestRunner(make_env(directory, 10))
+    script_path = make_script(directory, 10, 100)
+    calls = 200
+    return {"runs=10": measure(lambda: [runner.generate_run_commands(script_path) for _ in range(calls)],
+                               calls * 10, repeat)}
+
+
+def bench_enqueue_log_output(repeat: int) -> typing.Dict[str, typing.Any]:
+    lines = 50000
+    payload = bench_log_pump.make_payload(lines)
+
+    def cook():
+        bench_log_pump.enqueue_log_output(io.BytesIO(payload), b"[APP ][STDOUT]", io.BytesIO())
+
+    return {"lines=50000": measure(cook, lines, repeat)}
+
+
+def bench_log_pump_pipes(repeat: int) -> typing.Dict[str, typing.Any]:
+    lines, pipes = 50000, 4
+    payload = bench_log_pump.make_payload(lines)
+    return {"lines=50000,pipes=4": measure(lambda: bench_log_pump.bench_pump(payload, pipes), lines * pipes, repeat)}
+
+
+def run_all(repeat: int) -> typing.Dict[str, typing.Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = {
+            "parse_script": bench_parse_script(directory, repeat),
+            "resolve_env_vals": bench_resolve_env_vals(directory, repeat),
+            "generate_run_commands": bench_generate_run_commands(directory, repeat),
+            "enqueue_log_output": bench_enqueue_log_output(repeat),
+            "log_pump": bench_log_pump_pipes(repeat),
+        }
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.time(),
+        "benchmarks": benchmarks,
+    }
+
+
+def compare(results: typing.Dict[str, typing.Any], baseline: typing.Dict[str, typing.Any],
+            tolerance: float) -> typing.List[str]:
+    """
+    Returns a description of every benchmark whose throughput dropped by
+    more than `tolerance` (a fraction) compared to the baseline.
+    """
+    regressions = []
+    for group, cases in results["benchmarks"].items():
+        for case, result in cases.items():
+            reference = baseline.get("benchmarks", {}).get(group, {}).get(case)
+            if reference is None:
+                continue
+            ratio = result["ops_per_sec"] / reference["ops_per_sec"]
+            if ratio < 1 - tolerance:
+                regressions.append(f"{group}[{case}]: {result['ops_per_sec']:.0f} ops/s vs "
+                                   f"{reference['ops_per_sec']:.0f} ops/s in baseline ({ratio:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the test runner hot paths.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed repetitions of every benchmark')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative throughput drop compared to the baseline')
+    args = parser.parse_args()
+
+    results = run_all(args.repeat)
+
+    for group, cases in results["benchmarks"].items():
+        for case, result in cases.items():
+            print(f"{group:<24}{case:<28}{result['ops_per_sec']:>14.0f} ops/s")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import typing
+
+from sandbox import get_arg_value
+
+DEFAULT_SNAPSHOT_DIR = os.path.join("out", "commissioned_snapshots")
+
+# FICLONE from linux/fs.h, clones a file by sharing its extents on filesystems supporting reflinks
+FICLONE = 0x40049409
+
+# Script arguments only used to commission the DUT, a restored snapshot is already commissioned
+COMMISSIONING_ARGS = ("--commissioning-method", "--discriminator", "--passcode", "--qr-code", "--manual-code")
+
+# Arguments that do not affect the commissioned state, left out of snapshot keys along with the
+# commissioning ones, so that sandboxes allocating their own discriminator and port share snapshots
+UNKEYED_ARGS = ("--trace-to", "--secured-device-port") + COMMISSIONING_ARGS
+
+MANIFEST_NAME = "manifest.json"
+
+
+def clone_file(source: str, destination: str) -> None:
+    """
+    Copies a file with a reflink when the filesystem supports it, falling
+    back to a regular copy.
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def remove_args(args: str, names: typing.Iterable[str]) -> str:
+    """
+    Removes options and their value from a command line, e.g. removing
+    "--passcode" from "--passcode 20202021 --storage-path a.json" leaves
+    "--storage-path a.json".
+    """
+    names = set(names)
+    tokens = shlex.split(args)
+    kept = []
+    skip = False
+    for token in tokens:
+        if skip:
+            skip = False
+            continue
+        name = token.split('=', 1)[0]
+        if name in names:
+            skip = '=' not in token
+            continue
+        kept.append(token)
+    return " ".join(shlex.quote(token) for token in kept)
+
+
+def strip_commissioning_args(script_args: str) -> str:
+    return remove_args(script_args, COMMISSIONING_ARGS)
+
+
+def snapshot_key(app: str, app_args: str, script_args: str, sandbox_dir: typing.Optional[str] = None) -> str:
+    """
+    Identifies a commissioned setup: the app build, its arguments and the
+    arguments the script commissions with. Sandbox paths are normalized so
+    that runs in different sandboxes describe the same setup.
+    """
+    try:
+        stat = os.stat(app)
+        app_identity = [os.path.abspath(app), stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        app_identity = [app]
+
+    def normalize(args: str) -> str:
+        args = remove_args(args, UNKEYED_ARGS)
+        if sandbox_dir:
+            args = args.replace(sandbox_dir, "{SANDBOX}")
+        return args
+
+    content = json.dumps([app_identity, normalize(app_args), normalize(script_args)])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def state_files(app_args: str, script_args: str, tmp_dir: str) -> typing.Dict[str, str]:
+    """
+    Files holding the commissioned state of a run, keyed by their role: the
+    app KVS, the controller storage and the chip files of the app in tmp_dir.
+    """
+    files = {}
+    kvs_path = get_arg_value(app_args, "--KVS")
+    if kvs_path:
+        files["kvs"] = kvs_path
+    storage_path = get_arg_value(script_args, "--storage-path")
+    if storage_path:
+        files["storage"] = storage_path
+    for path in glob.glob(os.path.join(tmp_dir, "chip*")):
+        if os.path.isfile(path):
+            files["tmp/" + os.path.basename(path)] = path
+    return files
+
+
+class CommissionSnapshot:
+    """
+    Copy of the app and controller state right after a successful
+    commissioning, restored instead of commissioning the DUT again.
+    """
+
+    def __init__(self, snapshot_dir: str, key: str):
+        self.path = os.path.join(snapshot_dir, key)
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.path, MANIFEST_NAME))
+
+    def capture(self, files: typing.Dict[str, str]) -> None:
+        """
+        Stores the given state files. The snapshot becomes visible atomically
+        once complete, so concurrent runs never restore a partial one.
+        """
+        parent = os.path.dirname(self.path)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix=".staging-")
+
+        manifest = {}
+        for number, (role, path) in enumerate(sorted(files.items())):
+            if not os.path.exists(path):
+                continue
+            name = "%d-%s" % (number, re.sub(r'[^A-Za-z0-9_.-]', '_', role))
+            clone_file(path, os.path.join(staging, name))
+            manifest[role] = name
+
+        with open(os.path.join(staging, MANIFEST_NAME), 'w', encoding='utf8') as stream:
+            json.dump(manifest, stream)
+
+        try:
+            os.rename(staging, self.path)
+        except OSError:
+            # Another run captured the same setup first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def restore(self, files: typing.Dict[str, str], tmp_dir: str) -> typing.List[str]:
+        """
+        Restores the snapshot over the state files of this run, which may live
+        at different paths than the captured ones.
+
+        Parameters:
+
+        files:
+         State files of this run keyed by role, see state_files()
+
+        tmp_dir:
+         Directory receiving the captured chip files of the app
+
+        Return:
+
+        List[str]
+         Paths that were restored
+        """
+        with open(os.path.join(self.path, MANIFEST_NAME), 'r', encoding='utf8') as stream:
+            manifest = json.load(stream)
+
+        restored = []
+        for role, name in manifest.items():
+            if role.startswith("tmp/"):
+                destination = os.path.join(tmp_dir, role[len("tmp/"):])
+            else:
+                destination = files.get(role)
+            if destination is None:
+                raise FileNotFoundError(f"Run has no {role} file to restore the snapshot {self.path} into")
+            clone_file(os.path.join(self.path, name), destination)
+            restored.append(destination)
+        return restored
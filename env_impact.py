@@ -0,0 +1,130 @@
+import os
+import subprocess
+import tempfile
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from metadata import Metadata, MetadataReader, find_scripts
+
+RunKey = Tuple[str, str]
+
+
+class EnvImpactIndex:
+    """
+    Reverse index from environment variable names to the runs whose
+    test-runner directives refer to them through "${NAME}".
+
+    Runs using a computed variable name ("${APP_${BOARD}}") may depend on any
+    variable and are reported as affected by every change.
+    """
+
+    def __init__(self, metadata_reader: MetadataReader):
+        self.metadata_reader = metadata_reader
+        self.runs_by_variable: Dict[str, Set[RunKey]] = {}
+        self.dynamic_runs: Set[RunKey] = set()
+
+    def add_script(self, py_script_path: str) -> None:
+        """
+        Indexes the raw directives of a script. Malformed directives are
+        reported when the affected runs are parsed, not here.
+        """
+        directives = self.metadata_reader.read_directives(py_script_path, self.metadata_reader.header_only, report=False)
+        for run, args in directives.items():
+            key = (py_script_path, run)
+            for value in args.values():
+                names, dynamic = self.metadata_reader.substitution.compile(value).references()
+                for name in names:
+                    self.runs_by_variable.setdefault(name, set()).add(key)
+                if dynamic:
+                    self.dynamic_runs.add(key)
+
+    def affected(self, variables: Iterable[str]) -> Set[RunKey]:
+        """
+        Returns the (script, run) pairs that may depend on any of the given variables.
+        """
+        affected = set(self.dynamic_runs)
+        for name in variables:
+            affected |= self.runs_by_variable.get(name, set())
+        return affected
+
+
+def changed_variables(old_env: Mapping[str, str], new_env: Mapping[str, str]) -> Set[str]:
+    """
+    Names of the variables added, removed or changed between two environments.
+    """
+    return {name for name in set(old_env) | set(new_env) if old_env.get(name) != new_env.get(name)}
+
+
+def select_affected_runs(paths: Iterable[str], old_reader: MetadataReader, new_reader: MetadataReader,
+                         script_pattern: str = "TC_*.py") -> Tuple[List[Metadata], Set[str]]:
+    """
+    Selects the runs whose resolved arguments differ between two environments.
+
+    Only runs referring to a changed variable are resolved against both
+    environments, every other run is known to be unaffected from its raw
+    directives alone.
+
+    Parameters:
+
+    paths:
+     Paths to python test scripts or directories containing them
+
+    old_reader:
+     Reader of the environment the runs last executed with
+
+    new_reader:
+     Reader of the environment to execute the runs with
+
+    Return:
+
+    Tuple[List[Metadata], Set[str]]
+     The affected runs resolved against the new environment, and the
+     names of the changed variables
+    """
+    changed = changed_variables(old_reader.substitution.env, new_reader.substitution.env)
+    if not changed:
+        return [], changed
+
+    scripts = find_scripts(paths, script_pattern)
+    index = EnvImpactIndex(new_reader)
+    for script in scripts:
+        index.add_script(script)
+    candidates = index.affected(changed)
+
+    runs = []
+    for script in scripts:
+        if not any(key[0] == script for key in candidates):
+            continue
+
+        old_runs = {run.run: run for run in old_reader.parse_script(script)}
+        for run in new_reader.parse_script(script):
+            if (script, run.run) in candidates and old_runs.get(run.run) != run:
+                runs.append(run)
+
+    old_reader.save_index()
+    new_reader.save_index()
+    return runs, changed
+
+
+def env_file_at_revision(env_yaml_file_path: str, revision: str, directory: Optional[str] = None) -> str:
+    """
+    Writes the content of an environment file at a git revision to a
+    temporary file and returns its path.
+
+    Parameters:
+
+    env_yaml_file_path:
+     Path of the environment file in the working tree
+
+    revision:
+     Any git revision, e.g. "HEAD~1" or "origin/master"
+
+    directory:
+     Directory of the temporary file, defaults to the system temporary directory
+    """
+    env_dir, env_name = os.path.split(os.path.abspath(env_yaml_file_path))
+    content = subprocess.check_output(["git", "-C", env_dir, "show", f"{revision}:./{env_name}"])
+
+    fd, old_env_path = tempfile.mkstemp(dir=directory, prefix="env-", suffix=".yaml")
+    with os.fdopen(fd, 'wb') as stream:
+        stream.write(content)
+    return old_env_path
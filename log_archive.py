@@ -0,0 +1,353 @@
+"""
+Per-run archive of the app and test script output.
+
+The archive is an append-only file of binary records, each holding the
+parsed timestamp, source stream and raw bytes of one output line. Every
+`block_size` bytes of records a small entry is appended to a sidecar index
+with the offset, time range, streams and error flag of that block, so that
+queries only read the blocks they need.
+
+Query an archive with:
+
+    python3 log_archive.py ARCHIVE [--start TIME] [--end TIME] [--stream APP/STDERR] [--around-error N]
+"""
+
+import argparse
+import datetime
+import itertools
+import math
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import typing
+
+from log_pump import ParseLogTimestamp
+
+DATA_MAGIC = b'CHIPLOG1'
+INDEX_MAGIC = b'CHIPIDX1'
+INDEX_SUFFIX = '.idx'
+
+# Source streams of the archived lines, a record stores the position in this tuple
+STREAMS = ("APP/STDOUT", "APP/STDERR", "TEST/STDOUT", "TEST/STDERR")
+
+# timestamp, stream, flags, line length
+RECORD_HEADER = struct.Struct('<dBBI')
+# offset, end offset, first record number, min timestamp, max timestamp, stream mask, flags
+INDEX_ENTRY = struct.Struct('<QQQddBB')
+
+RECORD_ERROR = 1
+BLOCK_HAS_ERROR = 1
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# Lines marking a failure: python errors and tracebacks, test failures and chip error logs
+ERROR_PTRN = re.compile(rb'Traceback \(most recent call last\)|\b(?:ERROR|CRITICAL|FAIL|FAILED)\b|\bCHIP:[A-Z]+: .*\b[Ee]rror\b')
+
+
+class LogRecord(typing.NamedTuple):
+    timestamp: float
+    stream: str
+    line: bytes
+    error: bool
+
+
+class IndexBlock(typing.NamedTuple):
+    offset: int
+    end_offset: int
+    first_record: int
+    min_timestamp: float
+    max_timestamp: float
+    stream_mask: int
+    flags: int
+
+
+def stream_mask(streams: typing.Optional[typing.Iterable[str]]) -> int:
+    """
+    Bit mask of the given stream names, all streams when None.
+    """
+    if streams is None:
+        return (1 << len(STREAMS)) - 1
+
+    mask = 0
+    for stream in streams:
+        if stream not in STREAMS:
+            raise ValueError(f"Unknown log stream {stream!r}, expected one of {', '.join(STREAMS)}")
+        mask |= 1 << STREAMS.index(stream)
+    return mask
+
+
+class LogArchiveWriter:
+    """
+    Writes a log archive. Lines may be appended from several threads, for
+    example from the LogPump of a run and the one of an AppPool.
+    """
+
+    def __init__(self, archive_path: str, block_size: int = DEFAULT_BLOCK_SIZE,
+                 error_pattern: typing.Pattern[bytes] = ERROR_PTRN, exclusive: bool = False):
+        """
+        Parameters:
+
+        archive_path:
+         Path of the archive, the index is written next to it with an .idx suffix
+
+        exclusive:
+         Raise FileExistsError instead of overwriting an existing archive
+
+        block_size:
+         Number of record bytes covered by one index entry
+
+        error_pattern:
+         Lines matching this pattern are flagged as errors
+        """
+        self.archive_path = archive_path
+        self.block_size = block_size
+        self.error_pattern = error_pattern
+        self._lock = threading.Lock()
+        self._data = open(archive_path, 'xb' if exclusive else 'wb')
+        self._index = open(archive_path + INDEX_SUFFIX, 'wb')
+        self._data.write(DATA_MAGIC)
+        self._index.write(INDEX_MAGIC)
+        self._offset = len(DATA_MAGIC)
+        self._records = 0
+        self.__start_block__()
+
+    def __start_block__(self) -> None:
+        self._block_offset = self._offset
+        self._block_first_record = self._records
+        self._block_min = math.inf
+        self._block_max = -math.inf
+        self._block_mask = 0
+        self._block_flags = 0
+
+    def __end_block__(self) -> None:
+        if self._records == self._block_first_record:
+            return
+
+        # The index entry is only written once its records are on disk
+        self._data.flush()
+        self._index.write(INDEX_ENTRY.pack(self._block_offset, self._offset, self._block_first_record, self._block_min,
+                                           self._block_max, self._block_mask, self._block_flags))
+        self._index.flush()
+        self.__start_block__()
+
+    def append_lines(self, stream: str, lines: typing.List[bytes]) -> None:
+        """
+        Archives raw output lines of `stream`. Lines starting with a chip
+        log timestamp are archived with it, other lines with the current time.
+        """
+        stream_id = STREAMS.index(stream)
+        now = time.time()
+
+        with self._lock:
+            if self._data.closed:
+                return
+
+            for line in lines:
+                timestamp, _ = ParseLogTimestamp(line, now)
+                line = line.rstrip(b'\n')
+                flags = RECORD_ERROR if self.error_pattern.search(line) else 0
+
+                self._data.write(RECORD_HEADER.pack(timestamp, stream_id, flags, len(line)))
+                self._data.write(line)
+                self._offset += RECORD_HEADER.size + len(line)
+                self._records += 1
+
+                self._block_min = min(self._block_min, timestamp)
+                self._block_max = max(self._block_max, timestamp)
+                self._block_mask |= 1 << stream_id
+                if flags & RECORD_ERROR:
+                    self._block_flags |= BLOCK_HAS_ERROR
+
+                if self._offset - self._block_offset >= self.block_size:
+                    self.__end_block__()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._data.closed:
+                return
+            self.__end_block__()
+            self._data.close()
+            self._index.close()
+
+    @classmethod
+    def create_unique(cls, directory: str, name: str, **kwargs) -> 'LogArchiveWriter':
+        """
+        Creates the archive "<name>.log" in `directory`, or "<name>-<n>.log"
+        with the first free n when that name is taken, for example by an
+        earlier batch or by a run of the same name executing concurrently.
+        """
+        for attempt in itertools.count():
+            suffix = f"-{attempt}" if attempt else ""
+            try:
+                return cls(os.path.join(directory, f"{name}{suffix}.log"), exclusive=True, **kwargs)
+            except FileExistsError:
+                continue
+
+    def __enter__(self) -> 'LogArchiveWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class LogArchive:
+    """
+    Reads a log archive through its index. Records written after the last
+    index entry, e.g. when the run was killed, are read as one block that
+    matches every query.
+    """
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+
+        with open(archive_path, 'rb') as data:
+            if data.read(len(DATA_MAGIC)) != DATA_MAGIC:
+                raise ValueError(f"{archive_path} is not a log archive")
+        data_size = os.path.getsize(archive_path)
+
+        entries = []
+        index_path = archive_path + INDEX_SUFFIX
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as index:
+                content = index.read()
+            if content[:len(INDEX_MAGIC)] == INDEX_MAGIC:
+                body = content[len(INDEX_MAGIC):]
+                # Ignore a truncated last entry
+                body = body[:len(body) - len(body) % INDEX_ENTRY.size]
+                entries = list(INDEX_ENTRY.iter_unpack(body))
+
+        self.blocks: typing.List[IndexBlock] = [IndexBlock(*entry) for entry in entries]
+
+        indexed_end = self.blocks[-1].end_offset if self.blocks else len(DATA_MAGIC)
+        if indexed_end < data_size:
+            self.blocks.append(IndexBlock(indexed_end, data_size, -1, -math.inf, math.inf,
+                                          stream_mask(None), BLOCK_HAS_ERROR))
+
+    def read_block(self, block: IndexBlock) -> typing.List[LogRecord]:
+        """
+        Decodes the records of one block. A truncated last record is ignored.
+        """
+        with open(self.archive_path, 'rb') as data:
+            data.seek(block.offset)
+            content = data.read(block.end_offset - block.offset)
+
+        records = []
+        position = 0
+        while position + RECORD_HEADER.size <= len(content):
+            timestamp, stream_id, flags, length = RECORD_HEADER.unpack_from(content, position)
+            position += RECORD_HEADER.size
+            if position + length > len(content):
+                break
+            records.append(LogRecord(timestamp, STREAMS[stream_id], content[position:position + length],
+                                     bool(flags & RECORD_ERROR)))
+            position += length
+        return records
+
+    def records(self, start: typing.Optional[float] = None, end: typing.Optional[float] = None,
+                streams: typing.Optional[typing.Iterable[str]] = None) -> typing.Iterator[LogRecord]:
+        """
+        Yields the records within a time range and of the given streams, in
+        archive order. Blocks outside the range or without those streams
+        are not read.
+        """
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        mask = stream_mask(streams)
+        names = {STREAMS[i] for i in range(len(STREAMS)) if mask & (1 << i)}
+
+        for block in self.blocks:
+            if not block.stream_mask & mask or block.max_timestamp < start or block.min_timestamp > end:
+                continue
+            for record in self.read_block(block):
+                if record.stream in names and start <= record.timestamp <= end:
+                    yield record
+
+    def around_first_error(self, context: int,
+                           streams: typing.Optional[typing.Iterable[str]] = None) -> typing.List[LogRecord]:
+        """
+        Returns the first error record with up to `context` records before
+        and after it, or an empty list when no error was archived. Only the
+        blocks holding those records are read.
+        """
+        mask = stream_mask(streams)
+        names = {STREAMS[i] for i in range(len(STREAMS)) if mask & (1 << i)}
+
+        def select(block: IndexBlock) -> typing.List[LogRecord]:
+            if not block.stream_mask & mask:
+                return []
+            return [record for record in self.read_block(block) if record.stream in names]
+
+        for position, block in enumerate(self.blocks):
+            if not block.flags & BLOCK_HAS_ERROR or not block.stream_mask & mask:
+                continue
+
+            records = select(block)
+            error = next((i for i, record in enumerate(records) if record.error), None)
+            if error is None:
+                continue
+
+            before = records[:error]
+            previous = position - 1
+            while len(before) < context and previous >= 0:
+                before = select(self.blocks[previous]) + before
+                previous -= 1
+
+            after = records[error + 1:]
+            following = position + 1
+            while len(after) < context and following < len(self.blocks):
+                after += select(self.blocks[following])
+                following += 1
+
+            return before[max(0, len(before) - context):] + [records[error]] + after[:context]
+
+        return []
+
+
+def FormatRecord(record: LogRecord) -> str:
+    timestamp = datetime.datetime.fromtimestamp(record.timestamp).isoformat(sep=' ')
+    marker = "!" if record.error else " "
+    return f"[{timestamp}][{record.stream}]{marker}{record.line.decode('utf-8', 'replace')}"
+
+
+def parse_time(value: str) -> float:
+    """
+    Parses a time given as a unix timestamp or in ISO format.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a run log archive.')
+    parser.add_argument('archive', help='Path to the log archive of a run')
+    parser.add_argument('--start', type=parse_time, default=None,
+                        help='Only show lines at or after this time (unix timestamp or ISO format)')
+    parser.add_argument('--end', type=parse_time, default=None,
+                        help='Only show lines at or before this time (unix timestamp or ISO format)')
+    parser.add_argument('--stream', action='append', choices=STREAMS, default=None,
+                        help='Only show lines of this stream, may be repeated')
+    parser.add_argument('--around-error', type=int, default=None, metavar='N',
+                        help='Show the first error with N lines of context before and after it')
+    args = parser.parse_args()
+
+    archive = LogArchive(args.archive)
+
+    if args.around_error is not None:
+        records = archive.around_first_error(args.around_error, args.stream)
+        if not records:
+            print("No error found in the archive")
+            sys.exit(1)
+    else:
+        records = archive.records(args.start, args.end, args.stream)
+
+    for record in records:
+        print(FormatRecord(record))
+
+
+if __name__ == "__main__":
+    main()
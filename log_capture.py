@@ -0,0 +1,94 @@
+import collections
+import mmap
+import tempfile
+import threading
+import typing
+
+DEFAULT_MEMORY_LIMIT_MB = 16
+
+
+class BoundedCapture:
+    """
+    Binary output stream used to hold the output of a run in --quiet mode.
+
+    The most recent `memory_limit` bytes are kept in memory. Older data is
+    spilled to an anonymous temporary file, so the memory used by a run stays
+    bounded however much output it produces. On replay the spilled part is
+    memory-mapped and streamed out as is, without decoding or copying the
+    whole capture.
+    """
+
+    def __init__(self, memory_limit: int = DEFAULT_MEMORY_LIMIT_MB * 1024 * 1024):
+        """
+        Parameters:
+
+        memory_limit:
+         Maximum number of bytes held in memory before older data is spilled to disk.
+        """
+        self.memory_limit = memory_limit
+        self._chunks: typing.Deque[bytes] = collections.deque()
+        self._memory_size = 0
+        self._spill: typing.Optional[typing.BinaryIO] = None
+        self._spill_size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """
+        Total number of bytes captured.
+        """
+        return self._spill_size + self._memory_size
+
+    @property
+    def spilled_size(self) -> int:
+        """
+        Number of bytes spilled to disk.
+        """
+        return self._spill_size
+
+    def write(self, data: bytes) -> int:
+        with self._lock:
+            self._chunks.append(bytes(data))
+            self._memory_size += len(data)
+
+            while self._memory_size > self.memory_limit and self._chunks:
+                chunk = self._chunks.popleft()
+                self._memory_size -= len(chunk)
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile(prefix="chip-quiet-")
+                self._spill.write(chunk)
+                self._spill_size += len(chunk)
+
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def replay(self, output: typing.BinaryIO, chunk_size: int = 1024 * 1024) -> None:
+        """
+        Writes everything captured so far to `output`, oldest data first.
+        """
+        with self._lock:
+            if self._spill_size:
+                self._spill.flush()
+                with mmap.mmap(self._spill.fileno(), self._spill_size, access=mmap.ACCESS_READ) as spilled:
+                    view = memoryview(spilled)
+                    try:
+                        for offset in range(0, self._spill_size, chunk_size):
+                            output.write(view[offset:offset + chunk_size])
+                    finally:
+                        view.release()
+
+            for chunk in self._chunks:
+                output.write(chunk)
+
+        output.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+            self._chunks.clear()
+            self._memory_size = 0
+            self._spill_size = 0
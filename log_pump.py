@@ -0,0 +1,243 @@
+import datetime
+import functools
+import logging
+import os
+import selectors
+import threading
+import time
+import typing
+
+from colorama import Fore, Style
+
+# Length of the "[1646290606.901990]" timestamp prefix of chip app log lines
+CHIP_TIMESTAMP_LEN = len('[1646290606.901990]')
+
+
+class TimestampFormatter:
+    """
+    Formats timestamps the way datetime.isoformat(sep=' ') does, caching the
+    date and time part so that it is computed once per second instead of once
+    per line.
+    """
+
+    def __init__(self):
+        self._second = None
+        self._prefix = ''
+
+    def format(self, timestamp: float) -> bytes:
+        second = int(timestamp)
+        microsecond = round((timestamp - second) * 1e6)
+        if microsecond >= 1000000:
+            return f"[{datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')}]".encode()
+
+        if second != self._second:
+            self._second = second
+            self._prefix = datetime.datetime.fromtimestamp(second).isoformat(sep=' ')
+
+        if microsecond:
+            return f"[{self._prefix}.{microsecond:06d}]".encode()
+        return f"[{self._prefix}]".encode()
+
+
+def ParseLogTimestamp(line: bytes, now: float) -> typing.Tuple[float, bytes]:
+    """
+    Splits the chip log timestamp off a raw output line. Lines without one
+    are timestamped with `now`.
+    """
+    if len(line) > CHIP_TIMESTAMP_LEN and line[0:1] == b'[':
+        try:
+            return float(line[1:18].decode()), line[19:]
+        except Exception:
+            pass
+    return now, line
+
+
+def CookLogLine(line: bytes, tag: bytes, now: float, formatter: TimestampFormatter) -> bytes:
+    """
+    Prefixes a raw output line with its timestamp and tag. Lines starting
+    with a chip log timestamp use that timestamp instead of `now`.
+    """
+    timestamp, line = ParseLogTimestamp(line, now)
+    return formatter.format(timestamp) + tag + line
+
+
+def ChainWatchers(*watchers: typing.Optional[typing.Callable[[typing.List[bytes]], None]]
+                  ) -> typing.Optional[typing.Callable[[typing.List[bytes]], None]]:
+    """
+    Combines line watchers into one calling each of them in turn. None
+    entries are ignored.
+    """
+    watchers = [watcher for watcher in watchers if watcher is not None]
+    if not watchers:
+        return None
+    if len(watchers) == 1:
+        return watchers[0]
+
+    def watch(lines: typing.List[bytes]) -> None:
+        for watcher in watchers:
+            watcher(lines)
+    return watch
+
+
+class PumpStream:
+    """
+    A pipe registered with a LogPump. `done` is set once the pipe reached
+    end of file and all of its output was written, or once writing to its
+    output failed and the rest of the pipe's output was dropped. `watch`, when set, is
+    called from the pump thread with every batch of raw lines.
+    """
+
+    def __init__(self, fp, tag: bytes, output: typing.BinaryIO,
+                 watch: typing.Optional[typing.Callable[[typing.List[bytes]], None]] = None):
+        self.fp = fp
+        self.fd = fp.fileno()
+        self.tag = tag
+        self.output = output
+        self.watch = watch
+        self.partial = b''
+        self.done = threading.Event()
+
+
+class LogPump:
+    """
+    Copies the output of many child process pipes to their output streams
+    from a single thread.
+
+    Pipes are read in large non-blocking chunks as they become readable,
+    split into lines in bulk, cooked with a timestamp and tag, and written
+    and flushed once per batch of ready pipes.
+    """
+
+    def __init__(self, chunk_size: int = 64 * 1024):
+        """
+        Parameters:
+
+        chunk_size:
+         Maximum number of bytes read from a pipe at once.
+        """
+        self.chunk_size = chunk_size
+        self._selector = selectors.DefaultSelector()
+        self._formatter = TimestampFormatter()
+        self._lock = threading.Lock()
+        self._pending: typing.List[PumpStream] = []
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._closing = False
+        self._thread = threading.Thread(target=self.__run__, name="LogPump", daemon=True)
+        self._thread.start()
+
+    def add(self, fp, tag: bytes, output: typing.BinaryIO,
+            watch: typing.Optional[typing.Callable[[typing.List[bytes]], None]] = None) -> PumpStream:
+        """
+        Starts copying a pipe to `output`, prefixing every line with `tag`.
+        """
+        stream = PumpStream(fp, tag, output, watch)
+        os.set_blocking(stream.fd, False)
+        with self._lock:
+            self._pending.append(stream)
+        os.write(self._wakeup_write, b'\0')
+        return stream
+
+    def add_process(self, tag: str, process, output: typing.BinaryIO,
+                    watch: typing.Optional[typing.Callable[[typing.List[bytes]], None]] = None,
+                    archive=None, source: str = "") -> typing.List[PumpStream]:
+        """
+        Starts copying the stdout and stderr pipes of a process, tagged
+        "[<tag>][STDOUT]" and "[<tag>][STDERR]".
+
+        When `archive` is set, the raw lines are also appended to it under
+        the stream names "<source>/STDOUT" and "<source>/STDERR".
+        """
+        streams = []
+        for name, fp, color in (("STDOUT", process.stdout, Fore.YELLOW), ("STDERR", process.stderr, Fore.RED)):
+            stream_watch = watch
+            if archive is not None:
+                stream_watch = ChainWatchers(watch, functools.partial(archive.append_lines, f"{source}/{name}"))
+            streams.append(self.add(fp, (f"[{tag}][{color}{name}{Style.RESET_ALL}]").encode(), output, stream_watch))
+        return streams
+
+    def close(self) -> None:
+        """
+        Stops the pump thread. Pipes that did not reach end of file are dropped.
+        """
+        self._closing = True
+        os.write(self._wakeup_write, b'\0')
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def __register_pending__(self) -> None:
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        for stream in pending:
+            self._selector.register(stream.fd, selectors.EVENT_READ, stream)
+
+    def __detach_output__(self, output: typing.BinaryIO) -> typing.List[PumpStream]:
+        detached = []
+        for key in list(self._selector.get_map().values()):
+            stream = key.data
+            if stream is not None and stream.output is output:
+                self._selector.unregister(stream.fd)
+                detached.append(stream)
+        return detached
+
+    def __run__(self) -> None:
+        while not self._closing:
+            batches: typing.Dict[int, typing.List[bytes]] = {}
+            outputs: typing.Dict[int, typing.BinaryIO] = {}
+            finished: typing.List[PumpStream] = []
+            now = time.time()
+
+            for key, _ in self._selector.select():
+                stream = key.data
+                if stream is None:
+                    self.__register_pending__()
+                    continue
+
+                try:
+                    chunk = os.read(stream.fd, self.chunk_size)
+                except BlockingIOError:
+                    continue
+
+                if chunk:
+                    lines = (stream.partial + chunk).split(b'\n')
+                    stream.partial = lines.pop()
+                    lines = [line + b'\n' for line in lines]
+                else:
+                    # End of file, emit any unterminated last line
+                    lines = [stream.partial] if stream.partial else []
+                    stream.partial = b''
+                    self._selector.unregister(stream.fd)
+                    finished.append(stream)
+
+                if lines and stream.watch is not None:
+                    try:
+                        stream.watch(lines)
+                    except Exception:
+                        logging.exception("Log watcher failed")
+
+                if lines:
+                    batch = batches.setdefault(id(stream.output), [])
+                    outputs[id(stream.output)] = stream.output
+                    batch.extend(CookLogLine(line, stream.tag, now, self._formatter) for line in lines)
+
+            for output_id, batch in batches.items():
+                try:
+                    outputs[output_id].write(b''.join(batch))
+                    outputs[output_id].flush()
+                except Exception:
+                    logging.exception("Writing log output failed, dropping the pipes copied to it")
+                    finished.extend(self.__detach_output__(outputs[output_id]))
+
+            for stream in finished:
+                stream.fp.close()
+                stream.done.set()
@@ -1,9 +1,26 @@
+import dataclasses
+import fnmatch
+import hashlib
+import json
+import logging
+import os
 import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, List, Mapping, Optional, Any, Set, Tuple, Union
 import yaml
 
 
+def parse_bool(value: Any) -> bool:
+    """
+    Converts a directive value such as "True" or "false" to a boolean.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes", "on")
+    return bool(value)
+
+
 @dataclass
 class Metadata:
     py_script_path: str
@@ -15,6 +32,13 @@ class Metadata:
     factoryreset_app_only: bool = False
     script_gdb: bool = False
     quiet: bool = True
+    sandbox_dir: str = ""
+    netns: str = ""
+    quiet_buffer_mb: int = 0
+    app_ready_pattern: str = ""
+    app_ready_port: int = 0
+    app_ready_timeout: float = 0
+    commissioned_snapshot: bool = False
 
     def copy_from_dict(self, attr_dict: Dict[str, Any]) -> None:
         """
@@ -42,16 +66,411 @@ class Metadata:
             self.py_script_path = attr_dict["py_script_path"]
 
         if "factoryreset" in attr_dict:
-            self.factoryreset = bool(attr_dict["factoryreset"])
+            self.factoryreset = parse_bool(attr_dict["factoryreset"])
 
         if "factoryreset_app_only" in attr_dict:
-            self.factoryreset_app_only = bool(attr_dict["factoryreset_app_only"])
+            self.factoryreset_app_only = parse_bool(attr_dict["factoryreset_app_only"])
 
         if "script_gdb" in attr_dict:
-            self.script_gdb = bool(attr_dict["script_gdb"])
+            self.script_gdb = parse_bool(attr_dict["script_gdb"])
 
         if "quiet" in attr_dict:
-            self.quiet = bool(attr_dict["quiet"])
+            self.quiet = parse_bool(attr_dict["quiet"])
+
+        if "quiet_buffer_mb" in attr_dict:
+            self.quiet_buffer_mb = int(attr_dict["quiet_buffer_mb"])
+
+        if "app-ready-pattern" in attr_dict:
+            self.app_ready_pattern = attr_dict["app-ready-pattern"]
+
+        if "app-ready-port" in attr_dict:
+            self.app_ready_port = int(attr_dict["app-ready-port"])
+
+        if "app-ready-timeout" in attr_dict:
+            self.app_ready_timeout = float(attr_dict["app-ready-timeout"])
+
+        if "commissioned-snapshot" in attr_dict:
+            self.commissioned_snapshot = parse_bool(attr_dict["commissioned-snapshot"])
+
+
+def find_scripts(paths: Iterable[str], pattern: str = "TC_*.py") -> List[str]:
+    """
+    Expands a list of script and directory paths into a list of script paths.
+    Directories are searched recursively for files matching `pattern`.
+    """
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(fnmatch.filter(files, pattern)):
+                    scripts.append(os.path.join(root, name))
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def write_manifest(runs: Iterable[Metadata], manifest_path: str) -> None:
+    """
+    Writes runs to an NDJSON manifest, one compact JSON object per run.
+    Placeholders such as {SCRIPT_BASE_NAME} are filled, so that manifest
+    runs do not depend on the script path they are later executed from.
+    """
+    with open(manifest_path, 'w', encoding='utf8') as manifest:
+        for run in runs:
+            placeholders = {'SCRIPT_BASE_NAME': os.path.splitext(os.path.basename(run.py_script_path))[0]}
+            record = dataclasses.asdict(run)
+            for arg in ("app_args", "script_args"):
+                record[arg] = fill_placeholders(record[arg], placeholders)
+            manifest.write(json.dumps(record, separators=(',', ':')))
+            manifest.write('\n')
+
+
+def read_manifest(manifest_path: str) -> List[Metadata]:
+    """
+    Reads the runs of an NDJSON manifest written by write_manifest.
+    """
+    with open(manifest_path, 'r', encoding='utf8') as manifest:
+        return [Metadata(**json.loads(line)) for line in manifest if line.strip()]
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class ParseDiagnostic:
+    """
+    A test-runner directive that could not be applied.
+    """
+    py_script_path: str
+    line_number: int
+    line: str
+    message: str
+
+    def __str__(self) -> str:
+        return f"{self.py_script_path}:{self.line_number}: {self.message}: {self.line}"
+
+
+class MetadataIndex:
+    """
+    On-disk index of the runs parsed from test scripts.
+
+    Entries are keyed by the absolute script path and remember the script's
+    mtime, size and content hash along with the hash of the environment file
+    the runs were resolved against. A lookup only needs a stat() of the script
+    when its mtime and size are unchanged; the content hash is used to revive
+    entries of scripts that were touched without being modified. The
+    diagnostics reported while parsing a script are stored with its runs.
+    Changes are only written by save().
+    """
+
+    # Bumped whenever parsing or resolving a script can produce different runs or diagnostics
+    PARSER_VERSION = 4
+    # Bumped whenever the stored layout changes, the Metadata fields are part of it
+    FORMAT = f"2:{PARSER_VERSION}:" + ",".join(f.name for f in dataclasses.fields(Metadata))
+
+    def __init__(self, index_path: str):
+        """
+        Loads the index from disk. A missing, corrupt or outdated index is
+        treated as empty.
+
+        Parameters:
+
+        index_path:
+         Path to the JSON file storing the index.
+        """
+        self.index_path = index_path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+
+        try:
+            with open(index_path, 'r', encoding='utf8') as stream:
+                data = json.load(stream)
+            if data.get("format") == self.FORMAT:
+                self._entries = data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def lookup(self, py_script_path: str, env_hash: str) -> Optional[Tuple[List[Metadata], List[ParseDiagnostic]]]:
+        """
+        Returns the cached runs and diagnostics of a script, or None when the
+        script or the environment changed since they were stored.
+        """
+        entry = self._entries.get(os.path.abspath(py_script_path))
+        if entry is None or entry["env_hash"] != env_hash:
+            return None
+
+        try:
+            stat = os.stat(py_script_path)
+        except OSError:
+            return None
+
+        if stat.st_size != entry["size"]:
+            return None
+
+        if stat.st_mtime_ns != entry["mtime_ns"]:
+            if hash_file(py_script_path) != entry["sha256"]:
+                return None
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self._dirty = True
+
+        runs = [Metadata(**dict(run, py_script_path=py_script_path)) for run in entry["runs"]]
+        diagnostics = [ParseDiagnostic(**dict(diagnostic, py_script_path=py_script_path))
+                       for diagnostic in entry["diagnostics"]]
+        return runs, diagnostics
+
+    def store(self, py_script_path: str, env_hash: str, runs: List[Metadata],
+              diagnostics: Optional[List[ParseDiagnostic]] = None) -> None:
+        """
+        Records the runs parsed from a script and the diagnostics reported while parsing it.
+        """
+        stat = os.stat(py_script_path)
+        self._entries[os.path.abspath(py_script_path)] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": hash_file(py_script_path),
+            "env_hash": env_hash,
+            "runs": [dataclasses.asdict(run) for run in runs],
+            "diagnostics": [dataclasses.asdict(diagnostic) for diagnostic in diagnostics or []],
+        }
+        self._dirty = True
+
+    def save(self) -> None:
+        """
+        Atomically writes the index to disk if it changed.
+        """
+        if not self._dirty:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf8') as stream:
+            json.dump({"format": self.FORMAT, "entries": self._entries}, stream, separators=(',', ':'))
+        os.replace(temp_path, self.index_path)
+        self._dirty = False
+
+
+# Start of a "${...}" reference or a "{PLACEHOLDER}" such as {SCRIPT_BASE_NAME}
+TEMPLATE_TOKEN_PTRN = re.compile(r'\$\{|\{(?P<placeholder>[A-Z_][A-Z0-9_]*)\}')
+# A "{PLACEHOLDER}" that is not the body of a "${...}" reference
+PLACEHOLDER_PTRN = re.compile(r'(?<!\$)\{(?P<placeholder>[A-Z_][A-Z0-9_]*)\}')
+
+
+def fill_placeholders(text: str, placeholders: Optional[Mapping[str, str]]) -> str:
+    """
+    Fills the "{NAME}" placeholders of a string that have a value, leaving
+    "${...}" references and unknown placeholders untouched.
+    """
+    if not placeholders:
+        return text
+    return PLACEHOLDER_PTRN.sub(lambda m: placeholders.get(m.group('placeholder'), m.group(0)), text)
+
+
+class EnvTemplate:
+    """
+    A string containing "${NAME}" environment references and "{NAME}"
+    placeholders, tokenized once so that it can be rendered in a single pass.
+
+    References may be nested ("${APP_${BOARD}}") and may carry a default
+    value ("${NAME:-default}"). A reference to an unknown variable without a
+    default, and a placeholder without a value, are kept verbatim.
+    Placeholders inside the value of a variable are filled as well.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.parts: List[Union[str, Tuple[Any, ...]]] = []
+        self.__tokenize__()
+
+    @property
+    def is_literal(self) -> bool:
+        return all(isinstance(part, str) for part in self.parts)
+
+    @property
+    def has_placeholders(self) -> bool:
+        """
+        Whether the template, the name of one of its references or one of
+        their defaults contains a "{NAME}" placeholder.
+        """
+        for part in self.parts:
+            if isinstance(part, str):
+                continue
+            if part[0] == "placeholder":
+                return True
+            _, name, default, _ = part
+            if not isinstance(name, str) and name.has_placeholders:
+                return True
+            if default is not None and default.has_placeholders:
+                return True
+        return False
+
+    def __tokenize__(self) -> None:
+        text = self.text
+        pos = 0
+        literal_start = 0
+
+        while True:
+            match = TEMPLATE_TOKEN_PTRN.search(text, pos)
+            if match is None:
+                break
+
+            if match.group('placeholder'):
+                self.__add_literal__(text[literal_start:match.start()])
+                self.parts.append(("placeholder", match.group('placeholder'), match.group(0)))
+                pos = literal_start = match.end()
+                continue
+
+            end = self.__find_closing_brace__(match.end())
+            if end < 0:
+                # Unterminated reference, keep it as text
+                pos = match.end()
+                continue
+
+            self.__add_literal__(text[literal_start:match.start()])
+            body = text[match.end():end]
+            name, default = self.__split_default__(body)
+            name_template = EnvTemplate(name)
+            self.parts.append(("env", name if name_template.is_literal else name_template,
+                               None if default is None else EnvTemplate(default), text[match.start():end + 1]))
+            pos = literal_start = end + 1
+
+        self.__add_literal__(text[literal_start:])
+
+    def __add_literal__(self, literal: str) -> None:
+        if literal:
+            self.parts.append(literal)
+
+    def __find_closing_brace__(self, pos: int) -> int:
+        depth = 1
+        text = self.text
+        while pos < len(text):
+            if text[pos] == '{':
+                depth += 1
+            elif text[pos] == '}':
+                depth -= 1
+                if depth == 0:
+                    return pos
+            pos += 1
+        return -1
+
+    @staticmethod
+    def __split_default__(body: str) -> Tuple[str, Optional[str]]:
+        depth = 0
+        for pos in range(len(body) - 1):
+            if body[pos] == '{':
+                depth += 1
+            elif body[pos] == '}':
+                depth -= 1
+            elif depth == 0 and body.startswith(':-', pos):
+                return body[:pos], body[pos + 2:]
+        return body, None
+
+    def references(self) -> Tuple[Set[str], bool]:
+        """
+        Lists the environment variables the template refers to.
+
+        Return:
+
+        Tuple[Set[str], bool]
+         Names of the referenced variables, and whether a variable name is
+         itself built from other references ("${APP_${BOARD}}") so that the
+         template may depend on any variable.
+        """
+        names: Set[str] = set()
+        dynamic = False
+        for part in self.parts:
+            if isinstance(part, str) or part[0] == "placeholder":
+                continue
+
+            _, name, default, _ = part
+            if isinstance(name, str):
+                names.add(name)
+            else:
+                nested_names, _ = name.references()
+                names |= nested_names
+                dynamic = True
+
+            if default is not None:
+                default_names, default_dynamic = default.references()
+                names |= default_names
+                dynamic = dynamic or default_dynamic
+        return names, dynamic
+
+    def render(self, env: Mapping[str, str], placeholders: Optional[Mapping[str, str]] = None) -> str:
+        """
+        Renders the template against the environment and placeholder values.
+        """
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            elif part[0] == "placeholder":
+                _, name, raw = part
+                out.append(placeholders[name] if placeholders and name in placeholders else raw)
+            else:
+                _, name, default, raw = part
+                if not isinstance(name, str):
+                    name = name.render(env, placeholders)
+                if name in env:
+                    out.append(fill_placeholders(env[name], placeholders))
+                elif default is not None:
+                    out.append(default.render(env, placeholders))
+                else:
+                    out.append(raw)
+        return "".join(out)
+
+
+class EnvSubstitution:
+    """
+    Resolves "${NAME}" references against an environment mapping, caching
+    compiled templates and their resolved values so that arguments shared by
+    many scripts are only expanded once.
+    """
+
+    def __init__(self, env: Optional[Mapping[str, Any]]):
+        self.env: Dict[str, str] = {str(name): str(value) for name, value in (env or {}).items()}
+        self._templates: Dict[str, EnvTemplate] = {}
+        self._resolved: Dict[Union[str, Tuple[str, Tuple[Tuple[str, str], ...]]], str] = {}
+        self._env_has_placeholders = any(PLACEHOLDER_PTRN.search(value) for value in self.env.values())
+
+    def compile(self, text: str) -> EnvTemplate:
+        template = self._templates.get(text)
+        if template is None:
+            template = self._templates[text] = EnvTemplate(text)
+        return template
+
+    def resolve(self, text: str, placeholders: Optional[Mapping[str, str]] = None) -> str:
+        """
+        Resolves a string. Placeholders such as {SCRIPT_BASE_NAME} are filled
+        in the same pass when values for them are given. Resolved strings are
+        memoized by their placeholder values only when those can change the
+        result, so that arguments without placeholders are shared by all
+        scripts.
+        """
+        template = self.compile(text)
+        key: Union[str, Tuple[str, Tuple[Tuple[str, str], ...]]] = text
+        if placeholders and (template.has_placeholders or (self._env_has_placeholders and not template.is_literal)):
+            key = (text, tuple(sorted(placeholders.items())))
+
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            resolved = self._resolved[key] = template.render(self.env, placeholders)
+        return resolved
+
+
+# Matches both "# test-runner-runs: <runs>" and "# test-runner-run/<run>/<arg>: <value>"
+DIRECTIVE_PTRN = re.compile(
+    r'#\s*test-runner-(?:runs:\s*(?P<runs>.*?)|run/(?P<run>[a-zA-Z0-9_]+)/(?P<arg>[a-zA-Z0-9_\-]+):\s*(?P<value>.*?))\s*$')
+DIRECTIVE_PREFIX_PTRN = re.compile(r'#\s*test-runner-')
 
 
 class MetadataReader:
@@ -60,7 +479,10 @@ class MetadataReader:
     resolve them to environment specific values.
     """
 
-    def __init__(self, env_yaml_file_path: str):
+    # Below this many uncached scripts, spawning worker processes costs more than it saves
+    PARALLEL_PARSE_THRESHOLD = 32
+
+    def __init__(self, env_yaml_file_path: str, index_path: Optional[str] = None, header_only: bool = True):
         """
         Reads the YAML file and Constructs the environment object
 
@@ -68,11 +490,34 @@ class MetadataReader:
 
         env_yaml_file_path:
          Path to the environment file that contains the YAML configuration.
+
+        index_path:
+         Optional path to an on-disk MetadataIndex used to skip parsing
+         scripts that did not change.
+
+        header_only:
+         If true, stop reading a script at the end of its leading comment
+         block. Scripts that place directives later need this set to false.
+        """
+        with open(env_yaml_file_path, 'rb') as stream:
+            env_content = stream.read()
+
+        self.env_yaml_file_path = env_yaml_file_path
+        self.env: Dict[str, str] = yaml.safe_load(env_content)
+        self.substitution = EnvSubstitution(self.env)
+        self.env_hash = hashlib.sha256(env_content).hexdigest()
+        self.index = MetadataIndex(index_path) if index_path else None
+        self.header_only = header_only
+        self.diagnostics: List[ParseDiagnostic] = []
+
+    def save_index(self) -> None:
+        """
+        Writes the metadata index to disk, if one is used.
         """
-        with open(env_yaml_file_path) as stream:
-            self.env: Dict[str, str] = yaml.safe_load(stream)
+        if self.index:
+            self.index.save()
 
-    def __resolve_env_vals__(self, metadata_dict: Dict[str, str]) -> None:
+    def __resolve_env_vals__(self, metadata_dict: Dict[str, str], placeholders: Optional[Mapping[str, str]] = None) -> None:
         """
         Resolves the argument defined in the test script to environment values.
         For example, if a test script defines "all_clusters" as the value for app
@@ -85,15 +530,80 @@ class MetadataReader:
         metadata_dict:
          Dictionary where each key represent a particular argument and its value represent
          the value for that argument defined in the test script.
+
+        placeholders:
+         Values of placeholders such as {SCRIPT_BASE_NAME}
         """
         for arg, arg_val in metadata_dict.items():
-            # We do not expect to recurse (like ${FOO_${BAR}}) so just expand once
-            for name, value in self.env.items():
-                arg_val = arg_val.replace(f'${{{name}}}', value)
-            metadata_dict[arg] = arg_val
+            metadata_dict[arg] = self.substitution.resolve(arg_val, placeholders)
 
+    def read_directives(self, py_script_path: str, header_only: bool = True,
+                        report: bool = True) -> Dict[str, Dict[str, str]]:
+        """
+        Reads the raw, unresolved test-runner directives of a script.
 
-    def parse_script(self, py_script_path: str) -> List[Metadata]:
+        The file is streamed line by line and, when header_only is set, reading
+        stops at the first line that is neither blank nor a comment. Malformed
+        directives and arguments of undeclared runs are logged and recorded in
+        self.diagnostics instead of aborting the parse.
+
+        Parameter:
+
+        py_script_path:
+         path to the python test script
+
+        header_only:
+         stop at the end of the leading comment block
+
+        report:
+         log and record malformed directives, otherwise they are only skipped
+
+        Return:
+
+        Dict[str, Dict[str, str]]
+         Directive arguments of each declared run, keyed by run name
+        """
+
+        runs_arg_lines: Dict[str, Dict[str, str]] = {}
+
+        with open(py_script_path, 'r', encoding='utf8') as py_script:
+            for line_number, line in enumerate(py_script, start=1):
+                line = line.strip()
+                if not line.startswith('#'):
+                    if line and header_only:
+                        break
+                    continue
+
+                match = DIRECTIVE_PTRN.fullmatch(line)
+                if match is None:
+                    if report and DIRECTIVE_PREFIX_PTRN.match(line):
+                        self.__report__(py_script_path, line_number, line, "Malformed test-runner directive")
+                    continue
+
+                if match.group('runs') is not None:
+                    for run in match.group('runs').split():
+                        runs_arg_lines[run] = {}
+                        runs_arg_lines[run]['run'] = run
+                        runs_arg_lines[run]['py_script_path'] = py_script_path
+
+                elif match.group('run') in runs_arg_lines:
+                    runs_arg_lines[match.group('run')][match.group('arg')] = match.group('value')
+
+                elif report:
+                    self.__report__(py_script_path, line_number, line,
+                                    f"Run '{match.group('run')}' is not declared in test-runner-runs")
+
+        return runs_arg_lines
+
+    def __report__(self, py_script_path: str, line_number: int, line: str, message: str) -> None:
+        self.__replay__([ParseDiagnostic(py_script_path, line_number, line, message)])
+
+    def __replay__(self, diagnostics: List[ParseDiagnostic]) -> None:
+        for diagnostic in diagnostics:
+            logging.warning(str(diagnostic))
+            self.diagnostics.append(diagnostic)
+
+    def parse_script(self, py_script_path: str, header_only: Optional[bool] = None) -> List[Metadata]:
         """
         Parses a script and returns a list of metadata object where
         each element of that list representing run arguments associated
@@ -104,6 +614,9 @@ class MetadataReader:
         py_script_path:
          path to the python test script
 
+        header_only:
+         overrides the reader's header_only setting for this script
+
         Return:
 
         List[Metadata]
@@ -112,28 +625,94 @@ class MetadataReader:
          the script file.
         """
 
-        runs_def_ptrn = re.compile(r'^\s*#\s*test-runner-runs:\s*(.*)$')
-        arg_def_ptrn = re.compile(r'^\s*#\s*test-runner-run/([a-zA-Z0-9_]+)/([a-zA-Z0-9_\-]+):\s*(.*)$')
+        if header_only is None:
+            header_only = self.header_only
 
-        runs_arg_lines: Dict[str, Dict[str, str]] = {}
-        runs_metadata: List[Metadata] = []
+        # Runs parsed with and without header_only may differ, keep them apart in the index
+        index_hash = self.env_hash if header_only else self.env_hash + ":full"
 
-        with open(py_script_path, 'r', encoding='utf8') as py_script:
-            for line in py_script.readlines():
-                runs_match = runs_def_ptrn.match(line.strip())
-                args_match = arg_def_ptrn.match(line.strip())
+        if self.index:
+            cached = self.index.lookup(py_script_path, index_hash)
+            if cached is not None:
+                runs, diagnostics = cached
+                self.__replay__(diagnostics)
+                return runs
 
-                if runs_match:
-                    for run in runs_match.group(1).strip().split():
-                        runs_arg_lines[run] = {}
-                        runs_arg_lines[run]['run'] = run
-                        runs_arg_lines[run]['py_script_path'] = py_script_path
+        first_diagnostic = len(self.diagnostics)
+        runs = self.__parse_script_file__(py_script_path, header_only)
+
+        if self.index:
+            self.index.store(py_script_path, index_hash, runs, self.diagnostics[first_diagnostic:])
+
+        return runs
+
+    def parse_scripts(self, py_script_paths: List[str], processes: Optional[int] = None) -> List[Metadata]:
+        """
+        Parses many scripts, spreading the scripts missing from the metadata
+        index across a pool of worker processes.
+
+        Parameter:
+
+        py_script_paths:
+         paths to the python test scripts
+
+        processes:
+         number of worker processes, defaults to the number of CPUs
+
+        Return:
+
+        List[Metadata]
+         Runs of all scripts, in the order of py_script_paths
+        """
+
+        index_hash = self.env_hash if self.header_only else self.env_hash + ":full"
+        script_runs: Dict[str, List[Metadata]] = {}
+        pending = []
+
+        for py_script_path in py_script_paths:
+            cached = self.index.lookup(py_script_path, index_hash) if self.index else None
+            if cached is None:
+                pending.append(py_script_path)
+            else:
+                script_runs[py_script_path], diagnostics = cached
+                self.__replay__(diagnostics)
+
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or len(pending) < self.PARALLEL_PARSE_THRESHOLD:
+            for py_script_path in pending:
+                script_runs[py_script_path] = self.parse_script(py_script_path)
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_parse_worker,
+                                     initargs=(self.env_yaml_file_path, self.header_only)) as executor:
+                chunksize = max(1, len(pending) // (processes * 4))
+                for py_script_path, (runs, diagnostics) in zip(
+                        pending, executor.map(_parse_in_worker, pending, chunksize=chunksize)):
+                    script_runs[py_script_path] = runs
+                    # Already logged by the worker
+                    self.diagnostics.extend(diagnostics)
+                    if self.index:
+                        self.index.store(py_script_path, index_hash, runs, diagnostics)
+
+        return [run for py_script_path in py_script_paths for run in script_runs[py_script_path]]
+
+    def parse_tree(self, root: str, pattern: str = "TC_*.py", processes: Optional[int] = None) -> List[Metadata]:
+        """
+        Parses every script matching `pattern` below `root`, see parse_scripts.
+        """
+
+        return self.parse_scripts(find_scripts([root], pattern), processes)
+
+    def __parse_script_file__(self, py_script_path: str, header_only: bool) -> List[Metadata]:
+        """
+        Parses the run arguments of a script from its content, see parse_script.
+        """
 
-                elif args_match:
-                    runs_arg_lines[args_match.group(1)][args_match.group(2)] = args_match.group(3)
+        runs_arg_lines = self.read_directives(py_script_path, header_only)
+        runs_metadata: List[Metadata] = []
+        placeholders = {'SCRIPT_BASE_NAME': os.path.splitext(os.path.basename(py_script_path))[0]}
 
         for run, attr in runs_arg_lines.items():
-            self.__resolve_env_vals__(attr)
+            self.__resolve_env_vals__(attr, placeholders)
 
             metadata = Metadata(
                 py_script_path=attr.get("py_script_path", ""),
@@ -141,12 +720,27 @@ class MetadataReader:
                 app=attr.get("app", ""),
                 app_args=attr.get("app_args", ""),
                 script_args=attr.get("script_args", ""),
-                factoryreset=bool(attr.get("factoryreset", False)),
-                factoryreset_app_only=bool(attr.get("factoryreset_app_only", False)),
-                script_gdb=bool(attr.get("script_gdb", False)),
-                quiet=bool(attr.get("quiet", True))
+                factoryreset=parse_bool(attr.get("factoryreset", False)),
+                factoryreset_app_only=parse_bool(attr.get("factoryreset_app_only", False)),
+                script_gdb=parse_bool(attr.get("script_gdb", False)),
+                quiet=parse_bool(attr.get("quiet", True))
             )
             metadata.copy_from_dict(attr)
             runs_metadata.append(metadata)
 
         return runs_metadata
+
+
+# Reader of a parse_scripts worker process, created once per worker
+_worker_reader: Optional[MetadataReader] = None
+
+
+def _init_parse_worker(env_yaml_file_path: str, header_only: bool) -> None:
+    global _worker_reader
+    _worker_reader = MetadataReader(env_yaml_file_path, header_only=header_only)
+
+
+def _parse_in_worker(py_script_path: str) -> Tuple[List[Metadata], List[ParseDiagnostic]]:
+    _worker_reader.diagnostics = []
+    runs = _worker_reader.parse_script(py_script_path)
+    return runs, _worker_reader.diagnostics
@@ -0,0 +1,162 @@
+import contextlib
+import json
+import math
+import os
+import statistics
+import threading
+import time
+import typing
+
+# Type of the records written to a metrics file
+RUN_RECORD = "run"
+SCHEDULED_RUN_RECORD = "scheduled_run"
+SUMMARY_RECORD = "summary"
+
+
+class PhaseTimer:
+    """
+    Records the monotonic duration of the phases of a run.
+
+    Phases are timed with the `phase` context manager, or with `start` and
+    `stop` when a phase does not fit a single block. A phase timed more than
+    once accumulates its durations. Timers may be stopped from another
+    thread, for example from a LogPump watcher.
+    """
+
+    def __init__(self):
+        self.phases: typing.Dict[str, float] = {}
+        self._started: typing.Dict[str, float] = {}
+        self._created = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self, name: str) -> None:
+        with self._lock:
+            self._started[name] = time.monotonic()
+
+    def stop(self, name: str) -> None:
+        with self._lock:
+            self.__stop__(name, time.monotonic())
+
+    def switch(self, from_name: str, to_name: str) -> None:
+        """
+        Ends phase `from_name` and starts `to_name` at the same instant, if
+        `from_name` is running.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.__stop__(from_name, now):
+                self._started[to_name] = now
+
+    def __stop__(self, name: str, now: float) -> bool:
+        started = self._started.pop(name, None)
+        if started is None:
+            return False
+        self.phases[name] = self.phases.get(name, 0.0) + now - started
+        return True
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    @property
+    def total(self) -> float:
+        return time.monotonic() - self._created
+
+
+class MetricsWriter:
+    """
+    Appends records to an NDJSON metrics file. Every record is written with
+    a single append so that concurrent runs can share one file.
+    """
+
+    def __init__(self, metrics_path: str):
+        self.metrics_path = metrics_path
+        self._lock = threading.Lock()
+
+    def write(self, record: typing.Dict[str, typing.Any]) -> None:
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            with open(self.metrics_path, 'a', encoding='utf8') as metrics:
+                metrics.write(line)
+
+
+def read_metrics(metrics_path: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Reads all records of an NDJSON metrics file, skipping truncated lines.
+    """
+    records = []
+    if not os.path.exists(metrics_path):
+        return records
+
+    with open(metrics_path, 'r', encoding='utf8') as metrics:
+        for line in metrics:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def percentile(values: typing.List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    ordered = sorted(values)
+    rank = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize(records: typing.Iterable[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """
+    Aggregates the phase durations of run records.
+
+    Return:
+
+    Dict
+     For every phase the number of runs timing it and the total, mean,
+     median, p95 and maximum duration in seconds.
+    """
+    durations: typing.Dict[str, typing.List[float]] = {}
+    counts = {RUN_RECORD: 0, SCHEDULED_RUN_RECORD: 0}
+    failures = {RUN_RECORD: 0, SCHEDULED_RUN_RECORD: 0}
+
+    for record in records:
+        if record.get("type") not in counts:
+            continue
+
+        counts[record["type"]] += 1
+        failures[record["type"]] += 1 if record.get("exit_code") else 0
+
+        for name, duration in record.get("phases", {}).items():
+            durations.setdefault(name, []).append(duration)
+
+    phases = {}
+    for name, values in durations.items():
+        phases[name] = {
+            "count": len(values),
+            "total": sum(values),
+            "mean": statistics.mean(values),
+            "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95),
+            "max": max(values),
+        }
+
+    # Scheduled run records cover runs whose own records may be missing, e.g. when they crashed
+    kind = SCHEDULED_RUN_RECORD if counts[SCHEDULED_RUN_RECORD] else RUN_RECORD
+    return {"type": SUMMARY_RECORD, "runs": counts[kind], "failed": failures[kind], "phases": phases}
+
+
+def format_summary(summary: typing.Dict[str, typing.Any]) -> str:
+    """
+    Formats a summary as a table, slowest phases first.
+    """
+    lines = [f"Phase timings over {summary['runs']} runs ({summary['failed']} failed):",
+             f"  {'phase':<24}{'count':>7}{'total':>10}{'mean':>9}{'p95':>9}{'max':>9}"]
+    for name, stats in sorted(summary["phases"].items(), key=lambda item: -item[1]["total"]):
+        lines.append(f"  {name:<24}{stats['count']:>7}{stats['total']:>10.2f}{stats['mean']:>9.2f}"
+                     f"{stats['p95']:>9.2f}{stats['max']:>9.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,173 @@
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from metadata import Metadata, hash_file
+
+DEFAULT_MAX_SIZE_MB = 16
+
+# Run fields that do not change what a run tests: the script is hashed
+# separately and the sandbox is assigned per execution
+UNCACHED_FIELDS = ("py_script_path", "sandbox_dir", "netns")
+
+
+class ResultCache:
+    """
+    Local cache of passing runs, keyed by the content of everything a run
+    depends on: the test script, the resolved app binary, the run arguments
+    and the environment file they were resolved against.
+
+    Every entry is a small JSON file named after its key. A hit refreshes the
+    entry's mtime and the least recently used entries are evicted once the
+    cache grows over its size limit.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, cache_dir: str, max_size_mb: int = DEFAULT_MAX_SIZE_MB):
+        """
+        Parameters:
+
+        cache_dir:
+         Directory holding the cache entries, created if missing
+
+        max_size_mb:
+         Total size of the entries above which the oldest ones are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        # Binaries are large, hash each one once per (mtime, size)
+        self._file_hashes: Dict[str, Tuple[int, int, str]] = {}
+        # Total size of the entries, computed by the first eviction check
+        self._size: Optional[int] = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __hash_file__(self, path: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            cached = self._file_hashes.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        digest = hash_file(path)
+        with self._lock:
+            self._file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def key(self, run: Metadata, env_hash: str) -> Optional[str]:
+        """
+        Computes the cache key of a run.
+
+        Return:
+
+        str
+         Hex digest identifying the run inputs, None when an input cannot
+         be hashed, e.g. because the app binary was not built.
+        """
+        script_hash = self.__hash_file__(run.py_script_path)
+        if script_hash is None:
+            return None
+
+        app_hash = ""
+        if run.app:
+            app_hash = self.__hash_file__(run.app)
+            if app_hash is None:
+                return None
+
+        fields = {name: value for name, value in dataclasses.asdict(run).items() if name not in UNCACHED_FIELDS}
+        content = json.dumps({
+            "format": self.FORMAT,
+            "script": script_hash,
+            "app": app_hash,
+            "env": env_hash,
+            "run": fields,
+        }, sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def __entry_path__(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the entry of a run that passed with these inputs, None if
+        there is none.
+        """
+        entry_path = self.__entry_path__(key)
+        try:
+            with open(entry_path, 'r', encoding='utf8') as stream:
+                entry = json.load(stream)
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def store(self, key: str, run: Metadata, duration_sec: float) -> None:
+        """
+        Records that a run passed, evicting old entries if the cache is full.
+        """
+        entry_path = self.__entry_path__(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        try:
+            replaced_size = os.path.getsize(entry_path)
+        except OSError:
+            replaced_size = 0
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf8') as stream:
+            json.dump({
+                "script": run.py_script_path,
+                "run": run.run,
+                "duration_sec": duration_sec,
+                "timestamp": time.time(),
+            }, stream)
+        os.replace(temp_path, entry_path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(entry_path) - replaced_size
+            over_limit = self._size is None or self._size > self.max_size
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits its size limit.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for directory, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if not name.endswith(".json"):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, path, stat.st_size))
+                    total += stat.st_size
+
+            self._size = total
+            if total <= self.max_size:
+                return
+
+            for _, path, size in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_size:
+                    break
+            self._size = total
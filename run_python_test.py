@@ -1,56 +1,37 @@
-import datetime
-import io
+import asyncio
+import dataclasses
 import logging
 import os
 import os.path
-import queue
 import re
 import shlex
 import signal
 import subprocess
 import sys
-import threading
 import time
 import typing
 
 import click
 import coloredlogs
+from app_pool import APP_STOP_TIMEOUT_SEC, AppPool
+from app_readiness import AppReadinessError, ReadinessWatcher, wait_until_ready
 from colorama import Fore, Style
-from metadata import MetadataReader, Metadata
+from commission_snapshot import (DEFAULT_SNAPSHOT_DIR, CommissionSnapshot, snapshot_key, state_files,
+                                 strip_commissioning_args)
+from log_archive import LogArchiveWriter
+from log_capture import DEFAULT_MEMORY_LIMIT_MB, BoundedCapture
+from log_pump import LogPump
+from metadata import MetadataReader, Metadata, fill_placeholders
+from phase_timer import RUN_RECORD, MetricsWriter, PhaseTimer
+from sandbox import sandbox_command, sandbox_env
+from script_forkserver import ForkServerClient, ForkServerError
 
 DEFAULT_CHIP_ROOT = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', '..'))
 
 MATTER_DEVELOPMENT_PAA_ROOT_CERTS = "credentials/development/paa-root-certs"
 
-
-def EnqueueLogOutput(fp, tag, output_stream, q):
-    for line in iter(fp.readline, b''):
-        timestamp = time.time()
-        if len(line) > len('[1646290606.901990]') and line[0:1] == b'[':
-            try:
-                timestamp = float(line[1:18].decode())
-                line = line[19:]
-            except Exception:
-                pass
-        output_stream.write(
-            (f"[{datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')}]").encode() + tag + line)
-        sys.stdout.flush()
-    fp.close()
-
-
-def RedirectQueueThread(fp, tag, stream_output, queue) -> threading.Thread:
-    log_queue_thread = threading.Thread(target=EnqueueLogOutput, args=(
-        fp, tag, stream_output, queue))
-    log_queue_thread.start()
-    return log_queue_thread
-
-
-def DumpProgramOutputToQueue(thread_list: typing.List[threading.Thread], tag: str, process: subprocess.Popen, stream_output, queue: queue.Queue):
-    thread_list.append(RedirectQueueThread(process.stdout,
-                                           (f"[{tag}][{Fore.YELLOW}STDOUT{Style.RESET_ALL}]").encode(), stream_output, queue))
-    thread_list.append(RedirectQueueThread(process.stderr,
-                                           (f"[{tag}][{Fore.RED}STDERR{Style.RESET_ALL}]").encode(), stream_output, queue))
+DEFAULT_APP_READY_TIMEOUT_SEC = 30.0
 
 
 @click.command()
@@ -74,8 +55,42 @@ def DumpProgramOutputToQueue(thread_list: typing.List[threading.Thread], tag: st
 @click.option("--script-gdb", is_flag=True,
               help='Run script through gdb')
 @click.option("--quiet", is_flag=True, help="Do not print output from passing tests. Use this flag in CI to keep github log sizes manageable.")
+@click.option("--quiet-buffer-mb", type=int, default=DEFAULT_MEMORY_LIMIT_MB,
+              help='Memory ceiling of the --quiet output capture in MB, older output is spilled to a temporary file.')
+@click.option("--app-ready-pattern", type=str, default=None,
+              help='Regular expression matched against the app output. The script only starts once the app printed a matching line.')
+@click.option("--app-ready-port", type=int, default=None,
+              help='UDP or TCP port the app must have bound before the script starts.')
+@click.option("--app-ready-timeout", type=float, default=DEFAULT_APP_READY_TIMEOUT_SEC,
+              help='Seconds to wait for the app to become ready before failing the run.')
+@click.option("--reuse-app", is_flag=True,
+              help='Keep the app running across runs with the same app and app-args instead of restarting it for every run. '
+              'Sandboxed runs never share an app, their app-args point at their own sandbox.')
+@click.option("--app-max-runs", type=int, default=0,
+              help='With --reuse-app, restart an app after it served this many runs. 0 means never.')
+@click.option("--metrics-file", type=str, default=None,
+              help='Append the duration of every phase of every run to this NDJSON file.')
+@click.option("--metrics-batch", type=str, default=None,
+              help='Identifier of the batch this run belongs to, recorded with its metrics.')
+@click.option("--log-archive-dir", type=click.Path(file_okay=False), default=None,
+              help='Archive the output of every run in this directory, see log_archive.py to query it.')
+@click.option("--commissioned-snapshot", is_flag=True,
+              help='With --factoryreset, start from a snapshot of the state right after commissioning instead of commissioning again. '
+                   'The snapshot is captured by commissioning once with --commission-only. Requires --sandbox-dir.')
+@click.option("--snapshot-dir", type=str, default=DEFAULT_SNAPSHOT_DIR,
+              help='Directory holding the commissioned state snapshots.')
+@click.option("--forkserver-socket", type=str, default=None,
+              help='Launch the test script through the forkserver listening on this socket, see script_forkserver.py. '
+                   'Scripts are spawned as usual when no forkserver listens there, with --script-gdb or with --netns.')
 @click.option("--load-from-env", default=None, help="YAML file that contains values for environment variables.")
-def main(app: str, factoryreset: bool, factoryreset_app_only: bool, app_args: str, script: str, script_args: str, script_gdb: bool, quiet: bool, load_from_env):
+@click.option("--sandbox-dir", type=click.Path(exists=True, file_okay=False), default=None,
+              help='Private directory of this run. Factory reset only touches this directory and child processes use its tmp/ as TMPDIR.')
+@click.option("--netns", type=str, default=None,
+              help='Linux network namespace to run the app and script in. Requires --sandbox-dir, its tmp/ is mounted over /tmp.')
+def main(app: str, factoryreset: bool, factoryreset_app_only: bool, app_args: str, script: str, script_args: str, script_gdb: bool, quiet: bool, quiet_buffer_mb: int,
+         app_ready_pattern: str, app_ready_port: int, app_ready_timeout: float, reuse_app: bool, app_max_runs: int, metrics_file: str, metrics_batch: str,
+         log_archive_dir: str, commissioned_snapshot: bool, snapshot_dir: str, forkserver_socket: str, load_from_env,
+         sandbox_dir: str, netns: str):
     if load_from_env:
         reader = MetadataReader(load_from_env)
         runs = reader.parse_script(script)
@@ -90,28 +105,153 @@ def main(app: str, factoryreset: bool, factoryreset_app_only: bool, app_args: st
                 factoryreset=factoryreset,
                 factoryreset_app_only=factoryreset_app_only,
                 script_gdb=script_gdb,
-                quiet=quiet
+                quiet=quiet,
+                sandbox_dir=sandbox_dir or "",
+                netns=netns or "",
+                quiet_buffer_mb=quiet_buffer_mb,
+                app_ready_pattern=app_ready_pattern or "",
+                app_ready_port=app_ready_port or 0,
+                app_ready_timeout=app_ready_timeout,
+                commissioned_snapshot=commissioned_snapshot
                 )
             ]
 
-    for run in runs:
-        print(f"Executing run: {run.py_script_path}")
-        main_impl(run.app, run.factoryreset, run.factoryreset_app_only, run.app_args, run.py_script_path, run.script_args, run.script_gdb, run.quiet)
-                           
-            
-def main_impl(app: str, factoryreset: bool, factoryreset_app_only: bool, app_args: str, script: str, script_args: str, script_gdb: bool, quiet: bool):
-
-    app_args = app_args.replace('{SCRIPT_BASE_NAME}', os.path.splitext(os.path.basename(script))[0])
-    script_args = script_args.replace('{SCRIPT_BASE_NAME}', os.path.splitext(os.path.basename(script))[0])
+    # Options given on the command line apply to the runs that do not set them
+    runs = [dataclasses.replace(run,
+                                sandbox_dir=run.sandbox_dir or sandbox_dir or "",
+                                netns=run.netns or netns or "",
+                                quiet_buffer_mb=run.quiet_buffer_mb or quiet_buffer_mb,
+                                app_ready_pattern=run.app_ready_pattern or app_ready_pattern or "",
+                                app_ready_port=run.app_ready_port or app_ready_port or 0,
+                                app_ready_timeout=run.app_ready_timeout or app_ready_timeout,
+                                commissioned_snapshot=run.commissioned_snapshot or commissioned_snapshot)
+            for run in runs]
+
+    app_pool = AppPool(app_max_runs) if reuse_app else None
+
+    try:
+        for run in runs:
+            print(f"Executing run: {run.py_script_path}")
+            exit_code = run_metadata(run, app_pool=app_pool, metrics_file=metrics_file, log_archive_dir=log_archive_dir,
+                                     snapshot_dir=snapshot_dir, forkserver_socket=forkserver_socket,
+                                     metrics_batch=metrics_batch)
+            if exit_code != 0:
+                sys.exit(exit_code)
+    finally:
+        if app_pool:
+            app_exit_code = app_pool.shutdown()
+            if app_exit_code != 0:
+                logging.error("App exited with error %r" % app_exit_code)
+                sys.exit(app_exit_code)
+
+
+def run_metadata(run: Metadata, app_pool: typing.Optional[AppPool] = None, metrics_file: typing.Optional[str] = None,
+                 log_archive_dir: typing.Optional[str] = None, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                 forkserver_socket: typing.Optional[str] = None, metrics_batch: typing.Optional[str] = None) -> int:
+    """
+    Executes a run described by its metadata, without going through the
+    command line. Unset metadata fields use the main_impl() defaults.
+
+    Return:
+
+    int
+     Exit code of the run, 0 when both the app and the script exited cleanly
+    """
+    return main_impl(run.app, run.factoryreset, run.factoryreset_app_only, run.app_args, run.py_script_path, run.script_args,
+                     run.script_gdb, run.quiet,
+                     sandbox_dir=run.sandbox_dir or None, netns=run.netns or None,
+                     quiet_buffer_mb=run.quiet_buffer_mb or DEFAULT_MEMORY_LIMIT_MB,
+                     app_ready_pattern=run.app_ready_pattern or None,
+                     app_ready_port=run.app_ready_port or None,
+                     app_ready_timeout=run.app_ready_timeout or DEFAULT_APP_READY_TIMEOUT_SEC,
+                     app_pool=app_pool, metrics_file=metrics_file, run_name=run.run, log_archive_dir=log_archive_dir,
+                     commissioned_snapshot=run.commissioned_snapshot, snapshot_dir=snapshot_dir,
+                     forkserver_socket=forkserver_socket, metrics_batch=metrics_batch)
+
+
+def stop_process(process, name: str) -> None:
+    """
+    Stops a process left running by a failed run with SIGINT, or SIGKILL
+    when it does not exit in time.
+    """
+    if process.poll() is not None:
+        return
+    logging.warning("Stopping %s with SIGINT" % name)
+    process.send_signal(signal.SIGINT.value)
+    try:
+        process.wait(APP_STOP_TIMEOUT_SEC)
+    except subprocess.TimeoutExpired:
+        logging.error("The %s did not stop, killing it" % name)
+        process.kill()
+        process.wait()
+
+
+def main_impl(app: str, factoryreset: bool, factoryreset_app_only: bool, app_args: str, script: str, script_args: str, script_gdb: bool, quiet: bool,
+              sandbox_dir: typing.Optional[str] = None, netns: typing.Optional[str] = None,
+              quiet_buffer_mb: int = DEFAULT_MEMORY_LIMIT_MB, app_ready_pattern: typing.Optional[str] = None,
+              app_ready_port: typing.Optional[int] = None, app_ready_timeout: float = DEFAULT_APP_READY_TIMEOUT_SEC,
+              app_pool: typing.Optional[AppPool] = None, metrics_file: typing.Optional[str] = None, run_name: str = "",
+              log_archive_dir: typing.Optional[str] = None, commissioned_snapshot: bool = False,
+              snapshot_dir: str = DEFAULT_SNAPSHOT_DIR, forkserver_socket: typing.Optional[str] = None,
+              metrics_batch: typing.Optional[str] = None) -> int:
+    """
+    Runs a test script against an app and returns the exit code of the run:
+    the script's if it failed, otherwise the app's.
+    """
+
+    timer = PhaseTimer()
+
+    placeholders = {'SCRIPT_BASE_NAME': os.path.splitext(os.path.basename(script))[0]}
+    app_args = fill_placeholders(app_args, placeholders)
+    script_args = fill_placeholders(script_args, placeholders)
+
+    tmp_dir = os.path.join(sandbox_dir, "tmp") if sandbox_dir else "/tmp"
+    child_env = sandbox_env(sandbox_dir) if sandbox_dir else None
+    app_command = sandbox_command([app] + shlex.split(app_args), sandbox_dir, netns) if app else None
+
+    snapshot = None
+    if commissioned_snapshot and factoryreset and app and not sandbox_dir:
+        # The chip files of the app would have to be picked out of the shared /tmp
+        logging.warning("Commissioned snapshots need a sandbox directory, commissioning as usual")
+    elif commissioned_snapshot and factoryreset and app:
+        snapshot = CommissionSnapshot(snapshot_dir, snapshot_key(app, app_args, script_args, sandbox_dir))
+        if not snapshot.exists:
+            logging.info("No commissioned snapshot for this setup yet, commissioning once to capture %s" % snapshot.path)
+            with timer.phase("snapshot_capture"):
+                # The app must be stopped so that its state is complete on disk when captured
+                if app_pool and app_command:
+                    app_pool.recycle(app_command)
+                commission_exit_code = main_impl(app, True, False, app_args, script, script_args + " --commission-only", False, quiet,
+                                                 sandbox_dir=sandbox_dir, netns=netns, quiet_buffer_mb=quiet_buffer_mb,
+                                                 app_ready_pattern=app_ready_pattern, app_ready_port=app_ready_port,
+                                                 app_ready_timeout=app_ready_timeout, run_name=f"{run_name or 'run'}-commission",
+                                                 log_archive_dir=log_archive_dir, forkserver_socket=forkserver_socket)
+                if commission_exit_code != 0:
+                    logging.error("Commissioning for the snapshot failed with %r" % commission_exit_code)
+                    return commission_exit_code
+                snapshot.capture(state_files(app_args, script_args, tmp_dir))
 
     if factoryreset or factoryreset_app_only:
-        # Remove native app config
-        retcode = subprocess.call("rm -rf /tmp/chip* /tmp/repl*", shell=True)
-        if retcode != 0:
-            raise Exception("Failed to remove /tmp/chip* for factory reset.")
+        timer.start("factory_reset")
+        # A pooled app must not keep running on the state we are about to remove
+        if app_pool and app_command:
+            recycled_exit_code = app_pool.recycle(app_command)
+            if recycled_exit_code != 0:
+                logging.error("Pooled app exited with error %r when stopped for factory reset" % recycled_exit_code)
+
+        # Remove native app config. Without a network namespace nothing is mounted over /tmp,
+        # so the apps' hard-coded /tmp/chip_* files must be removed along with the sandbox's.
+        # TestRunner executes such sandboxed runs alone, see ResourceLimits.exclusive_factory_resets.
+        reset_dirs = [tmp_dir] if netns or tmp_dir == "/tmp" else [tmp_dir, "/tmp"]
+        for reset_dir in reset_dirs:
+            retcode = subprocess.call("rm -rf %s/chip* %s/repl*" % (shlex.quote(reset_dir), shlex.quote(reset_dir)), shell=True)
+            if retcode != 0:
+                raise Exception("Failed to remove %s/chip* for factory reset." % reset_dir)
 
+        timer.switch("factory_reset", "directory_listing")
         print("Contents of test directory: %s" % os.getcwd())
         print(subprocess.check_output(["ls -l"], shell=True).decode('utf-8'))
+        timer.switch("directory_listing", "factory_reset")
 
         # Remove native app KVS if that was used
         kvs_match = re.search(r"--KVS (?P<kvs_path>[^ ]+)", app_args)
@@ -131,80 +271,182 @@ def main_impl(app: str, factoryreset: bool, factoryreset_app_only: bool, app_arg
             print("Trying to remove storage path %s" % storage_path_to_remove)
             if retcode != 0:
                 raise Exception("Failed to remove %s for factory reset." % storage_path_to_remove)
+    timer.stop("factory_reset")
+
+    if snapshot and snapshot.exists:
+        with timer.phase("snapshot_restore"):
+            restored = snapshot.restore(state_files(app_args, script_args, tmp_dir), tmp_dir)
+        logging.info("Restored commissioned snapshot %s into %s" % (snapshot.path, ", ".join(restored)))
+        script_args = strip_commissioning_args(script_args)
 
     coloredlogs.install(level='INFO')
 
-    log_queue = queue.Queue()
-    log_cooking_threads = []
+    log_pump = LogPump()
+    log_streams = []
 
     app_process = None
+    pooled_app = None
     app_pid = 0
+    app_ready_watcher = ReadinessWatcher(app_ready_pattern) if app_ready_pattern else None
 
     stream_output = sys.stdout.buffer
     if quiet:
-        stream_output = io.BytesIO()
+        stream_output = BoundedCapture(quiet_buffer_mb * 1024 * 1024)
+
+    log_archive = None
+    if log_archive_dir:
+        os.makedirs(log_archive_dir, exist_ok=True)
+        log_archive = LogArchiveWriter.create_unique(log_archive_dir, "%s-%s" % (placeholders['SCRIPT_BASE_NAME'],
+                                                                              run_name or "run"))
 
     if app:
         if not os.path.exists(app):
             if app is None:
                 raise FileNotFoundError(f"{app} not found")
-        app_args = [app] + shlex.split(app_args)
-        logging.info(f"Execute: {app_args}")
-        app_process = subprocess.Popen(
-            app_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+        logging.info(f"Execute: {app_command}")
+        timer.start("app_spawn")
+        if app_pool:
+            pooled_app = app_pool.acquire(app_command, child_env, stream_output, app_ready_watcher, log_archive)
+            app_process = pooled_app.process
+        else:
+            app_process = subprocess.Popen(
+                app_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, env=child_env)
+            log_streams.extend(log_pump.add_process(Fore.GREEN + "APP " + Style.RESET_ALL, app_process, stream_output,
+                                                    app_ready_watcher, log_archive, "APP"))
         app_pid = app_process.pid
-        DumpProgramOutputToQueue(
-            log_cooking_threads, Fore.GREEN + "APP " + Style.RESET_ALL, app_process, stream_output, log_queue)
-
-    script_command = [script, "--paa-trust-store-path", os.path.join(DEFAULT_CHIP_ROOT, MATTER_DEVELOPMENT_PAA_ROOT_CERTS),
-                      '--log-format', '%(message)s', "--app-pid", str(app_pid)] + shlex.split(script_args)
-
-    if script_gdb:
-        #
-        # When running through Popen, we need to preserve some space-delimited args to GDB as a single logical argument.
-        # To do that, let's use '|' as a placeholder for the space character so that the initial split will not tokenize them,
-        # and then replace that with the space char there-after.
-        #
-        script_command = ("gdb -batch -return-child-result -q -ex run -ex "
-                          "thread|apply|all|bt --args python3".split() + script_command)
-    else:
-        script_command = "/usr/bin/env python3".split() + script_command
-
-    final_script_command = [i.replace('|', ' ') for i in script_command]
-
-    logging.info(f"Execute: {final_script_command}")
-    test_script_process = subprocess.Popen(
-        final_script_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    DumpProgramOutputToQueue(log_cooking_threads, Fore.GREEN + "TEST" + Style.RESET_ALL,
-                             test_script_process, stream_output, log_queue)
-
-    test_script_exit_code = test_script_process.wait()
-
-    if test_script_exit_code != 0:
-        logging.error("Test script exited with error %r" % test_script_exit_code)
-
-    test_app_exit_code = 0
-    if app_process:
-        logging.warning("Stopping app with SIGINT")
-        app_process.send_signal(signal.SIGINT.value)
-        test_app_exit_code = app_process.wait()
+        timer.stop("app_spawn")
+
+    test_script_process = None
+    run_completed = False
+    try:
+        app_ready = True
+        # A reused app is known to be ready already
+        app_reused = pooled_app is not None and pooled_app.runs_served > 0
+        if app_process and (app_ready_pattern or app_ready_port) and not app_reused:
+            try:
+                with timer.phase("app_ready"):
+                    ready_sec = asyncio.run(wait_until_ready(app_process, app_ready_timeout, app_ready_watcher, app_ready_port))
+                logging.info("App ready after %.2fs" % ready_sec)
+            except AppReadinessError as e:
+                logging.error(str(e))
+                app_ready = False
+
+        if app_ready:
+            script_argv = [script, "--paa-trust-store-path", os.path.join(DEFAULT_CHIP_ROOT, MATTER_DEVELOPMENT_PAA_ROOT_CERTS),
+                           '--log-format', '%(message)s', "--app-pid", str(app_pid)] + shlex.split(script_args)
+            script_command = script_argv
+
+            # The forkserver runs outside of any network namespace and cannot run the script under gdb
+            forkserver = None
+            if forkserver_socket and not script_gdb and not netns:
+                forkserver = ForkServerClient(forkserver_socket)
+                if not forkserver.available:
+                    logging.warning("No forkserver listening on %s, spawning the script" % forkserver_socket)
+                    forkserver = None
+
+            if script_gdb:
+                #
+                # When running through Popen, we need to preserve some space-delimited args to GDB as a single logical argument.
+                # To do that, let's use '|' as a placeholder for the space character so that the initial split will not tokenize them,
+                # and then replace that with the space char there-after.
+                #
+                script_command = ("gdb -batch -return-child-result -q -ex run -ex "
+                                  "thread|apply|all|bt --args python3".split() + script_command)
+            else:
+                script_command = "/usr/bin/env python3".split() + script_command
+
+            final_script_command = sandbox_command([i.replace('|', ' ') for i in script_command], sandbox_dir, netns)
+
+            # Script startup lasts until the interpreter printed its first line, the body until it exits
+            timer.start("script_startup")
+            if forkserver:
+                logging.info(f"Execute through forkserver: {script_argv}")
+                try:
+                    test_script_process = forkserver.launch(script_argv, child_env)
+                except (OSError, ForkServerError) as e:
+                    logging.warning("Forkserver launch failed, spawning the script: %s" % e)
+            if test_script_process is None:
+                logging.info(f"Execute: {final_script_command}")
+                test_script_process = subprocess.Popen(
+                    final_script_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=child_env)
+            log_streams.extend(log_pump.add_process(Fore.GREEN + "TEST" + Style.RESET_ALL, test_script_process, stream_output,
+                                                    lambda lines: timer.switch("script_startup", "script_body"),
+                                                    log_archive, "TEST"))
+
+            test_script_exit_code = test_script_process.wait()
+            timer.stop("script_startup")
+            timer.stop("script_body")
+
+            if test_script_exit_code != 0:
+                logging.error("Test script exited with error %r" % test_script_exit_code)
+        else:
+            test_script_exit_code = 1
+
+        test_app_exit_code = 0
+        timer.start("app_shutdown")
+        if pooled_app:
+            # An app that did not become ready must not be handed to the next run
+            test_app_exit_code = app_pool.release(pooled_app, recycle=not app_ready)
+            pooled_app = None
+        elif app_process:
+            logging.warning("Stopping app with SIGINT")
+            app_process.send_signal(signal.SIGINT.value)
+            test_app_exit_code = app_process.wait()
+        timer.stop("app_shutdown")
+        run_completed = True
+    finally:
+        if not run_completed:
+            # Whatever went wrong, the app must go back to the pool: a key left in use
+            # makes every later run of the same app command wait for it forever
+            if pooled_app:
+                app_pool.release(pooled_app, recycle=True)
+            elif app_process:
+                stop_process(app_process, "app")
+            # In process, anything left running here would pile up in the runner across runs
+            if test_script_process:
+                stop_process(test_script_process, "test script")
+            log_pump.close()
+            if log_archive:
+                log_archive.close()
 
     # There are some logs not cooked, so we wait until we have processed all logs.
     # This procedure should be very fast since the related processes are finished.
-    for thread in log_cooking_threads:
-        thread.join()
+    with timer.phase("log_drain"):
+        for stream in log_streams:
+            stream.done.wait()
+        log_pump.close()
+        if log_archive:
+            log_archive.close()
 
     # We expect both app and test script should exit with 0
     exit_code = test_script_exit_code if test_script_exit_code != 0 else test_app_exit_code
 
     if quiet:
         if exit_code:
-            sys.stdout.write(stream_output.getvalue().decode('utf-8'))
+            sys.stdout.flush()
+            stream_output.replay(sys.stdout.buffer)
         else:
             logging.info("Test completed successfully")
+        stream_output.close()
+
+    if log_archive and exit_code:
+        logging.info("Run output archived in %s, show the first error with: log_archive.py %s --around-error 50" %
+                     (log_archive.archive_path, shlex.quote(log_archive.archive_path)))
+
+    if metrics_file:
+        timer.phases["total"] = timer.total
+        MetricsWriter(metrics_file).write({
+            "type": RUN_RECORD,
+            "batch": metrics_batch,
+            "script": script,
+            "run": run_name,
+            "exit_code": exit_code,
+            "timestamp": time.time(),
+            "phases": timer.phases,
+        })
+
+    return exit_code
 
-    if exit_code != 0:
-        sys.exit(exit_code)
 
 if __name__ == '__main__':
     main(auto_envvar_prefix='CHIP')
@@ -1,20 +1,179 @@
 import argparse
-from metadata import Metadata, MetadataReader
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+from env_impact import env_file_at_revision, select_affected_runs
+from metadata import Metadata, MetadataReader, read_manifest, write_manifest
+from result_cache import DEFAULT_MAX_SIZE_MB, ResultCache
+from sandbox import SandboxManager
+from scheduler import DurationHistory, ResourceLimits, shard_runs
+from script_forkserver import ForkServerError, ForkServerProcess, forkserver_command
 from test_runner import TestRunner
+from trace_metrics import DEFAULT_TOLERANCE, check_traces, parse_tolerances, run_trace_files
 
 
 def run_test():
     parser = argparse.ArgumentParser(description='Run python tests.')
     parser.add_argument('-e','--env')
-    parser.add_argument('-s','--script')
+    parser.add_argument('-s','--script', nargs='+',
+                        help='Test scripts or directories of TC_*.py scripts to run')
     parser.add_argument('-d','--dry-run', action="store_true")
-    
+    parser.add_argument('-j','--jobs', type=int, default=None,
+                        help='Maximum number of runs executing at once. Defaults to the number of CPUs with '
+                             '--sandbox or --sandbox-netns, 1 otherwise since unsandboxed runs share their state and port')
+    parser.add_argument('--max-memory-mb', type=int, default=0,
+                        help='Memory budget for all concurrent runs, 0 for unlimited')
+    parser.add_argument('--memory-per-run-mb', type=int, default=512,
+                        help='Estimated memory used by a single run')
+    parser.add_argument('--max-apps', type=int, default=0,
+                        help='Maximum number of concurrently running DUT apps, 0 for unlimited')
+    parser.add_argument('--sandbox', action="store_true",
+                        help='Give every run a private directory, discriminator and port. Without '
+                             '--sandbox-netns the apps still share their hard-coded /tmp/chip_* files, so runs '
+                             'doing a factory reset execute alone')
+    parser.add_argument('--sandbox-netns', action="store_true",
+                        help='Also give every run its own network namespace (requires root)')
+    parser.add_argument('--sandbox-base-dir', default=None,
+                        help='Directory under which run sandboxes are created')
+    parser.add_argument('--metadata-index', default=None,
+                        help='On-disk cache of parsed script metadata, reused across invocations')
+    parser.add_argument('--metrics-file', default=None,
+                        help='NDJSON file receiving per-phase timings of every run and a summary of the batch')
+    parser.add_argument('--log-archive-dir', default=None,
+                        help='Directory receiving an indexed archive of the output of every run')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Index of the shard of runs to execute, from 0 to --shard-count - 1')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='Number of shards the runs are split into, e.g. one per CI node')
+    parser.add_argument('--duration-history', default=None,
+                        help='JSON file of past run durations used to balance shards, updated by every execution. '
+                             'All shards must use the same history.')
+    parser.add_argument('--result-cache', default=None,
+                        help='Directory caching passing runs, runs whose script, app binary, arguments and '
+                             'environment are unchanged are reported as cached passes without executing them')
+    parser.add_argument('--result-cache-max-mb', type=int, default=DEFAULT_MAX_SIZE_MB,
+                        help='Size of the result cache above which the least recently used entries are evicted')
+    parser.add_argument('--force', action="store_true",
+                        help='Execute every run even if the result cache holds a pass for it')
+    env_change = parser.add_mutually_exclusive_group()
+    env_change.add_argument('--env-changed-from', default=None, metavar='OLD_ENV',
+                            help='Only execute the runs whose resolved arguments differ between this env file and --env')
+    env_change.add_argument('--env-changed-since', default=None, metavar='REVISION',
+                            help='Only execute the runs whose resolved arguments differ between --env at this git '
+                                 'revision and --env in the working tree')
+    parser.add_argument('--snapshot-dir', default=None,
+                        help='Directory holding the commissioned state snapshots of runs using commissioned-snapshot, '
+                             'which only applies to sandboxed runs')
+    parser.add_argument('--forkserver', action="store_true",
+                        help='Launch test scripts from a forkserver that imported the chip, mobly and '
+                             'matter_testing_support modules once, instead of a fresh interpreter per run')
+    parser.add_argument('--in-process', action="store_true",
+                        help='Execute runs from this process instead of starting run_python_test.py through the shell '
+                             'for every run. Must itself run in the python environment of the tests. Concurrent '
+                             'runs (--jobs above 1) share the stdout and the coloredlogs setup of this process, so '
+                             'their output interleaves line by line without any per-run grouping.')
+    parser.add_argument('--reuse-apps', action="store_true",
+                        help='With --in-process, keep apps running across runs using the same app command. '
+                             'Sandboxed runs never share apps, since every sandbox rewrites the app arguments')
+    parser.add_argument('--app-max-runs', type=int, default=0,
+                        help='Number of runs a reused app serves before it is restarted, 0 for unlimited')
+    parser.add_argument('--trace-baseline', default=None,
+                        help='After the runs, compare the metrics of their json: traces against this baseline, '
+                             'see trace_metrics.py. Runs skipped by the result cache are not measured. '
+                             'Regressions fail the batch.')
+    parser.add_argument('--update-trace-baseline', action="store_true",
+                        help='Store the metrics of the traces of the runs in --trace-baseline instead of comparing them')
+    parser.add_argument('--trace-tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative increase over the trace baseline tolerated by default')
+    parser.add_argument('--trace-metric-tolerance', action='append', default=[], metavar='PATTERN=FRACTION',
+                        help='Relative tolerance of the trace metrics matching an fnmatch pattern, e.g. "commissioning.*=0.5"')
+    parser.add_argument('--trace-warn-only', action="store_true",
+                        help='Report trace metric regressions without failing the batch')
+    parser.add_argument('--manifest', default=None,
+                        help='Write every run of the given scripts to this NDJSON manifest and exit')
+    parser.add_argument('--from-manifest', default=None,
+                        help='Execute the runs of an NDJSON manifest instead of parsing scripts')
+
     args = parser.parse_args()
 
-    runner = TestRunner(args.env)
+    if not args.script and not args.from_manifest:
+        parser.error("one of -s/--script or --from-manifest is required")
+
+    sandbox_manager = None
+    if args.sandbox or args.sandbox_netns:
+        sandbox_manager = SandboxManager(base_dir=args.sandbox_base_dir, use_netns=args.sandbox_netns)
+
+    duration_history = DurationHistory(args.duration_history) if args.duration_history else None
+
+    result_cache = ResultCache(args.result_cache, args.result_cache_max_mb) if args.result_cache else None
+
+    forkserver_socket = None
+    if args.forkserver and not args.dry_run:
+        forkserver_socket = os.path.join(tempfile.mkdtemp(prefix="chip-forkserver-"), "forkserver.sock")
+
+    runner = TestRunner(args.env, sandbox_manager, args.metadata_index, args.metrics_file,
+                        args.log_archive_dir, duration_history, result_cache, args.force, args.snapshot_dir,
+                        forkserver_socket, in_process=args.in_process, reuse_apps=args.reuse_apps,
+                        app_max_runs=args.app_max_runs)
+
+    limits = ResourceLimits(
+        max_parallel_runs=args.jobs or (os.cpu_count() or 1 if sandbox_manager else 1),
+        max_memory_mb=args.max_memory_mb,
+        memory_per_run_mb=args.memory_per_run_mb,
+        max_apps=args.max_apps
+    )
+
+    if args.from_manifest:
+        runs = read_manifest(args.from_manifest)
+    elif args.env_changed_from or args.env_changed_since:
+        old_env = args.env_changed_from
+        if args.env_changed_since:
+            old_env = env_file_at_revision(args.env, args.env_changed_since)
+        try:
+            runs, changed = select_affected_runs(args.script, MetadataReader(old_env), runner.metadata_reader)
+        finally:
+            if args.env_changed_since:
+                os.remove(old_env)
+        print(f"{len(runs)} runs affected by changes to {', '.join(sorted(changed)) or 'no variables'}")
+    else:
+        runs = runner.expand_runs(args.script)
+
+    if args.shard_count > 1:
+        total = len(runs)
+        runs = shard_runs(runs, args.shard_index, args.shard_count, duration_history)
+        print(f"Shard {args.shard_index}/{args.shard_count}: {len(runs)} of {total} runs")
+
+    if args.manifest:
+        write_manifest(runs, args.manifest)
+        print(f"Wrote {len(runs)} runs to {args.manifest}")
+        return
+
+    with contextlib.ExitStack() as stack:
+        if forkserver_socket:
+            try:
+                stack.enter_context(ForkServerProcess(forkserver_command(forkserver_socket), forkserver_socket))
+            except ForkServerError as e:
+                # Runs fall back to spawning their script when nothing listens on the socket
+                print(f"Forkserver unavailable, spawning every script: {e}")
+        passed = runner.execute_runs(runs, args.dry_run, limits)
+
+    if args.trace_baseline and not args.dry_run:
+        # Cached runs did not run in this batch, traces left at their paths are stale if there are any
+        trace_paths = list(dict.fromkeys(path for run in runner.executed_runs for path in run_trace_files(run)))
+        findings = check_traces(trace_paths, args.trace_baseline, args.update_trace_baseline,
+                                tolerances=parse_tolerances(args.trace_metric_tolerance),
+                                default_tolerance=args.trace_tolerance)
+        if not args.trace_warn_only and any(finding.status == "regressed" for finding in findings):
+            passed = False
+
+    if forkserver_socket:
+        shutil.rmtree(os.path.dirname(forkserver_socket), ignore_errors=True)
+
+    if not passed:
+        sys.exit(1)
 
-    runner.run_test(args.script, args.dry_run)
-    
 
 if __name__ == "__main__":
     run_test()
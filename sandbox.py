@@ -0,0 +1,261 @@
+import contextlib
+import dataclasses
+import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set
+
+from metadata import Metadata
+
+DEFAULT_KVS_NAME = "kvs"
+DEFAULT_STORAGE_NAME = "admin_storage.json"
+# Secured device port of the apps when --secured-device-port is not given
+DEFAULT_SECURED_DEVICE_PORT = 5540
+# Setup codes encode the discriminator of the app they were generated for
+SETUP_CODE_ARGS = ("--qr-code", "--manual-code")
+
+
+def replace_arg_value(args: str, option: str, value: str, append: bool = False) -> str:
+    """
+    Replaces the value of every occurrence of `option` in a shell style
+    argument string.
+
+    Parameters:
+
+    args:
+     Argument string, for example "--KVS kvs1 --discriminator 1234"
+
+    option:
+     Option whose value should be replaced, for example "--KVS"
+
+    value:
+     New value of the option
+
+    append:
+     If true and the option is not present, append it with the given value
+    """
+    ptrn = re.compile(rf"(^|\s){re.escape(option)}(\s+|=)([^\s]+)")
+    if ptrn.search(args):
+        return ptrn.sub(lambda m: f"{m.group(1)}{option}{m.group(2)}{shlex.quote(value)}", args)
+
+    if append:
+        return f"{args} {option} {shlex.quote(value)}".strip()
+
+    return args
+
+
+def get_arg_value(args: str, option: str) -> Optional[str]:
+    """
+    Returns the value of `option` in a shell style argument string, if present.
+    """
+    match = re.search(rf"(^|\s){re.escape(option)}(\s+|=)(?P<value>[^\s]+)", args)
+    return match.group("value") if match else None
+
+
+def is_port_free(port: int) -> bool:
+    """
+    Checks that nothing on this host is bound to the given UDP or TCP port.
+    """
+    for family in (socket.AF_INET6, socket.AF_INET):
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+            try:
+                with socket.socket(family, kind) as sock:
+                    sock.bind(("::" if family == socket.AF_INET6 else "", port))
+            except OSError:
+                return False
+    return True
+
+
+@dataclass
+class RunSandbox:
+    """
+    Private namespace of a single run.
+
+    Attributes:
+
+    root:
+     Directory holding the run's temp directory, app KVS and controller storage.
+
+    discriminator:
+     Discriminator allocated to the app of this run.
+
+    port:
+     Secured device port allocated to the app of this run.
+
+    netns:
+     Name of the Linux network namespace the run executes in, if any.
+    """
+    root: str
+    discriminator: int
+    port: int
+    netns: Optional[str] = None
+
+    @property
+    def tmp_dir(self) -> str:
+        return os.path.join(self.root, "tmp")
+
+    def rewrite(self, run: Metadata) -> Metadata:
+        """
+        Returns a copy of `run` whose app and script arguments point at the
+        sandbox's private paths and allocated values.
+
+        Runs whose script commissions through --qr-code or --manual-code are
+        refused, those codes carry the app's original discriminator.
+        """
+        app_args = run.app_args
+        script_args = run.script_args
+
+        app_ready_port = run.app_ready_port
+
+        if run.app:
+            for option in SETUP_CODE_ARGS:
+                if get_arg_value(script_args, option) is not None:
+                    raise ValueError(f"Cannot sandbox {run.run}: the script commissions with {option}, "
+                                     "use --discriminator and --passcode instead")
+            kvs = get_arg_value(app_args, "--KVS") or DEFAULT_KVS_NAME
+            app_args = replace_arg_value(app_args, "--KVS",
+                                         os.path.join(self.root, os.path.basename(kvs)), append=True)
+            app_args = replace_arg_value(app_args, "--discriminator", str(self.discriminator), append=True)
+            # A readiness probe of the app's own port must follow it to the allocated one
+            if app_ready_port == int(get_arg_value(app_args, "--secured-device-port") or DEFAULT_SECURED_DEVICE_PORT):
+                app_ready_port = self.port
+            app_args = replace_arg_value(app_args, "--secured-device-port", str(self.port), append=True)
+
+        storage = get_arg_value(script_args, "--storage-path") or DEFAULT_STORAGE_NAME
+        script_args = replace_arg_value(script_args, "--storage-path",
+                                        os.path.join(self.root, os.path.basename(storage)), append=True)
+        if run.app:
+            script_args = replace_arg_value(script_args, "--discriminator", str(self.discriminator), append=True)
+
+        return dataclasses.replace(run, app_args=app_args, script_args=script_args, app_ready_port=app_ready_port,
+                                   sandbox_dir=self.root, netns=self.netns or "")
+
+
+def sandbox_command(command: List[str], sandbox_dir: Optional[str], netns: Optional[str]) -> List[str]:
+    """
+    Wraps a command so that it executes inside the given network namespace,
+    with the sandbox's temp directory bind mounted over /tmp. Without a
+    network namespace the command is returned unchanged, the temp directory
+    is then only exposed through TMPDIR and the apps keep writing their
+    hard-coded /tmp/chip_* files to the shared /tmp.
+    """
+    if not netns:
+        return command
+
+    if not sandbox_dir:
+        return ["ip", "netns", "exec", netns] + command
+
+    return ["ip", "netns", "exec", netns, "sh", "-c", 'mount --bind "$0" /tmp && exec "$@"',
+            os.path.join(sandbox_dir, "tmp")] + command
+
+
+def sandbox_env(sandbox_dir: str) -> Dict[str, str]:
+    """
+    Environment of processes executing inside a sandbox.
+    """
+    env = dict(os.environ)
+    env["TMPDIR"] = os.path.join(sandbox_dir, "tmp")
+    return env
+
+
+class SandboxManager:
+    """
+    Allocates sandboxes for concurrent runs on a single host, making sure
+    no two active runs share a directory, discriminator or port.
+    """
+
+    def __init__(self, base_dir: Optional[str] = None, use_netns: bool = False,
+                 port_base: int = 5540, discriminator_base: int = 1):
+        """
+        Parameters:
+
+        base_dir:
+         Directory under which sandboxes are created, defaults to the system temp directory.
+
+        use_netns:
+         If true, every run gets its own network namespace. Requires root.
+
+        port_base:
+         First port considered when allocating secured device ports.
+
+        discriminator_base:
+         First discriminator considered when allocating discriminators.
+        """
+        self.base_dir = base_dir
+        self.use_netns = use_netns
+        self.port_base = port_base
+        self.discriminator_base = discriminator_base
+        self._lock = threading.Lock()
+        self._ports: Set[int] = set()
+        self._discriminators: Set[int] = set()
+        self._next_port = port_base
+        self._next_discriminator = discriminator_base
+        self._netns_index = 0
+
+    def __allocate_port__(self) -> int:
+        for _ in range(65536 - self.port_base):
+            port = self._next_port
+            self._next_port = port + 1 if port < 65535 else self.port_base
+            if port not in self._ports and is_port_free(port):
+                self._ports.add(port)
+                return port
+        raise Exception("No free port left for a new sandbox")
+
+    def __allocate_discriminator__(self) -> int:
+        # 3840 is the default discriminator of the example apps, never hand it out.
+        for _ in range(4096):
+            discriminator = self._next_discriminator
+            self._next_discriminator = (discriminator + 1) % 4096
+            if discriminator not in self._discriminators and discriminator != 3840:
+                self._discriminators.add(discriminator)
+                return discriminator
+        raise Exception("No free discriminator left for a new sandbox")
+
+    def create(self) -> RunSandbox:
+        """
+        Creates a new sandbox with a private directory and allocated values.
+        """
+        with self._lock:
+            port = self.__allocate_port__()
+            discriminator = self.__allocate_discriminator__()
+            self._netns_index += 1
+            netns = f"chiptest{os.getpid()}-{self._netns_index}" if self.use_netns else None
+
+        root = tempfile.mkdtemp(prefix="chip-run-", dir=self.base_dir)
+        os.makedirs(os.path.join(root, "tmp"))
+
+        if netns:
+            subprocess.check_call(["ip", "netns", "add", netns])
+            subprocess.check_call(["ip", "netns", "exec", netns, "ip", "link", "set", "lo", "up"])
+
+        return RunSandbox(root=root, discriminator=discriminator, port=port, netns=netns)
+
+    def release(self, sandbox: RunSandbox) -> None:
+        """
+        Deletes a sandbox and returns its allocated values to the pool.
+        """
+        if sandbox.netns:
+            subprocess.call(["ip", "netns", "delete", sandbox.netns])
+
+        shutil.rmtree(sandbox.root, ignore_errors=True)
+
+        with self._lock:
+            self._ports.discard(sandbox.port)
+            self._discriminators.discard(sandbox.discriminator)
+
+    @contextlib.contextmanager
+    def sandboxed(self, run: Metadata) -> Iterator[Metadata]:
+        """
+        Context manager yielding `run` rewritten to execute inside a fresh sandbox.
+        """
+        sandbox = self.create()
+        try:
+            yield sandbox.rewrite(run)
+        finally:
+            self.release(sandbox)
@@ -0,0 +1,321 @@
+import heapq
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from metadata import Metadata, MetadataReader, find_scripts
+
+
+@dataclass
+class ResourceLimits:
+    """
+    Limits applied by the scheduler when deciding how many runs can
+    execute at the same time.
+
+    Attributes:
+
+    max_parallel_runs:
+     Maximum number of runs executing at once. Defaults to the number of CPUs.
+
+    max_memory_mb:
+     Memory budget shared by all concurrent runs, 0 means unlimited.
+
+    memory_per_run_mb:
+     Estimated memory used by a single run (app + test script), checked
+     against max_memory_mb.
+
+    max_apps:
+     Maximum number of concurrently running DUT apps, 0 means unlimited.
+
+    exclusive_factory_resets:
+     Execute runs doing a factory reset alone. Without a network namespace
+     their reset removes the app files in the shared /tmp.
+    """
+    max_parallel_runs: int = os.cpu_count() or 1
+    max_memory_mb: int = 0
+    memory_per_run_mb: int = 512
+    max_apps: int = 0
+    exclusive_factory_resets: bool = False
+
+
+@dataclass
+class RunResult:
+    """
+    Outcome of a single executed run.
+    """
+    run: Metadata
+    exit_code: int
+    duration_sec: float
+
+    @property
+    def passed(self) -> bool:
+        return self.exit_code == 0
+
+
+class ResourceGate:
+    """
+    Admission control for runs. A run is admitted when the number of active
+    runs, the memory estimate and the number of active apps all stay within
+    the configured limits. A run is always admitted when nothing else is
+    active so that a single oversized run cannot deadlock the scheduler.
+    An exclusive run is only admitted when nothing else is active, and
+    nothing else is admitted while it executes.
+    """
+
+    def __init__(self, limits: ResourceLimits):
+        self.limits = limits
+        self._cond = threading.Condition()
+        self._active_runs = 0
+        self._active_apps = 0
+        self._active_memory_mb = 0
+        self._exclusive_active = False
+
+    def __is_exclusive__(self, run: Metadata) -> bool:
+        return self.limits.exclusive_factory_resets and (run.factoryreset or run.factoryreset_app_only)
+
+    def __fits__(self, run: Metadata) -> bool:
+        if self._active_runs == 0:
+            return True
+
+        if self._exclusive_active or self.__is_exclusive__(run):
+            return False
+
+        if self._active_runs >= self.limits.max_parallel_runs:
+            return False
+
+        if self.limits.max_memory_mb and \
+                self._active_memory_mb + self.limits.memory_per_run_mb > self.limits.max_memory_mb:
+            return False
+
+        if run.app and self.limits.max_apps and self._active_apps >= self.limits.max_apps:
+            return False
+
+        return True
+
+    def acquire(self, run: Metadata) -> None:
+        with self._cond:
+            self._cond.wait_for(lambda: self.__fits__(run))
+            self._active_runs += 1
+            self._active_memory_mb += self.limits.memory_per_run_mb
+            if run.app:
+                self._active_apps += 1
+            if self.__is_exclusive__(run):
+                self._exclusive_active = True
+
+    def release(self, run: Metadata) -> None:
+        with self._cond:
+            self._active_runs -= 1
+            self._active_memory_mb -= self.limits.memory_per_run_mb
+            if run.app:
+                self._active_apps -= 1
+            if self.__is_exclusive__(run):
+                self._exclusive_active = False
+            self._cond.notify_all()
+
+
+class TestScheduler:
+    """
+    Expands test scripts into runs and executes them on a worker pool,
+    yielding the result of each run as soon as it finishes.
+    """
+
+    def __init__(self, metadata_reader: MetadataReader, execute_run: Callable[[Metadata], int],
+                 limits: Optional[ResourceLimits] = None, script_pattern: str = "TC_*.py"):
+        """
+        Parameters:
+
+        metadata_reader:
+         Reader used to parse the runs defined in each test script.
+
+        execute_run:
+         Callable executing a single run and returning its exit code.
+
+        limits:
+         Concurrency limits, defaults to ResourceLimits().
+
+        script_pattern:
+         Glob pattern used to select test scripts when a directory is given.
+        """
+        self.metadata_reader = metadata_reader
+        self.execute_run = execute_run
+        self.limits = limits or ResourceLimits()
+        self.script_pattern = script_pattern
+
+    def expand_scripts(self, paths: Iterable[str]) -> List[str]:
+        """
+        Expands a list of script and directory paths into a list of script paths.
+        Directories are searched recursively for files matching script_pattern.
+        """
+        return find_scripts(paths, self.script_pattern)
+
+    def expand_runs(self, paths: Iterable[str]) -> List[Metadata]:
+        """
+        Expands a list of script and directory paths into the runs they define.
+        """
+        return self.metadata_reader.parse_scripts(self.expand_scripts(paths))
+
+    def __execute__(self, gate: ResourceGate, run: Metadata) -> RunResult:
+        gate.acquire(run)
+        try:
+            start = time.monotonic()
+            try:
+                exit_code = self.execute_run(run)
+            except Exception:
+                logging.exception(f"Run {run.run} of {run.py_script_path} raised")
+                exit_code = -1
+            return RunResult(run=run, exit_code=exit_code, duration_sec=time.monotonic() - start)
+        finally:
+            gate.release(run)
+
+    def run(self, runs: List[Metadata]) -> Iterator[RunResult]:
+        """
+        Executes the given runs concurrently within the resource limits.
+
+        Return:
+
+        Iterator[RunResult]
+         Results in completion order, produced as each run finishes.
+        """
+        if not runs:
+            return
+
+        gate = ResourceGate(self.limits)
+        workers = max(1, min(self.limits.max_parallel_runs, len(runs)))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.__execute__, gate, run) for run in runs]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+class DurationHistory:
+    """
+    On-disk history of the duration of every run, used to balance shards.
+
+    Runs are keyed by their script path relative to the working directory
+    and their run name, so that a history can be shared between checkouts.
+    Durations are smoothed with an exponential moving average so that a
+    single slow execution does not reshuffle every shard.
+    """
+
+    FORMAT = 1
+
+    # Weight of the latest duration in the moving average
+    SMOOTHING = 0.5
+
+    def __init__(self, history_path: str):
+        """
+        Loads the history from disk. A missing or corrupt history is treated
+        as empty.
+
+        Parameters:
+
+        history_path:
+         Path to the JSON file storing the history.
+        """
+        self.history_path = history_path
+        self._durations: Dict[str, float] = {}
+        self._dirty = False
+
+        try:
+            with open(history_path, 'r', encoding='utf8') as stream:
+                data = json.load(stream)
+            if data.get("format") == self.FORMAT:
+                self._durations = {key: float(value) for key, value in data["durations"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._durations = {}
+
+    @staticmethod
+    def key(run: Metadata) -> str:
+        return f"{os.path.relpath(run.py_script_path)}::{run.run}"
+
+    def get(self, run: Metadata) -> Optional[float]:
+        """
+        Returns the expected duration of a run in seconds, None if it never ran.
+        """
+        return self._durations.get(self.key(run))
+
+    def update(self, run: Metadata, duration_sec: float) -> None:
+        key = self.key(run)
+        previous = self._durations.get(key)
+        if previous is None:
+            self._durations[key] = duration_sec
+        else:
+            self._durations[key] = self.SMOOTHING * duration_sec + (1 - self.SMOOTHING) * previous
+        self._dirty = True
+
+    def save(self) -> None:
+        """
+        Atomically writes the history to disk if it changed.
+        """
+        if not self._dirty:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.history_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf8') as stream:
+            json.dump({"format": self.FORMAT, "durations": self._durations}, stream, indent=1, sort_keys=True)
+        os.replace(temp_path, self.history_path)
+        self._dirty = False
+
+
+def shard_runs(runs: List[Metadata], shard_index: int, shard_count: int,
+               history: Optional[DurationHistory] = None) -> List[Metadata]:
+    """
+    Selects the runs of one shard, balancing the expected duration of all
+    shards with longest-processing-time-first bin packing.
+
+    Runs without history are expected to take the median duration of the
+    known runs, so that they spread evenly across shards. Every shard
+    computes the same assignment as long as all of them get the same runs
+    and history.
+
+    Parameters:
+
+    runs:
+     Every run of the suite
+
+    shard_index:
+     Index of the shard to return, from 0 to shard_count - 1
+
+    shard_count:
+     Total number of shards
+
+    history:
+     Past run durations, all runs are treated as equally long without it
+
+    Return:
+
+    List[Metadata]
+     Runs of the shard, longest first
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index {shard_index} is not in [0, {shard_count})")
+
+    known = [history.get(run) for run in runs] if history else [None] * len(runs)
+    known_durations = [duration for duration in known if duration is not None]
+    default = statistics.median(known_durations) if known_durations else 1.0
+    estimates = [default if duration is None else duration for duration in known]
+
+    # Sort by a stable key so that every shard sees the same order
+    order = sorted(range(len(runs)),
+                   key=lambda i: (-estimates[i], DurationHistory.key(runs[i])))
+
+    # Min-heap of (load, shard), ties go to the lowest shard index
+    loads = [(0.0, shard) for shard in range(shard_count)]
+    selected = []
+    for i in order:
+        load, shard = heapq.heappop(loads)
+        if shard == shard_index:
+            selected.append(runs[i])
+        heapq.heappush(loads, (load + estimates[i], shard))
+
+    return selected
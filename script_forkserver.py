@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+
+"""
+Forkserver launching python test scripts from a preloaded interpreter.
+
+Starting a test script costs a cold interpreter plus the import of the chip
+controller bindings, mobly and matter_testing_support. The forkserver pays
+that once: it imports the heavy modules, listens on a unix socket and forks
+a child per request, which runs the requested script with runpy as
+`python3 <script> <args>` would.
+
+A request carries the argv, environment and working directory of the script
+along with the write ends of its stdout and stderr pipes. The server answers
+with the pid of the child, then with its exit code once it exited. Closing
+the connection early kills the child.
+
+Modules are imported once per server, a server must be restarted to pick up
+changes to preloaded modules.
+"""
+
+import argparse
+import json
+import logging
+import os
+import runpy
+import selectors
+import shlex
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+# Modules imported by nearly every test script
+DEFAULT_PRELOAD_MODULES = (
+    "chip.ChipDeviceCtrl",
+    "chip.clusters",
+    "chip.interaction_model",
+    "mobly.asserts",
+    "mobly.base_test",
+    "matter_testing_support",
+)
+
+# Time given to a starting server to import its modules and listen
+SERVER_START_TIMEOUT_SEC = 120
+# Time given to a stopping server to remove its socket and exit before it is killed
+SERVER_STOP_TIMEOUT_SEC = 30
+
+REQUEST_HEADER = "<I"
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+class ForkServerError(Exception):
+    pass
+
+
+def preload(modules: typing.Iterable[str]) -> typing.List[str]:
+    """
+    Imports the given modules, skipping the ones that fail to import.
+
+    Return:
+
+    List[str]
+     Modules that were imported
+    """
+    loaded = []
+    for module in modules:
+        try:
+            __import__(module)
+            loaded.append(module)
+        except Exception as e:
+            logging.warning("Not preloading %s: %s" % (module, e))
+    return loaded
+
+
+def recv_request(connection: socket.socket) -> typing.Tuple[typing.Optional[dict], typing.List[int]]:
+    """
+    Reads a request and the file descriptors sent along with it. The request
+    is None when the client closed without sending one, e.g. when checking
+    that the server is listening.
+    """
+    data, fds, _, _ = socket.recv_fds(connection, 64 * 1024, 2)
+    if not data and not fds:
+        return None, []
+    try:
+        header_size = struct.calcsize(REQUEST_HEADER)
+        while len(data) < header_size:
+            chunk = connection.recv(header_size - len(data))
+            if not chunk:
+                raise ForkServerError("Connection closed before the request was received")
+            data += chunk
+
+        size, = struct.unpack_from(REQUEST_HEADER, data)
+        if size > MAX_REQUEST_SIZE:
+            raise ForkServerError("Request of %d bytes is too large" % size)
+        while len(data) < header_size + size:
+            chunk = connection.recv(header_size + size - len(data))
+            if not chunk:
+                raise ForkServerError("Connection closed before the request was received")
+            data += chunk
+
+        request = json.loads(data[header_size:header_size + size])
+        if len(fds) != 2 or not request.get("argv"):
+            raise ForkServerError("Malformed request")
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return request, fds
+
+
+def send_message(connection: socket.socket, message: dict) -> None:
+    try:
+        connection.sendall(json.dumps(message).encode() + b'\n')
+    except OSError:
+        # The client went away, there is nobody left to tell
+        pass
+
+
+class ForkServer:
+    """
+    Single threaded server forking a child per script to run.
+    """
+
+    def __init__(self, socket_path: str, script_sys_path: typing.Optional[typing.List[str]] = None):
+        """
+        Parameters:
+
+        socket_path:
+         Unix socket to listen on
+
+        script_sys_path:
+         Module search path of the scripts after their own directory, the
+         server's own path without its first entry when not given
+        """
+        self.socket_path = socket_path
+        self.script_sys_path = list(sys.path[1:] if script_sys_path is None else script_sys_path)
+        self._pid = os.getpid()
+        self._listener: typing.Optional[socket.socket] = None
+        self._selector: typing.Optional[selectors.BaseSelector] = None
+        self._wakeup_read = self._wakeup_write = -1
+        # Running children by pid, with the connection of the client waiting for them
+        self._children: typing.Dict[int, typing.Optional[socket.socket]] = {}
+        self._stopping = False
+
+    def serve(self) -> None:
+        """
+        Serves requests until SIGTERM or SIGINT.
+
+        In the forked children this only returns, or raises, once the script
+        finished, so that the interpreter exits the way it would after
+        running the script directly.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(64)
+
+        # Children exiting and stop requests wake the selector up through this pipe
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        signal.set_wakeup_fd(self._wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, self.__stop__)
+        signal.signal(signal.SIGINT, self.__stop__)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+
+        logging.info("Forkserver %d listening on %s" % (self._pid, self.socket_path))
+        try:
+            while not self._stopping:
+                for key, _ in self._selector.select():
+                    if key.fileobj is self._listener:
+                        request = self.__accept__()
+                        if request and self.__fork__(*request) == 0:
+                            self.__run_script__(request[1])
+                            return
+                    elif key.fileobj == self._wakeup_read:
+                        self.__drain_wakeup__()
+                    else:
+                        self.__client_closed__(key.fileobj)
+                self.__reap__()
+        finally:
+            if os.getpid() == self._pid:
+                self.__shutdown__()
+
+    def __stop__(self, signum, frame) -> None:
+        self._stopping = True
+
+    def __accept__(self) -> typing.Optional[typing.Tuple[socket.socket, dict, typing.List[int]]]:
+        connection, _ = self._listener.accept()
+        connection.settimeout(10)
+        try:
+            request, fds = recv_request(connection)
+        except (OSError, ValueError, ForkServerError) as e:
+            logging.error("Dropping forkserver request: %s" % e)
+            connection.close()
+            return None
+        if request is None:
+            connection.close()
+            return None
+        return connection, request, fds
+
+    def __fork__(self, connection: socket.socket, request: dict, fds: typing.List[int]) -> int:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # Only the pipes of this request survive in the child
+            connection.close()
+            os.dup2(fds[0], 1)
+            os.dup2(fds[1], 2)
+            for fd in fds:
+                os.close(fd)
+            return 0
+
+        for fd in fds:
+            os.close(fd)
+        send_message(connection, {"pid": pid})
+        connection.setblocking(False)
+        self._children[pid] = connection
+        self._selector.register(connection, selectors.EVENT_READ)
+        return pid
+
+    def __run_script__(self, request: dict) -> None:
+        """
+        Turns the forked child into the script process.
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self._selector.close()
+        self._listener.close()
+        for connection in self._children.values():
+            if connection is not None:
+                connection.close()
+        self._children.clear()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.close(null_fd)
+
+        os.environ.clear()
+        os.environ.update(request.get("env") or {})
+        # Preloaded modules may have looked the temporary directory up already
+        tempfile.tempdir = None
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+
+        # Drop the logging setup of the server, a script calling logging.basicConfig() must get its own
+        for handler in list(logging.root.handlers):
+            logging.root.removeHandler(handler)
+        logging.root.setLevel(logging.WARNING)
+        logging.disable(logging.NOTSET)
+
+        argv = request["argv"]
+        sys.argv = list(argv)
+        sys.path[:] = [os.path.dirname(os.path.abspath(argv[0]))] + self.script_sys_path
+        runpy.run_path(argv[0], run_name="__main__")
+
+    def __client_closed__(self, connection: socket.socket) -> None:
+        try:
+            if connection.recv(4096):
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+
+        for pid, child_connection in self._children.items():
+            if child_connection is connection:
+                logging.warning("Client of child %d went away, killing it" % pid)
+                self._children[pid] = None
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                break
+        self._selector.unregister(connection)
+        connection.close()
+
+    def __drain_wakeup__(self) -> None:
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __reap__(self) -> None:
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            connection = self._children.pop(pid, None)
+            if connection is not None:
+                self._selector.unregister(connection)
+                connection.setblocking(True)
+                send_message(connection, {"exit_code": os.waitstatus_to_exitcode(status)})
+                connection.close()
+
+    def __shutdown__(self) -> None:
+        signal.set_wakeup_fd(-1)
+        for pid, connection in self._children.items():
+            logging.warning("Forkserver stopping, killing child %d" % pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            if connection is not None:
+                connection.close()
+        self._children.clear()
+        if self._selector:
+            self._selector.close()
+        if self._listener:
+            self._listener.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        for fd in (self._wakeup_read, self._wakeup_write):
+            if fd >= 0:
+                os.close(fd)
+
+
+class ForkedScript:
+    """
+    Script process forked by a forkserver, with the subset of the
+    subprocess.Popen interface used to run tests.
+    """
+
+    def __init__(self, connection: socket.socket, pid: int, stdout: typing.BinaryIO, stderr: typing.BinaryIO,
+                 buffer: bytes = b''):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode: typing.Optional[int] = None
+        self._connection = connection
+        self._buffer = buffer
+
+    def __read_exit_code__(self, timeout: typing.Optional[float]) -> typing.Optional[int]:
+        self._connection.settimeout(timeout)
+        while b'\n' not in self._buffer:
+            try:
+                chunk = self._connection.recv(4096)
+            except socket.timeout:
+                return None
+            if not chunk:
+                logging.error("Forkserver closed the connection before child %d exited" % self.pid)
+                return 1
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return json.loads(line)["exit_code"]
+
+    def poll(self) -> typing.Optional[int]:
+        if self.returncode is None:
+            self.returncode = self.__read_exit_code__(0)
+            self.__close_if_exited__()
+        return self.returncode
+
+    def wait(self, timeout: typing.Optional[float] = None) -> int:
+        if self.returncode is None:
+            self.returncode = self.__read_exit_code__(timeout)
+            if self.returncode is None:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            self.__close_if_exited__()
+        return self.returncode
+
+    def __close_if_exited__(self) -> None:
+        if self.returncode is not None:
+            self._connection.close()
+
+    def send_signal(self, signum: int) -> None:
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self) -> None:
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self) -> None:
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkServerClient:
+    """
+    Launches scripts through the forkserver listening on socket_path.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+
+    @property
+    def available(self) -> bool:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+
+    def launch(self, argv: typing.List[str], env: typing.Optional[typing.Dict[str, str]] = None,
+               cwd: typing.Optional[str] = None) -> ForkedScript:
+        """
+        Runs a script in a child of the forkserver.
+
+        Parameters:
+
+        argv:
+         Script path followed by its arguments, as in `python3 <argv>`
+
+        env:
+         Environment of the script, the current one when None
+
+        cwd:
+         Working directory of the script, the current one when None
+        """
+        payload = json.dumps({
+            "argv": argv,
+            "env": dict(os.environ if env is None else env),
+            "cwd": cwd or os.getcwd(),
+        }).encode()
+
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+            socket.send_fds(connection, [struct.pack(REQUEST_HEADER, len(payload)) + payload],
+                            [stdout_write, stderr_write])
+            os.close(stdout_write)
+            os.close(stderr_write)
+            stdout_write = stderr_write = -1
+
+            buffer = b''
+            while b'\n' not in buffer:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    raise ForkServerError("Forkserver on %s dropped the request" % self.socket_path)
+                buffer += chunk
+            line, buffer = buffer.split(b'\n', 1)
+            pid = json.loads(line)["pid"]
+        except BaseException:
+            connection.close()
+            for fd in (stdout_read, stderr_read, stdout_write, stderr_write):
+                if fd >= 0:
+                    os.close(fd)
+            raise
+
+        return ForkedScript(connection, pid, open(stdout_read, 'rb', buffering=0),
+                            open(stderr_read, 'rb', buffering=0), buffer)
+
+
+def live_group_members(pgid: int) -> typing.List[int]:
+    """
+    Pids of the processes of a process group that are still running. Exited
+    processes waiting to be reaped do not count.
+    """
+    members = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as stat:
+                # The fields after the command name are: state, ppid, pgrp, ...
+                fields = stat.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        if fields[0] != 'Z' and int(fields[2]) == pgid:
+            members.append(int(entry))
+    return members
+
+
+class ForkServerProcess:
+    """
+    Forkserver started in the background for the duration of a with block.
+    The command runs in its own process group, which is stopped as a whole:
+    a shell command, such as forkserver_command(), does not pass signals on
+    to the server it started.
+    """
+
+    def __init__(self, command: typing.Union[str, typing.List[str]], socket_path: str,
+                 start_timeout: float = SERVER_START_TIMEOUT_SEC, stop_timeout: float = SERVER_STOP_TIMEOUT_SEC):
+        self.command = command
+        self.socket_path = socket_path
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.process: typing.Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> 'ForkServerProcess':
+        self.process = subprocess.Popen(self.command, shell=isinstance(self.command, str), start_new_session=True)
+        client = ForkServerClient(self.socket_path)
+        deadline = time.monotonic() + self.start_timeout
+        while not client.available:
+            if self.process.poll() is not None:
+                raise ForkServerError("Forkserver exited with %d before listening" % self.process.returncode)
+            if time.monotonic() > deadline:
+                self.__exit__(None, None, None)
+                raise ForkServerError("Forkserver not listening on %s after %ds" %
+                                      (self.socket_path, self.start_timeout))
+            time.sleep(0.1)
+        return self
+
+    def __signal_group__(self, signum: int) -> None:
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def __wait_group__(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            self.process.poll()
+            if not live_group_members(self.process.pid):
+                return True
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self.process is None:
+            return
+        self.__signal_group__(signal.SIGTERM)
+        if not self.__wait_group__(self.stop_timeout):
+            self.__signal_group__(signal.SIGKILL)
+            self.__wait_group__(self.stop_timeout)
+        self.process.wait()
+
+
+def forkserver_command(socket_path: str) -> str:
+    """
+    Shell command starting a forkserver in the python environment the test
+    scripts run in.
+    """
+    return ("scripts/run_in_python_env.sh out/venv "
+            f"'./scripts/tests/script_forkserver.py --socket {shlex.quote(socket_path)} --preload-path src/python_testing'")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve test script launches from a preloaded interpreter.')
+    parser.add_argument('--socket', required=True, help='Unix socket to listen on')
+    parser.add_argument('--preload', nargs='*', default=list(DEFAULT_PRELOAD_MODULES),
+                        help='Modules imported once before serving')
+    parser.add_argument('--preload-path', action='append', default=[],
+                        help='Directory added to sys.path before preloading, e.g. src/python_testing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # Scripts get the module search path of a fresh interpreter, without the preload paths
+    script_sys_path = sys.path[1:]
+    for path in args.preload_path:
+        sys.path.insert(0, os.path.abspath(path))
+    loaded = preload(args.preload)
+    logging.info("Preloaded %s" % ", ".join(loaded))
+
+    ForkServer(args.socket, script_sys_path).serve()
+
+
+if __name__ == '__main__':
+    main()
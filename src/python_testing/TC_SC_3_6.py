@@ -21,17 +21,16 @@
 #    limitations under the License.
 
 import asyncio
+import json
 import logging
-import queue
+import math
 import time
-from threading import Event
 
 import chip.clusters as Clusters
-from chip.clusters import ClusterObjects as ClustersObjects
-from chip.clusters.Attribute import SubscriptionTransaction, TypedAttributePath
 from chip.utils import CommissioningBuildingBlocks
 from matter_testing_support import MatterBaseTest, async_test_body, default_matter_test_main
 from mobly import asserts
+from subscription_accumulator import AllClientsSawValue, SubscriptionAccumulator
 
 # TODO: Overall, we need to add validation that session IDs have not changed throughout to be agnostic
 #       to some internal behavior assumptions of the SDK we are making relative to the write to
@@ -39,52 +38,179 @@ from mobly import asserts
 #
 
 
-class AttributeChangeAccumulator:
-    def __init__(self, name: str, expected_attribute: ClustersObjects.ClusterAttributeDescriptor, output: queue.Queue):
-        self._name = name
-        self._output = output
-        self._expected_attribute = expected_attribute
+def percentiles(values: list) -> dict:
+    """Nearest-rank p50/p95/p99 and maximum of a list of values, None entries when it is empty."""
+    ordered = sorted(values)
+    summary = {"count": len(ordered)}
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        summary[name] = ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] if ordered else None
+    summary["max"] = ordered[-1] if ordered else None
+    return summary
 
-    def __call__(self, path: TypedAttributePath, transaction: SubscriptionTransaction):
-        if path.AttributeType == self._expected_attribute:
-            data = transaction.GetAttribute(path)
 
-            value = {
-                'name': self._name,
-                'endpoint': path.Path.EndpointId,
-                'attribute': path.AttributeType,
-                'value': data
-            }
-            logging.info("Got subscription report on client %s for %s: %s" % (self.name, path.AttributeType, data))
-            self._output.put(value)
-
-    @property
-    def name(self) -> str:
-        return self._name
-
-
-class ResubscriptionCatcher:
-    def __init__(self, name):
-        self._name = name
-        self._got_resubscription_event = Event()
-
-    def __call__(self, transaction: SubscriptionTransaction, terminationError, nextResubscribeIntervalMsec):
-        self._got_resubscription_event.set()
-        logging.info("Got resubscription on client %s" % self.name)
-
-    @property
-    def name(self) -> str:
-        return self._name
-
-    @property
-    def caught_resubscription(self) -> bool:
-        return self._got_resubscription_event.is_set()
+def sweep_values(maximum: int) -> list:
+    """1, 2, 4, ... up to and including maximum."""
+    values = []
+    value = 1
+    while value < maximum:
+        values.append(value)
+        value *= 2
+    values.append(maximum)
+    return values
 
 
 class TC_SC_3_6(MatterBaseTest):
     def setup_class(self):
         self._subscriptions = []
 
+    def new_fabric_credentials(self, admin_node_id: int) -> tuple:
+        """
+        Local part of provisioning a fabric: creates its CA, fabric admin and admin
+        controller. Returns them with the time it took. Must run on the event loop
+        thread, the CA manager and the controllers' storage are not thread-safe.
+        """
+        start_time = time.monotonic()
+        new_certificate_authority = self.certificate_authority_manager.NewCertificateAuthority()
+        new_fabric_admin = new_certificate_authority.NewFabricAdmin(vendorId=0xFFF1, fabricId=1)
+        new_admin_ctrl = new_fabric_admin.NewController(nodeId=admin_node_id)
+        return new_fabric_admin, new_admin_ctrl, time.monotonic() - start_time
+
+    async def provision_fabric_on_dut(self, dev_ctrl, new_fabric_admin, new_admin_ctrl, controller_node_ids: list,
+                                      stages: dict) -> list:
+        """
+        Device part of provisioning a fabric: adds its NOC to the DUT and creates its
+        other controllers. Records the duration of each step in stages, which includes
+        the time the loop spent creating the next fabric's credentials meanwhile, and
+        returns the controllers created.
+        """
+        stage_start = time.monotonic()
+        await CommissioningBuildingBlocks.AddNOCForNewFabricFromExisting(
+            commissionerDevCtrl=dev_ctrl,
+            newFabricDevCtrl=new_admin_ctrl,
+            existingNodeId=self.dut_node_id,
+            newNodeId=self.dut_node_id
+        )
+        stages["add_noc"] = time.monotonic() - stage_start
+
+        if not controller_node_ids:
+            return []
+        stage_start = time.monotonic()
+        new_controllers = await CommissioningBuildingBlocks.CreateControllersOnFabric(
+            fabricAdmin=new_fabric_admin,
+            adminDevCtrl=new_admin_ctrl,
+            controllerNodeIds=controller_node_ids,
+            privilege=Clusters.AccessControl.Enums.AccessControlEntryPrivilegeEnum.kAdminister,
+            targetNodeId=self.dut_node_id
+        )
+        stages["create_controllers"] = time.monotonic() - stage_start
+        return new_controllers
+
+    async def subscribe_all(self, client_list: list, attribute_path: tuple, report_interval: tuple,
+                            max_parallel_subscriptions: int) -> list:
+        """
+        Establishes a subscription from every client, at most max_parallel_subscriptions
+        at a time. Returns (subscription, subscribe latency in seconds) in client_list order,
+        whatever the order in which the subscriptions completed.
+        """
+        semaphore = asyncio.Semaphore(max_parallel_subscriptions)
+
+        async def subscribe(sub_idx, client):
+            async with semaphore:
+                logging.info("Establishing subscription %d/%d from controller node %s" % (sub_idx + 1, len(client_list), client.name))
+                start_time = time.monotonic()
+                sub = await client.ReadAttribute(
+                    nodeid=self.dut_node_id,
+                    attributes=[attribute_path],
+                    reportInterval=report_interval,
+                    keepSubscriptions=False
+                )
+                return sub, time.monotonic() - start_time
+
+        results = await asyncio.gather(*[subscribe(sub_idx, client) for sub_idx, client in enumerate(client_list)],
+                                       return_exceptions=True)
+
+        # Keep every established subscription for teardown, even if another one failed
+        for result in results:
+            if not isinstance(result, BaseException):
+                self._subscriptions.append(result[0])
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        return results
+
+    async def run_stress(self, client_list: list, num_controllers_per_fabric: int, report_interval: tuple,
+                         max_parallel_subscriptions: int):
+        """
+        Stress mode: for every swept (fabrics, controllers per fabric) configuration, subscribes
+        the matching subset of clients, writes NodeLabel repeatedly and records the latency of
+        the resulting reports and the resubscriptions seen. The results are written as JSON to
+        the stress_output user param.
+        """
+        fabric_counts = self.user_params.get("stress_fabric_counts",
+                                             sweep_values(len(client_list) // num_controllers_per_fabric))
+        controller_counts = self.user_params.get("stress_controller_counts", sweep_values(num_controllers_per_fabric))
+        writes_per_config = self.user_params.get("stress_writes_per_config", 10)
+        write_rate_hz = self.user_params.get("stress_write_rate_hz", 1.0)
+        report_timeout_sec = self.user_params.get("stress_report_timeout_sec", 30)
+        output_path = self.user_params.get("stress_output", "TC_SC_3_6_stress.json")
+
+        node_label = Clusters.BasicInformation.Attributes.NodeLabel
+        results = []
+
+        for num_fabrics in fabric_counts:
+            for num_controllers in controller_counts:
+                clients = [client_list[fabric_idx * num_controllers_per_fabric + controller_idx]
+                           for fabric_idx in range(num_fabrics) for controller_idx in range(num_controllers)]
+                logging.info("Stress: %d fabrics x %d controllers (%d clients)" % (num_fabrics, num_controllers, len(clients)))
+
+                first_subscription = len(self._subscriptions)
+                subscriptions = await self.subscribe_all(clients, attribute_path=(0, node_label),
+                                                         report_interval=report_interval,
+                                                         max_parallel_subscriptions=max_parallel_subscriptions)
+
+                accumulator = SubscriptionAccumulator()
+                for client, (sub, _) in zip(clients, subscriptions):
+                    accumulator.attach(client.name, sub, [node_label])
+
+                # Writes are issued at most at write_rate_hz, a write whose reports take longer delays the next one
+                report_latencies = []
+                missing_reports = 0
+                next_write_time = time.monotonic()
+                for write_idx in range(writes_per_config):
+                    await asyncio.sleep(max(0, next_write_time - time.monotonic()))
+                    next_write_time = time.monotonic() + 1 / write_rate_hz
+
+                    label = "Stress %d-%d-%d" % (num_fabrics, num_controllers, write_idx)
+                    saw_label = AllClientsSawValue([client.name for client in clients], endpoint=0,
+                                                   attribute=node_label, value=label, since=time.monotonic())
+                    await clients[0].WriteAttribute(self.dut_node_id, [(0, node_label(value=label))])
+                    await accumulator.wait_for(saw_label, report_timeout_sec)
+                    report_latencies.extend(saw_label.latency_sec.values())
+                    missing_reports += len(saw_label.pending)
+
+                for sub, _ in subscriptions:
+                    sub.Shutdown()
+                del self._subscriptions[first_subscription:]
+
+                result = {
+                    "fabrics": num_fabrics,
+                    "controllers_per_fabric": num_controllers,
+                    "clients": len(clients),
+                    "writes": writes_per_config,
+                    "missing_reports": missing_reports,
+                    "resubscriptions": accumulator.resubscription_count(),
+                    "subscribe_latency_sec": percentiles([latency for _, latency in subscriptions]),
+                    "report_latency_sec": percentiles(report_latencies),
+                }
+                logging.info("Stress result: %s" % json.dumps(result))
+                results.append(result)
+
+        with open(output_path, "w") as output:
+            json.dump({"test": "TC_SC_3_6", "write_rate_hz": write_rate_hz, "configurations": results}, output, indent=2)
+        logging.info("Stress results written to %s" % output_path)
+        self.record_data({"stress_results": output_path})
+
     def teardown_class(self):
         logging.info("Teardown: shutting down all subscription to avoid racy callbacks")
         for subscription in self._subscriptions:
@@ -106,6 +232,26 @@ class TC_SC_3_6(MatterBaseTest):
         # on MRP params of subscriber and on actual min_report_interval.
         # TODO: Determine the correct max value depending on target. Test plan doesn't say!
         timeout_delay_sec = self.user_params.get("timeout_delay_sec", max_report_interval_sec * 2)
+        # Number of subscriptions being established at the same time
+        max_parallel_subscriptions = self.user_params.get("max_parallel_subscriptions", 5)
+        # Stress mode sweeps fabric and controller counts up to the DUT limits and reports latency percentiles
+        stress_mode = self.user_params.get("stress_mode", False)
+
+        if stress_mode:
+            supported_fabrics = await self.read_single_attribute(
+                dev_ctrl,
+                node_id=self.dut_node_id,
+                endpoint=0,
+                attribute=Clusters.OperationalCredentials.Attributes.SupportedFabrics
+            )
+            case_sessions_per_fabric = (await self.read_single_attribute(
+                dev_ctrl,
+                node_id=self.dut_node_id,
+                endpoint=0,
+                attribute=Clusters.BasicInformation.Attributes.CapabilityMinima
+            )).caseSessionsPerFabric
+            num_fabrics_to_commission = self.user_params.get("num_fabrics_to_commission", supported_fabrics)
+            num_controllers_per_fabric = self.user_params.get("num_controllers_per_fabric", case_sessions_per_fabric)
 
         BEFORE_LABEL = "Before Subscriptions"
         AFTER_LABEL = "After Subscriptions"
@@ -150,34 +296,41 @@ class TC_SC_3_6(MatterBaseTest):
                 controller.name = all_names.pop(0)
             client_list.extend(new_controllers)
 
-        # Prepare clients for subsequent fabrics
+        # Prepare clients for subsequent fabrics. The DUT handles one fail-safe context at a time,
+        # so the NOC exchange and controller setup of each fabric stay serialized. The credentials
+        # of the next fabric are created on this thread while the device steps of the current one
+        # are in flight: those wait on the CHIP stack thread, which the credential creation only
+        # reaches through the stack lock.
+        fabric_setup_sec = []
+        credentials = self.new_fabric_credentials(dev_ctrl.nodeId) if num_fabrics_to_commission > 1 else None
         for i in range(num_fabrics_to_commission - 1):
             admin_index = 2 + i
             logging.info("Commissioning fabric %d/%d" % (admin_index, num_fabrics_to_commission))
-            new_certificate_authority = self.certificate_authority_manager.NewCertificateAuthority()
-            new_fabric_admin = new_certificate_authority.NewFabricAdmin(vendorId=0xFFF1, fabricId=1)
-            new_admin_ctrl = new_fabric_admin.NewController(nodeId=dev_ctrl.nodeId)
+            new_fabric_admin, new_admin_ctrl, credentials_sec = credentials
+            stages = {"fabric": admin_index, "credentials": credentials_sec}
+
             new_admin_ctrl.name = all_names.pop(0)
             client_list.append(new_admin_ctrl)
-            await CommissioningBuildingBlocks.AddNOCForNewFabricFromExisting(
-                commissionerDevCtrl=dev_ctrl,
-                newFabricDevCtrl=new_admin_ctrl,
-                existingNodeId=self.dut_node_id,
-                newNodeId=self.dut_node_id
-            )
 
-            if num_controllers_per_fabric > 1:
-                new_controllers = await CommissioningBuildingBlocks.CreateControllersOnFabric(
-                    fabricAdmin=new_fabric_admin,
-                    adminDevCtrl=new_admin_ctrl,
-                    controllerNodeIds=node_ids,
-                    privilege=Clusters.AccessControl.Enums.AccessControlEntryPrivilegeEnum.kAdminister,
-                    targetNodeId=self.dut_node_id
-                )
-                for controller in new_controllers:
-                    controller.name = all_names.pop(0)
+            device_steps = asyncio.ensure_future(self.provision_fabric_on_dut(
+                dev_ctrl, new_fabric_admin, new_admin_ctrl, node_ids, stages))
+            try:
+                if admin_index < num_fabrics_to_commission:
+                    # Let the NOC exchange send its first request before the loop is busy
+                    await asyncio.sleep(0)
+                    credentials = self.new_fabric_credentials(dev_ctrl.nodeId)
+            finally:
+                new_controllers = await device_steps
 
-                client_list.extend(new_controllers)
+            for controller in new_controllers:
+                controller.name = all_names.pop(0)
+            client_list.extend(new_controllers)
+
+            logging.info("Fabric %d set up: %s" % (admin_index, ", ".join(
+                "%s %.3fs" % (stage, duration) for stage, duration in stages.items() if stage != "fabric")))
+            fabric_setup_sec.append(stages)
+
+        self.record_data({"fabric_setup_sec": fabric_setup_sec})
 
         asserts.assert_equal(len(client_list), num_fabrics_to_commission *
                              num_controllers_per_fabric, "Must have the right number of clients")
@@ -187,85 +340,61 @@ class TC_SC_3_6(MatterBaseTest):
         await client_list[0].WriteAttribute(self.dut_node_id,
                                             [(0, Clusters.BasicInformation.Attributes.NodeLabel(value=BEFORE_LABEL))])
 
-        # Subscribe with all clients to NodeLabel attribute
-        sub_handlers = []
-        resub_catchers = []
-        output_queue = queue.Queue()
-
-        logging.info("Step 1 (first part): Establish subscription with all %d clients" % len(client_list))
-        for sub_idx, client in enumerate(client_list):
-            logging.info("Establishing subscription %d/%d from controller node %s" % (sub_idx + 1, len(client_list), client.name))
-
-            sub = await client.ReadAttribute(
-                nodeid=self.dut_node_id,
-                attributes=[(0, Clusters.BasicInformation.Attributes.NodeLabel)],
-                reportInterval=(min_report_interval_sec, max_report_interval_sec),
-                keepSubscriptions=False
-            )
-            self._subscriptions.append(sub)
-
-            attribute_handler = AttributeChangeAccumulator(
-                name=client.name, expected_attribute=Clusters.BasicInformation.Attributes.NodeLabel, output=output_queue)
-            sub.SetAttributeUpdateCallback(attribute_handler)
-            sub_handlers.append(attribute_handler)
+        if stress_mode:
+            await self.run_stress(client_list, num_controllers_per_fabric,
+                                  report_interval=(min_report_interval_sec, max_report_interval_sec),
+                                  max_parallel_subscriptions=max_parallel_subscriptions)
+            return
 
-            # TODO: Replace resubscription catcher with API to disable re-subscription on failure
-            resub_catcher = ResubscriptionCatcher(name=client.name)
-            sub.SetResubscriptionAttemptedCallback(resub_catcher)
-            resub_catchers.append(resub_catcher)
+        # Subscribe with all clients to NodeLabel attribute
+        node_label = Clusters.BasicInformation.Attributes.NodeLabel
+        accumulator = SubscriptionAccumulator()
+
+        logging.info("Step 1 (first part): Establish subscription with all %d clients, %d at a time" %
+                     (len(client_list), max_parallel_subscriptions))
+        subscriptions = await self.subscribe_all(client_list,
+                                                 attribute_path=(0, node_label),
+                                                 report_interval=(min_report_interval_sec, max_report_interval_sec),
+                                                 max_parallel_subscriptions=max_parallel_subscriptions)
+
+        # Callbacks are wired in client order so that their registration does not depend on completion order
+        subscribe_latency_sec = {}
+        for client, (sub, latency_sec) in zip(client_list, subscriptions):
+            logging.info("Subscription from client %s established in %.3fs" % (client.name, latency_sec))
+            subscribe_latency_sec[client.name] = latency_sec
+            # TODO: Replace resubscription tracking with API to disable re-subscription on failure
+            accumulator.attach(client.name, sub, [node_label])
 
         asserts.assert_equal(len(self._subscriptions), len(client_list), "Must have the right number of subscriptions")
+        logging.info("Slowest subscription took %.3fs" % max(subscribe_latency_sec.values()))
+        self.record_data({"subscribe_latency_sec": subscribe_latency_sec})
 
         # Trigger a change on NodeLabel
         logging.info(
             "Step 1 (second part): Change attribute with one client, await all attributes changed within time")
-        await asyncio.sleep(1)
-        await client_list[0].WriteAttribute(self.dut_node_id,
-                                            [(0, Clusters.BasicInformation.Attributes.NodeLabel(value=AFTER_LABEL))])
+        saw_after_label = AllClientsSawValue([client.name for client in client_list], endpoint=0,
+                                             attribute=node_label, value=AFTER_LABEL, since=time.monotonic())
+        await client_list[0].WriteAttribute(self.dut_node_id, [(0, node_label(value=AFTER_LABEL))])
 
-        all_changes = {client.name: False for client in client_list}
-
-        # Await a stabilization delay in increments to let the event loops run
-        start_time = time.time()
-        elapsed = 0
-        time_remaining = timeout_delay_sec
-
-        while time_remaining > 0:
-            try:
-                item = output_queue.get(block=True, timeout=time_remaining)
-                client_name, endpoint, attribute, value = item['name'], item['endpoint'], item['attribute'], item['value']
-
-                # Record arrival of an expected subscription change when seen
-                if endpoint == 0 and attribute == Clusters.BasicInformation.Attributes.NodeLabel and value == AFTER_LABEL:
-                    if not all_changes[client_name]:
-                        logging.info("Got expected attribute change for client %s" % client_name)
-                        all_changes[client_name] = True
-
-                # We are done waiting when we have accumulated all results
-                if all(all_changes.values()):
-                    logging.info("All clients have reported, done waiting.")
-                    break
-            except queue.Empty:
-                # No error, we update timeouts and keep going
-                pass
-
-            elapsed = time.time() - start_time
-            time_remaining = timeout_delay_sec - elapsed
+        # Reports are awaited without blocking the event loop, the wait ends as soon as all clients reported
+        if await accumulator.wait_for(saw_after_label, timeout_delay_sec):
+            logging.info("All clients have reported, done waiting.")
+        self.record_data({"report_latency_sec": saw_after_label.latency_sec})
 
         logging.info("Validation of results")
         failed = False
 
-        for catcher in resub_catchers:
-            if catcher.caught_resubscription:
-                logging.error("Client %s saw a resubscription" % catcher.name)
+        for client in client_list:
+            if accumulator.resubscription_count(client.name):
+                logging.error("Client %s saw a resubscription" % client.name)
                 failed = True
             else:
-                logging.info("Client %s correctly did not see a resubscription" % catcher.name)
+                logging.info("Client %s correctly did not see a resubscription" % client.name)
 
-        all_reports_gotten = all(all_changes.values())
-        if not all_reports_gotten:
+        missing_reports = saw_after_label.pending
+        if missing_reports:
             logging.error("Missing reports from the following clients: %s" %
-                          ", ".join([name for name, value in all_changes.items() if value is False]))
+                          ", ".join([client.name for client in client_list if client.name in missing_reports]))
             failed = True
         else:
             logging.info("Got successful reports from all clients, meaning all concurrent CASE sessions worked")
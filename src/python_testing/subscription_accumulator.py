@@ -0,0 +1,243 @@
+#
+#    Copyright (c) 2024 Project CHIP Authors
+#    All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+
+"""
+Shared accumulator of the attribute reports and resubscriptions of many
+client subscriptions, with awaitable predicates evaluated as reports arrive.
+
+Typical use in an async test:
+
+    accumulator = SubscriptionAccumulator()
+    for client, sub in zip(clients, subscriptions):
+        accumulator.attach(client.name, sub, [Clusters.BasicInformation.Attributes.NodeLabel])
+
+    write_time = time.monotonic()
+    await client.WriteAttribute(...)
+    saw_value = AllClientsSawValue([client.name for client in clients], endpoint=0,
+                                   attribute=Clusters.BasicInformation.Attributes.NodeLabel, value=label,
+                                   since=write_time)
+    if not await accumulator.wait_for(saw_value, timeout_sec):
+        logging.error("Missing reports from %s" % saw_value.pending)
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+# (client name, endpoint id, cluster id, attribute id)
+ReportKey = Tuple[str, int, int, int]
+
+DEFAULT_HISTORY_LIMIT = 16
+
+
+def attribute_ids(attribute) -> Tuple[int, int]:
+    """(cluster id, attribute id) of a ClusterAttributeDescriptor class."""
+    return attribute.cluster_id, attribute.attribute_id
+
+
+class ReportPredicate:
+    """
+    Condition over the reports and resubscriptions of an accumulator. It is
+    seeded once with the accumulator's current state, then updated with every
+    new event until it is satisfied.
+    """
+
+    def seed(self, accumulator: 'SubscriptionAccumulator') -> bool:
+        return False
+
+    def on_report(self, key: ReportKey, value: Any, arrival_time: float) -> bool:
+        return False
+
+    def on_resubscription(self, client_name: str) -> bool:
+        return False
+
+
+class AllClientsSawValue(ReportPredicate):
+    """
+    Satisfied once every client reported `value` for an attribute, at or after
+    `since`. The latency of each client's report from `since` is recorded.
+    """
+
+    def __init__(self, client_names: Iterable[str], endpoint: int, attribute, value: Any,
+                 since: Optional[float] = None):
+        self._cluster_id, self._attribute_id = attribute_ids(attribute)
+        self._endpoint = endpoint
+        self._value = value
+        self._since = time.monotonic() if since is None else since
+        self._pending = set(client_names)
+        self.latency_sec: Dict[str, float] = {}
+
+    @property
+    def pending(self) -> set:
+        return set(self._pending)
+
+    def seed(self, accumulator: 'SubscriptionAccumulator') -> bool:
+        for client_name in list(self._pending):
+            latest = accumulator.latest(client_name, self._endpoint, (self._cluster_id, self._attribute_id))
+            if latest is not None:
+                self.on_report((client_name, self._endpoint, self._cluster_id, self._attribute_id), latest[1], latest[0])
+        return not self._pending
+
+    def on_report(self, key: ReportKey, value: Any, arrival_time: float) -> bool:
+        client_name, endpoint, cluster_id, attribute_id = key
+        if client_name in self._pending and endpoint == self._endpoint and cluster_id == self._cluster_id and \
+                attribute_id == self._attribute_id and value == self._value and arrival_time >= self._since:
+            self._pending.discard(client_name)
+            self.latency_sec[client_name] = arrival_time - self._since
+        return not self._pending
+
+
+class AnyClientResubscribed(ReportPredicate):
+    """
+    Satisfied as soon as any of the given clients, or any client when none
+    are given, attempted a resubscription.
+    """
+
+    def __init__(self, client_names: Optional[Iterable[str]] = None):
+        self._client_names = None if client_names is None else set(client_names)
+        self.client_name: Optional[str] = None
+
+    def seed(self, accumulator: 'SubscriptionAccumulator') -> bool:
+        for client_name, count in accumulator.resubscription_counts.items():
+            if count and self.on_resubscription(client_name):
+                return True
+        return False
+
+    def on_resubscription(self, client_name: str) -> bool:
+        if self._client_names is None or client_name in self._client_names:
+            self.client_name = client_name
+            return True
+        return False
+
+
+class SubscriptionAccumulator:
+    """
+    Accumulates the attribute reports of many client subscriptions.
+
+    Reports are indexed by (client, endpoint, cluster, attribute). For every key
+    the last `history_limit` values are kept with their arrival time. Subscription
+    callbacks run on the Matter thread; they only timestamp the event and hand it
+    to the event loop, where the state and the waiting predicates are updated.
+    """
+
+    def __init__(self, history_limit: int = DEFAULT_HISTORY_LIMIT, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._history_limit = history_limit
+        self._loop = loop or asyncio.get_running_loop()
+        self._history: Dict[ReportKey, Deque[Tuple[float, Any]]] = {}
+        self._resubscriptions: Dict[str, int] = {}
+        self._waiters: List[Tuple[ReportPredicate, asyncio.Future]] = []
+
+    def attach(self, client_name: str, subscription, attributes: Optional[Iterable] = None) -> None:
+        """
+        Registers the report and resubscription callbacks of a subscription.
+
+        Parameters:
+
+        client_name:
+         Name the reports of this subscription are indexed under
+
+        subscription:
+         SubscriptionTransaction returned by ReadAttribute
+
+        attributes:
+         ClusterAttributeDescriptor classes to accumulate, all attributes when None
+        """
+        subscription.SetAttributeUpdateCallback(self.attribute_callback(client_name, attributes))
+        subscription.SetResubscriptionAttemptedCallback(self.resubscription_callback(client_name))
+        self._resubscriptions.setdefault(client_name, 0)
+
+    def attribute_callback(self, client_name: str, attributes: Optional[Iterable] = None) -> Callable:
+        wanted = None if attributes is None else {attribute_ids(attribute) for attribute in attributes}
+
+        def on_attribute_update(path, transaction):
+            if wanted is not None and (path.Path.ClusterId, path.Path.AttributeId) not in wanted:
+                return
+            arrival_time = time.monotonic()
+            value = transaction.GetAttribute(path)
+            logging.info("Got subscription report on client %s for %s: %s" % (client_name, path.AttributeType, value))
+            key = (client_name, path.Path.EndpointId, path.Path.ClusterId, path.Path.AttributeId)
+            self._loop.call_soon_threadsafe(self.__record_report__, key, value, arrival_time)
+
+        return on_attribute_update
+
+    def resubscription_callback(self, client_name: str) -> Callable:
+        def on_resubscription_attempted(transaction, termination_error, next_resubscribe_interval_msec):
+            logging.info("Got resubscription on client %s" % client_name)
+            self._loop.call_soon_threadsafe(self.__record_resubscription__, client_name)
+
+        return on_resubscription_attempted
+
+    def __record_report__(self, key: ReportKey, value: Any, arrival_time: float) -> None:
+        history = self._history.get(key)
+        if history is None:
+            history = self._history[key] = collections.deque(maxlen=self._history_limit)
+        history.append((arrival_time, value))
+        self.__notify__(lambda predicate: predicate.on_report(key, value, arrival_time))
+
+    def __record_resubscription__(self, client_name: str) -> None:
+        self._resubscriptions[client_name] = self._resubscriptions.get(client_name, 0) + 1
+        self.__notify__(lambda predicate: predicate.on_resubscription(client_name))
+
+    def __notify__(self, update: Callable[[ReportPredicate], bool]) -> None:
+        remaining = []
+        for predicate, future in self._waiters:
+            if future.done():
+                continue
+            if update(predicate):
+                future.set_result(True)
+            else:
+                remaining.append((predicate, future))
+        self._waiters = remaining
+
+    async def wait_for(self, predicate: ReportPredicate, timeout_sec: float) -> bool:
+        """
+        Waits until the predicate holds. Returns False if timeout_sec elapsed first,
+        the predicate then tells what was still missing.
+        """
+        if predicate.seed(self):
+            return True
+
+        future = self._loop.create_future()
+        self._waiters.append((predicate, future))
+        try:
+            await asyncio.wait_for(future, timeout_sec)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def history(self, client_name: str, endpoint: int, attribute) -> List[Tuple[float, Any]]:
+        """
+        Retained (arrival time, value) reports of an attribute, oldest first.
+        `attribute` is a ClusterAttributeDescriptor class or a (cluster id, attribute id) pair.
+        """
+        cluster_id, attribute_id = attribute if isinstance(attribute, tuple) else attribute_ids(attribute)
+        return list(self._history.get((client_name, endpoint, cluster_id, attribute_id), ()))
+
+    def latest(self, client_name: str, endpoint: int, attribute) -> Optional[Tuple[float, Any]]:
+        history = self.history(client_name, endpoint, attribute)
+        return history[-1] if history else None
+
+    @property
+    def resubscription_counts(self) -> Dict[str, int]:
+        return dict(self._resubscriptions)
+
+    def resubscription_count(self, client_name: Optional[str] = None) -> int:
+        if client_name is None:
+            return sum(self._resubscriptions.values())
+        return self._resubscriptions.get(client_name, 0)
@@ -0,0 +1,134 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+from subscription_accumulator import AllClientsSawValue, AnyClientResubscribed, SubscriptionAccumulator
+
+
+class NodeLabel:
+    cluster_id = 0x0028
+    attribute_id = 0x0005
+
+
+class Location:
+    cluster_id = 0x0028
+    attribute_id = 0x0006
+
+
+class FakeSubscription:
+
+    def SetAttributeUpdateCallback(self, callback):
+        self.attribute_callback = callback
+
+    def SetResubscriptionAttemptedCallback(self, callback):
+        self.resubscription_callback = callback
+
+    def report(self, attribute, value, endpoint: int = 0):
+        path = SimpleNamespace(Path=SimpleNamespace(EndpointId=endpoint, ClusterId=attribute.cluster_id,
+                                                    AttributeId=attribute.attribute_id),
+                               AttributeType=attribute)
+        self.attribute_callback(path, SimpleNamespace(GetAttribute=lambda _: value))
+
+    def resubscribe(self):
+        self.resubscription_callback(None, None, 0)
+
+
+async def settle():
+    # Callbacks hand their events to the loop with call_soon_threadsafe
+    await asyncio.sleep(0)
+
+
+class TestSubscriptionAccumulator(unittest.TestCase):
+
+    def attach(self, accumulator: SubscriptionAccumulator, *client_names: str):
+        subscriptions = {name: FakeSubscription() for name in client_names}
+        for name, subscription in subscriptions.items():
+            accumulator.attach(name, subscription, [NodeLabel])
+        return subscriptions
+
+    def test_history_is_bounded(self):
+        async def run():
+            accumulator = SubscriptionAccumulator(history_limit=3)
+            subs = self.attach(accumulator, "a")
+            for value in range(5):
+                subs["a"].report(NodeLabel, f"label{value}")
+            subs["a"].report(Location, "XX")
+            await settle()
+
+            self.assertEqual([value for _, value in accumulator.history("a", 0, NodeLabel)],
+                             ["label2", "label3", "label4"])
+            self.assertEqual(accumulator.latest("a", 0, NodeLabel)[1], "label4")
+            # Attributes not asked for in attach() are not accumulated
+            self.assertIsNone(accumulator.latest("a", 0, Location))
+
+        asyncio.run(run())
+
+    def test_seeded_from_existing_reports(self):
+        async def run():
+            accumulator = SubscriptionAccumulator()
+            subs = self.attach(accumulator, "a", "b")
+            since = time.monotonic()
+            subs["a"].report(NodeLabel, "new")
+            subs["b"].report(NodeLabel, "new")
+            subs["b"].resubscribe()
+            await settle()
+
+            saw_value = AllClientsSawValue(["a", "b"], endpoint=0, attribute=NodeLabel, value="new", since=since)
+            self.assertTrue(await accumulator.wait_for(saw_value, 0.01))
+            self.assertEqual(set(saw_value.latency_sec), {"a", "b"})
+
+            resubscribed = AnyClientResubscribed()
+            self.assertTrue(await accumulator.wait_for(resubscribed, 0.01))
+            self.assertEqual(resubscribed.client_name, "b")
+
+        asyncio.run(run())
+
+    def test_since_filters_earlier_reports(self):
+        async def run():
+            accumulator = SubscriptionAccumulator()
+            subs = self.attach(accumulator, "a")
+            subs["a"].report(NodeLabel, "new")
+            await settle()
+
+            saw_value = AllClientsSawValue(["a"], endpoint=0, attribute=NodeLabel, value="new")
+            waiter = asyncio.ensure_future(accumulator.wait_for(saw_value, 5))
+            await settle()
+            self.assertFalse(waiter.done())
+            self.assertEqual(saw_value.pending, {"a"})
+
+            subs["a"].report(NodeLabel, "other")
+            subs["a"].report(NodeLabel, "new", endpoint=1)
+            await settle()
+            self.assertFalse(waiter.done())
+
+            subs["a"].report(NodeLabel, "new")
+            self.assertTrue(await waiter)
+            self.assertEqual(saw_value.pending, set())
+
+        asyncio.run(run())
+
+    def test_timeouts_leave_pending(self):
+        async def run():
+            accumulator = SubscriptionAccumulator()
+            subs = self.attach(accumulator, "a", "b")
+            saw_value = AllClientsSawValue(["a", "b"], endpoint=0, attribute=NodeLabel, value="new")
+            waiter = asyncio.ensure_future(accumulator.wait_for(saw_value, 0.05))
+            await settle()
+            subs["a"].report(NodeLabel, "new")
+            self.assertFalse(await waiter)
+            self.assertEqual(saw_value.pending, {"b"})
+
+            subs["b"].resubscribe()
+            await settle()
+            resubscribed = AnyClientResubscribed(["a"])
+            self.assertFalse(await accumulator.wait_for(resubscribed, 0.05))
+            self.assertIsNone(resubscribed.client_name)
+            self.assertEqual(accumulator.resubscription_count(), 1)
+            self.assertEqual(accumulator.resubscription_count("a"), 0)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import io
+import unittest
+
+from app_pool import AppPool
+
+
+class TestAppPool(unittest.TestCase):
+
+    def test_recycled_app_is_not_reused(self):
+        pool = AppPool()
+        command = ["/bin/sh", "-c", "trap 'exit 0' INT; while true; do sleep 0.05; done"]
+        try:
+            first = pool.acquire(command, None, io.BytesIO())
+            pool.release(first, recycle=True)
+            self.assertFalse(first.alive)
+
+            second = pool.acquire(command, None, io.BytesIO())
+            self.assertNotEqual(second.pid, first.pid)
+            self.assertEqual(pool.release(second), 0)
+            self.assertTrue(second.alive)
+        finally:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import asyncio
+import io
+import socket
+import subprocess
+import sys
+import typing
+import unittest
+
+from app_readiness import AppReadinessError, ReadinessWatcher, wait_until_ready
+from log_pump import LogPump
+
+
+class TestAppReadiness(unittest.TestCase):
+
+    def run_app(self, code: str, watcher: typing.Optional[ReadinessWatcher], timeout: float,
+                port: typing.Optional[int] = None) -> float:
+        pump = LogPump()
+        process = subprocess.Popen([sys.executable, "-u", "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        streams = pump.add_process("APP", process, io.BytesIO(), watcher)
+        try:
+            return asyncio.run(wait_until_ready(process, timeout, watcher, port))
+        finally:
+            process.kill()
+            process.wait()
+            for stream in streams:
+                stream.done.wait(5)
+            pump.close()
+
+    def test_ready_pattern(self):
+        waited = self.run_app("import time; time.sleep(0.2); print('Server Listening...'); time.sleep(10)",
+                              ReadinessWatcher("Server Listening"), timeout=10)
+        self.assertGreaterEqual(waited, 0.1)
+        self.assertLess(waited, 5)
+
+    def test_ready_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        code = ("import socket, time; time.sleep(0.2); s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); "
+                f"s.bind(('127.0.0.1', {port})); time.sleep(10)")
+        waited = self.run_app(code, None, timeout=10, port=port)
+        self.assertGreaterEqual(waited, 0.1)
+        self.assertLess(waited, 5)
+
+    def test_app_exits_before_ready(self):
+        with self.assertRaisesRegex(AppReadinessError, "exited with code 3"):
+            self.run_app("import sys; sys.exit(3)", ReadinessWatcher("Server Listening"), timeout=10)
+
+    def test_deadline(self):
+        with self.assertRaisesRegex(AppReadinessError, "not ready after"):
+            self.run_app("import time; time.sleep(10)", ReadinessWatcher("Server Listening"), timeout=0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
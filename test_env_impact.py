@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from env_impact import select_affected_runs
+from metadata import MetadataReader
+
+
+class TestEnvImpact(unittest.TestCase):
+
+    test_file_content = ''' 
+    # test-runner-runs: run1 
+    # test-runner-run/run1/app: ${ALL_CLUSTERS_APP}
+    # test-runner-run/run1/app-args: --discriminator 1234 --trace-to json:${TRACE_APP}.json
+    # test-runner-run/run1/script-args: --commissioning-method on-network --trace-to json:${TRACE_TEST_JSON}.json --trace-to perfetto:${TRACE_TEST_PERFETTO}.perfetto
+    # test-runner-run/run1/factoryreset: True
+    '''
+
+    env_file_content = '''
+    ALL_CLUSTERS_APP: out/linux-x64-all-clusters-ipv6only-no-ble-no-wifi-tsan-clang-test/chip-all-clusters-app
+    CHIP_LOCK_APP: out/linux-x64-lock-ipv6only-no-ble-no-wifi-tsan-clang-test/chip-lock-app
+    ENERGY_MANAGEMENT_APP: out/linux-x64-energy-management-ipv6only-no-ble-no-wifi-tsan-clang-test/chip-energy-management-app
+    TRACE_APP: out/trace_data/app-{SCRIPT_BASE_NAME}
+    TRACE_TEST_JSON: out/trace_data/test-{SCRIPT_BASE_NAME}
+    TRACE_TEST_PERFETTO: out/trace_data/test-{SCRIPT_BASE_NAME}
+    '''
+
+    def generate_temp_file(self, directory: str, file_content: str) -> str:
+        fd, temp_file_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(file_content)
+        return temp_file_path
+
+    def test_env_impact(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            old_env = self.generate_temp_file(temp_dir, self.env_file_content)
+            new_env = self.generate_temp_file(temp_dir, self.env_file_content.replace(
+                "chip-all-clusters-app", "chip-all-clusters-app-v2").replace(
+                "CHIP_LOCK_APP: out/linux-x64-lock", "CHIP_LOCK_APP: out/linux-x64-lock-v2"))
+            with open(os.path.join(temp_dir, "TC_ALL.py"), 'w') as fp:
+                fp.write("# test-runner-run/undeclared/app: ${ALL_CLUSTERS_APP}\n" + self.test_file_content)
+            with open(os.path.join(temp_dir, "TC_ENERGY.py"), 'w') as fp:
+                fp.write(self.test_file_content.replace("ALL_CLUSTERS_APP", "ENERGY_MANAGEMENT_APP"))
+            with open(os.path.join(temp_dir, "TC_BOARD.py"), 'w') as fp:
+                fp.write(self.test_file_content.replace("${ALL_CLUSTERS_APP}", "${TRACE_${BOARD:-APP}}"))
+
+            new_reader = MetadataReader(new_env)
+            runs, changed = select_affected_runs([temp_dir], MetadataReader(old_env), new_reader)
+
+            self.assertEqual(changed, {"ALL_CLUSTERS_APP", "CHIP_LOCK_APP"})
+            self.assertEqual([os.path.basename(run.py_script_path) for run in runs], ["TC_ALL.py"])
+            self.assertTrue(runs[0].app.endswith("chip-all-clusters-app-v2"))
+            # Indexing the directives does not report them a second time
+            self.assertEqual([diagnostic.line_number for diagnostic in new_reader.diagnostics], [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from log_archive import INDEX_SUFFIX, LogArchive, LogArchiveWriter
+
+
+class TestLogArchive(unittest.TestCase):
+
+    def test_archive_queries(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive_path = os.path.join(temp_dir, "TC_A-run1.log")
+            with LogArchiveWriter(archive_path, block_size=256) as writer:
+                for i in range(100):
+                    writer.append_lines("APP/STDOUT", [f"[{1646290000 + i:.6f}] app line {i}\n".encode()])
+                    if i == 60:
+                        writer.append_lines("TEST/STDERR", [f"[{1646290000 + i:.6f}] ERROR test failed\n".encode()])
+
+            archive = LogArchive(archive_path)
+            self.assertGreater(len(archive.blocks), 10)
+
+            records = list(archive.records(start=1646290010, end=1646290012))
+            self.assertEqual([record.line for record in records],
+                             [b"[1646290010.000000] app line 10", b"[1646290011.000000] app line 11", b"[1646290012.000000] app line 12"])
+
+            self.assertEqual([record.line for record in archive.records(streams=["TEST/STDERR"])],
+                             [b"[1646290060.000000] ERROR test failed"])
+
+            around = archive.around_first_error(3)
+            self.assertEqual(len(around), 7)
+            self.assertTrue(around[3].error)
+            self.assertEqual(around[0].line, b"[1646290058.000000] app line 58")
+            self.assertEqual(around[-1].line, b"[1646290063.000000] app line 63")
+
+            # Records past the last index entry are still found
+            with open(archive_path + INDEX_SUFFIX, 'r+b') as index:
+                index.truncate(os.path.getsize(archive_path + INDEX_SUFFIX) - 10)
+            self.assertEqual(len(list(LogArchive(archive_path).records())), 101)
+
+    def test_unique_archive_names(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with LogArchiveWriter.create_unique(temp_dir, "TC_A-run1") as first, \
+                    LogArchiveWriter.create_unique(temp_dir, "TC_A-run1") as second:
+                self.assertEqual(os.path.basename(first.archive_path), "TC_A-run1.log")
+                self.assertEqual(os.path.basename(second.archive_path), "TC_A-run1-1.log")
+
+
+if __name__ == "__main__":
+    unittest.main()
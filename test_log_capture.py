@@ -0,0 +1,26 @@
+import io
+import unittest
+
+from log_capture import BoundedCapture
+
+
+class TestBoundedCapture(unittest.TestCase):
+
+    def test_spill_and_replay(self):
+        capture = BoundedCapture(memory_limit=100)
+        data = [f"line {i}\n".encode() for i in range(100)]
+        for line in data:
+            capture.write(line)
+
+        self.assertEqual(capture.size, sum(len(line) for line in data))
+        self.assertGreater(capture.spilled_size, 0)
+        self.assertLessEqual(capture.size - capture.spilled_size, 100)
+
+        output = io.BytesIO()
+        capture.replay(output)
+        self.assertEqual(output.getvalue(), b''.join(data))
+        capture.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
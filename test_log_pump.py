@@ -0,0 +1,56 @@
+import datetime
+import io
+import os
+import unittest
+
+from log_pump import LogPump, TimestampFormatter
+
+
+class TestLogPump(unittest.TestCase):
+
+    def test_timestamp_formatter(self):
+        formatter = TimestampFormatter()
+        for timestamp in (1646290606.901990, 1646290606.0, 1646290607.5, 1646290606.25):
+            expected = f"[{datetime.datetime.fromtimestamp(timestamp).isoformat(sep=' ')}]".encode()
+            self.assertEqual(formatter.format(timestamp), expected)
+
+    def test_pump_lines(self):
+        pump = LogPump(chunk_size=7)
+        output = io.BytesIO()
+
+        pipes = [os.pipe(), os.pipe()]
+        streams = [pump.add(os.fdopen(read_fd, 'rb', buffering=0), tag, output)
+                   for (read_fd, _), tag in zip(pipes, (b"[A]", b"[B]"))]
+
+        os.write(pipes[0][1], b"[1646290606.901990] first line\nsecond")
+        os.close(pipes[0][1])
+        os.write(pipes[1][1], b"other\n")
+        os.close(pipes[1][1])
+
+        for stream in streams:
+            self.assertTrue(stream.done.wait(5))
+        pump.close()
+
+        lines = output.getvalue().split(b'\n')
+        chip_timestamp = datetime.datetime.fromtimestamp(1646290606.901990).isoformat(sep=' ')
+        self.assertIn(f"[{chip_timestamp}][A] first line".encode(), lines)
+        # The unterminated last line of a pipe may be followed by the output of another one
+        self.assertIn(b"[A]second", output.getvalue())
+        self.assertTrue(any(line.endswith(b"[B]other") for line in lines))
+
+    def test_failing_output(self):
+        pump = LogPump()
+        output = io.BytesIO()
+        output.close()
+
+        read_fd, write_fd = os.pipe()
+        stream = pump.add(os.fdopen(read_fd, 'rb', buffering=0), b"[A]", output)
+        with self.assertLogs(level='ERROR'):
+            os.write(write_fd, b"line\n")
+            self.assertTrue(stream.done.wait(5))
+        os.close(write_fd)
+        pump.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
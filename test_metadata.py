@@ -3,8 +3,9 @@ import unittest
 from os import path
 import tempfile
 from typing import List
+from unittest import mock
 
-from metadata import Metadata, MetadataReader  # Assumed to be existing modules
+from metadata import EnvSubstitution, EnvTemplate, Metadata, MetadataReader, fill_placeholders, read_manifest, write_manifest  # Assumed to be existing modules
 from test_runner import TestRunner  # Assumed to be existing modules
 
 
@@ -42,17 +43,158 @@ class TestMetadataReader(unittest.TestCase):
             runner = TestRunner(env_file)
             self.maxDiff = None
             
+            base_name = path.splitext(path.basename(temp_file))[0]
             test_file_expected_arg_string = (
                 "scripts/run_in_python_env.sh out/venv './scripts/tests/run_python_test.py "
                 "--app out/linux-x64-all-clusters-ipv6only-no-ble-no-wifi-tsan-clang-test/chip-all-clusters-app "
-                "--factoryreset --app-args \"--discriminator 1234 --trace-to json:out/trace_data/app-{SCRIPT_BASE_NAME}.json\" "
+                "--factoryreset --quiet --app-args \"--discriminator 1234 --trace-to json:out/trace_data/app-" + base_name + ".json\" "
                 "--script \"" + temp_file + "\" --script-args \"--commissioning-method on-network "
-                "--trace-to json:out/trace_data/test-{SCRIPT_BASE_NAME}.json --trace-to perfetto:out/trace_data/test-{SCRIPT_BASE_NAME}.perfetto\"'"
+                "--trace-to json:out/trace_data/test-" + base_name + ".json "
+                "--trace-to perfetto:out/trace_data/test-" + base_name + ".perfetto\"'"
             )
 
             actual = runner.generate_run_commands(temp_file)[0]
             self.assertEqual(test_file_expected_arg_string, actual)
 
+    def test_metadata_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = self.generate_temp_file(temp_dir, self.test_file_content)
+            env_file = self.generate_temp_file(temp_dir, self.env_file_content)
+            index_path = os.path.join(temp_dir, "index.json")
+
+            reader = MetadataReader(env_file, index_path)
+            expected = reader.parse_script(temp_file)
+            reader.save_index()
+
+            # A fresh reader must answer from the index without parsing the script
+            reader = MetadataReader(env_file, index_path)
+            with mock.patch.object(MetadataReader, '__parse_script_file__') as parse:
+                self.assertEqual(reader.parse_script(temp_file), expected)
+                parse.assert_not_called()
+
+            # Touching the script without changing it keeps the entry valid
+            os.utime(temp_file, ns=(0, 0))
+            with mock.patch.object(MetadataReader, '__parse_script_file__') as parse:
+                self.assertEqual(reader.parse_script(temp_file), expected)
+                parse.assert_not_called()
+
+            # Changing the script or the environment invalidates the entry
+            with open(temp_file, 'a') as fp:
+                fp.write("# test-runner-run/run1/script-args: --storage-path admin_storage.json\n")
+            self.assertEqual(reader.parse_script(temp_file)[0].script_args, "--storage-path admin_storage.json")
+
+            with open(env_file, 'w') as fp:
+                fp.write(self.env_file_content.replace("out/linux-x64-all-clusters-ipv6only-no-ble-no-wifi-tsan-clang-test/", ""))
+            reader = MetadataReader(env_file, index_path)
+            self.assertEqual(reader.parse_script(temp_file)[0].app, "chip-all-clusters-app")
+
+    def test_header_only_parse(self):
+        script_content = (
+            "# test-runner-runs: run1\n"
+            "# test-runner-run/run1/app: ${ALL_CLUSTERS_APP}\n"
+            "# test-runner-run/run1/factoryreset: False\n"
+            "# test-runner-run/run2/app: ${CHIP_LOCK_APP}\n"
+            "# test-runner-run/run 1/app: ${CHIP_LOCK_APP}\n"
+            "\n"
+            "#    Copyright (c) 2022 Project CHIP Authors\n"
+            "\n"
+            "import asyncio\n"
+            "# test-runner-run/run1/quiet: False\n"
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = self.generate_temp_file(temp_dir, script_content)
+            env_file = self.generate_temp_file(temp_dir, self.env_file_content)
+
+            reader = MetadataReader(env_file)
+            with self.assertLogs(level='WARNING'):
+                runs = reader.parse_script(temp_file)
+
+            self.assertEqual(len(runs), 1)
+            self.assertFalse(runs[0].factoryreset)
+            self.assertTrue(runs[0].quiet)
+            self.assertEqual([d.line_number for d in reader.diagnostics], [4, 5])
+
+            # Directives after the header are only read when asked for
+            with self.assertLogs(level='WARNING'):
+                runs = reader.parse_script(temp_file, header_only=False)
+            self.assertFalse(runs[0].quiet)
+
+            # Diagnostics are replayed when the runs come from the index
+            index_path = os.path.join(temp_dir, "index.json")
+            reader = MetadataReader(env_file, index_path)
+            with self.assertLogs(level='WARNING'):
+                reader.parse_script(temp_file)
+            reader.save_index()
+            reader = MetadataReader(env_file, index_path)
+            with mock.patch.object(MetadataReader, '__parse_script_file__') as parse, self.assertLogs(level='WARNING'):
+                reader.parse_script(temp_file)
+                parse.assert_not_called()
+            self.assertEqual([d.line_number for d in reader.diagnostics], [4, 5])
+
+    def test_env_substitution(self):
+        substitution = EnvSubstitution({"BOARD": "linux", "APP_linux": "chip-app", "PORT": 5540})
+
+        self.assertEqual(substitution.resolve("--port ${PORT}"), "--port 5540")
+        self.assertEqual(substitution.resolve("${APP_${BOARD}}"), "chip-app")
+        self.assertEqual(substitution.resolve("${MISSING:-${BOARD}-default}"), "linux-default")
+        self.assertEqual(substitution.resolve("${MISSING} ${UNTERMINATED"), "${MISSING} ${UNTERMINATED")
+        self.assertEqual(substitution.resolve("${BOARD}/{SCRIPT_BASE_NAME}"), "linux/{SCRIPT_BASE_NAME}")
+        self.assertEqual(substitution.resolve("${BOARD}/{SCRIPT_BASE_NAME}", {"SCRIPT_BASE_NAME": "TC_SC_3_6"}),
+                         "linux/TC_SC_3_6")
+        self.assertEqual(substitution.resolve("${MISSING:-{SCRIPT_BASE_NAME}}", {"SCRIPT_BASE_NAME": "TC"}), "TC")
+        self.assertEqual(substitution.resolve("${APP_{SCRIPT_BASE_NAME}:-none}", {"SCRIPT_BASE_NAME": "linux"}),
+                         "chip-app")
+
+        # Resolved arguments are shared by scripts unless their placeholders change the result
+        with mock.patch.object(EnvTemplate, 'render', autospec=True, side_effect=EnvTemplate.render) as render:
+            for name in ("TC_A", "TC_B"):
+                self.assertEqual(substitution.resolve("--app ${APP_linux} --port ${PORT}", {"SCRIPT_BASE_NAME": name}),
+                                 "--app chip-app --port 5540")
+                self.assertEqual(substitution.resolve("${BOARD}/{SCRIPT_BASE_NAME}", {"SCRIPT_BASE_NAME": name}),
+                                 f"linux/{name}")
+                substitution.resolve("${BOARD}/{SCRIPT_BASE_NAME}", {"SCRIPT_BASE_NAME": name})
+        self.assertEqual(render.call_count, 3)
+
+        substitution = EnvSubstitution({"TRACE": "out/{SCRIPT_BASE_NAME}"})
+        self.assertEqual(substitution.resolve("${TRACE}.json", {"SCRIPT_BASE_NAME": "TC"}), "out/TC.json")
+        self.assertEqual(substitution.resolve("${TRACE}.json", {"SCRIPT_BASE_NAME": "TC_B"}), "out/TC_B.json")
+        self.assertEqual(fill_placeholders("${X:-y} {SCRIPT_BASE_NAME} {OTHER}", {"SCRIPT_BASE_NAME": "TC"}),
+                         "${X:-y} TC {OTHER}")
+
+    def test_parse_tree_and_manifest(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = self.generate_temp_file(temp_dir, self.env_file_content)
+            scripts_dir = os.path.join(temp_dir, "python_testing")
+            os.makedirs(scripts_dir)
+            for i in range(8):
+                with open(os.path.join(scripts_dir, f"TC_{i}.py"), 'w') as fp:
+                    fp.write(self.test_file_content)
+
+            reader = MetadataReader(env_file)
+            serial = [reader.parse_script(os.path.join(scripts_dir, f"TC_{i}.py"))[0] for i in range(8)]
+
+            index_path = os.path.join(temp_dir, "index.json")
+            reader = MetadataReader(env_file, index_path)
+            with mock.patch.object(MetadataReader, 'PARALLEL_PARSE_THRESHOLD', 0):
+                runs = reader.parse_tree(scripts_dir, processes=2)
+            self.assertEqual(runs, serial)
+            # The index is only written when asked to
+            self.assertFalse(os.path.exists(index_path))
+            reader.save_index()
+            self.assertEqual(MetadataReader(env_file, index_path).index.lookup(runs[0].py_script_path, reader.env_hash)[0],
+                             runs[:1])
+
+            manifest_path = os.path.join(temp_dir, "manifest.ndjson")
+            write_manifest(runs, manifest_path)
+            self.assertEqual(read_manifest(manifest_path), runs)
+            self.assertIn("json:out/trace_data/test-TC_0.json", runs[0].script_args)
+
+            literal = Metadata(py_script_path="TC_SC_3_6.py", run="run1", app="", app_args="",
+                               script_args="--trace-to json:{SCRIPT_BASE_NAME}.json")
+            write_manifest([literal], manifest_path)
+            self.assertEqual(read_manifest(manifest_path)[0].script_args, "--trace-to json:TC_SC_3_6.json")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from phase_timer import MetricsWriter, PhaseTimer, read_metrics, summarize
+from test_runner import TestRunner
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def test_phases_and_summary(self):
+        timer = PhaseTimer()
+        with timer.phase("app_spawn"):
+            pass
+        timer.start("script_startup")
+        timer.switch("script_startup", "script_body")
+        timer.switch("script_startup", "script_body")
+        timer.stop("script_body")
+        self.assertEqual(set(timer.phases), {"app_spawn", "script_startup", "script_body"})
+
+        records = [{"type": "run", "exit_code": i % 2, "phases": {"script_body": float(i)}} for i in range(1, 21)]
+        records.append({"type": "summary", "phases": {"script_body": 1000.0}})
+        summary = summarize(records)
+
+        self.assertEqual(summary["runs"], 20)
+        self.assertEqual(summary["failed"], 10)
+        self.assertEqual(summary["phases"]["script_body"]["p50"], 10.0)
+        self.assertEqual(summary["phases"]["script_body"]["p95"], 19.0)
+        self.assertEqual(summary["phases"]["script_body"]["max"], 20.0)
+
+    def test_batch_summary(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = os.path.join(temp_dir, "env.yaml")
+            script = os.path.join(temp_dir, "TC_A.py")
+            metrics_file = os.path.join(temp_dir, "metrics.ndjson")
+            for path, content in ((env_file, "{}\n"), (script, "# test-runner-runs: run1 run2\n")):
+                with open(path, 'w') as fp:
+                    fp.write(content)
+
+            runner = TestRunner(env_file, metrics_file=metrics_file)
+            # A concurrent batch writes to the same file while this one runs
+            other = MetricsWriter(metrics_file)
+            runner.execute_run = lambda run: other.write({"type": "scheduled_run", "batch": "other", "exit_code": 1,
+                                                          "phases": {"scheduled_total": 1.0}}) or 0
+            self.assertTrue(runner.execute_runs(runner.expand_runs([script]), False))
+
+            summary = read_metrics(metrics_file)[-1]
+            self.assertEqual(summary["type"], "summary")
+            self.assertEqual(summary["runs"], 2)
+            self.assertEqual(summary["failed"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
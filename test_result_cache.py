@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from metadata import Metadata
+from result_cache import ResultCache
+from test_runner import TestRunner
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_cached_runs_are_skipped(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = os.path.join(temp_dir, "env.yaml")
+            app = os.path.join(temp_dir, "app")
+            script = os.path.join(temp_dir, "TC_A.py")
+            for path, content in ((env_file, "APP: %s\n" % app), (app, "binary v1"),
+                                  (script, "# test-runner-runs: run1 run2\n# test-runner-run/run1/app: ${APP}\n")):
+                with open(path, 'w') as fp:
+                    fp.write(content)
+
+            executed = []
+            runner = TestRunner(env_file, result_cache=ResultCache(os.path.join(temp_dir, "cache")))
+            runner.execute_run = lambda run: executed.append(run.run) or (1 if run.run == "run2" else 0)
+
+            runs = runner.expand_runs([script])
+            self.assertFalse(runner.execute_runs(runs, False))
+            self.assertEqual(sorted(executed), ["run1", "run2"])
+
+            # Only the passing run is cached
+            executed.clear()
+            runner.execute_runs(runs, False)
+            self.assertEqual(executed, ["run2"])
+            self.assertEqual([run.run for run in runner.executed_runs], ["run2"])
+
+            # A new app binary invalidates the runs using it
+            with open(app, 'w') as fp:
+                fp.write("binary v2")
+            executed.clear()
+            runner.execute_runs(runs, False)
+            self.assertEqual(sorted(executed), ["run1", "run2"])
+
+            executed.clear()
+            runner.force_rerun = True
+            runner.execute_runs(runs, False)
+            self.assertEqual(sorted(executed), ["run1", "run2"])
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = ResultCache(temp_dir, max_size_mb=0)
+            cache.max_size = 1000
+            run = Metadata(py_script_path="TC_A.py", run="run1", app="", app_args="", script_args="")
+            for i in range(50):
+                cache.store(f"{i:064x}", run, 1.0)
+            self.assertIsNone(cache.lookup(f"{0:064x}"))
+            self.assertIsNotNone(cache.lookup(f"{49:064x}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from app_pool import AppPool
+from run_python_test import main_impl
+from scheduler import ResourceLimits
+from test_runner import TestRunner
+
+
+class TestInProcessRuns(unittest.TestCase):
+
+    def test_runs_share_app_pool(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = os.path.join(temp_dir, "env.yaml")
+            app = os.path.join(temp_dir, "app.sh")
+            script = os.path.join(temp_dir, "TC_A.py")
+            pids_file = os.path.join(temp_dir, "pids")
+            for path, content in (
+                    (env_file, "APP: %s\n" % app),
+                    (app, "#!/bin/sh\ntrap 'exit 0' INT\necho started\nwhile true; do sleep 0.05; done\n"),
+                    (script, "# test-runner-runs: run1 run2 run3\n"
+                             "# test-runner-run/run1/app: ${APP}\n"
+                             "# test-runner-run/run2/app: ${APP}\n"
+                             "# test-runner-run/run3/app: ${APP}\n"
+                             "# test-runner-run/run3/script-args: --fail \"with spaces\"\n"
+                             "import sys\n"
+                             "with open(%r, 'a') as fp:\n"
+                             "    fp.write(sys.argv[sys.argv.index('--app-pid') + 1] + '\\n')\n"
+                             "sys.exit(3 if '--fail' in sys.argv else 0)\n" % pids_file)):
+                with open(path, 'w') as fp:
+                    fp.write(content)
+            os.chmod(app, 0o755)
+
+            runner = TestRunner(env_file, in_process=True, reuse_apps=True)
+            runs = runner.expand_runs([script])
+            self.assertEqual(runner.generate_run_argv(runs[2])[-2:], ["--script-args", '--fail "with spaces"'])
+
+            self.assertFalse(runner.execute_runs(runs, False, ResourceLimits(max_parallel_runs=2)))
+            with open(pids_file) as fp:
+                pids = fp.read().split()
+            self.assertEqual(len(pids), 3)
+            self.assertEqual(len(set(pids)), 1)
+            self.assertIsNone(runner.app_pool)
+
+    def test_failed_run_releases_app(self):
+        pool = AppPool()
+        app_args = "-c 'trap \"exit 0\" INT; while true; do sleep 0.05; done'"
+        try:
+            with mock.patch("run_python_test.wait_until_ready", side_effect=RuntimeError("readiness check failed")):
+                with self.assertRaises(RuntimeError):
+                    main_impl("/bin/sh", False, False, app_args, "TC_A.py", "", False, True,
+                              app_ready_port=5540, app_pool=pool)
+
+            # The app of the failed run is stopped and its command can be acquired again right away
+            acquired = []
+            waiter = threading.Thread(target=lambda: acquired.append(
+                pool.acquire(["/bin/sh", "-c", "trap \"exit 0\" INT; while true; do sleep 0.05; done"], None, io.BytesIO())), daemon=True)
+            waiter.start()
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+            self.assertEqual(acquired[0].runs_served, 0)
+        finally:
+            pool.shutdown()
+
+    def test_failed_run_stops_app(self):
+        apps = []
+
+        def fail_readiness(process, *args):
+            apps.append(process)
+            raise RuntimeError("readiness check failed")
+
+        app_args = "-c 'trap \"exit 0\" INT; while true; do sleep 0.05; done'"
+        threads = threading.active_count()
+        with mock.patch("run_python_test.wait_until_ready", side_effect=fail_readiness):
+            with self.assertRaises(RuntimeError):
+                main_impl("/bin/sh", False, False, app_args, "TC_A.py", "", False, True, app_ready_port=5540)
+
+        # The app was stopped and reaped, and the log pump of the run no longer runs
+        self.assertEqual(len(apps), 1)
+        self.assertIsNotNone(apps[0].returncode)
+        self.assertEqual(threading.active_count(), threads)
+
+if __name__ == "__main__":
+    unittest.main()
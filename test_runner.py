@@ -1,17 +1,71 @@
+import dataclasses
+import shlex
+import subprocess
+import sys
+import time
+import traceback
+import uuid
+from app_pool import AppPool
+from commission_snapshot import DEFAULT_SNAPSHOT_DIR
 from metadata import Metadata, MetadataReader
-from typing import List, Union, Optional
+from phase_timer import SCHEDULED_RUN_RECORD, MetricsWriter, format_summary, read_metrics, summarize
+from result_cache import ResultCache
+from sandbox import SandboxManager
+from scheduler import DurationHistory, ResourceLimits, RunResult, TestScheduler
+from typing import Dict, Iterable, List, Tuple, Union, Optional
 from os.path import relpath
 
+# Options of run_python_test.py whose value is double quoted in shell command strings
+QUOTED_RUN_ARGS = ("--app-args", "--script", "--script-args", "--sandbox-dir", "--metrics-file", "--log-archive-dir",
+                   "--app-ready-pattern", "--snapshot-dir", "--forkserver-socket")
+
 
 class TestRunner:
     """
     A class to run a test script against an environment.
     """
 
-    def __init__(self, env_yaml_file_path: str) -> None:
-        self.metadata_reader = MetadataReader(env_yaml_file_path)
+    def __init__(self, env_yaml_file_path: str, sandbox_manager: Optional[SandboxManager] = None,
+                 metadata_index_path: Optional[str] = None, metrics_file: Optional[str] = None,
+                 log_archive_dir: Optional[str] = None, duration_history: Optional[DurationHistory] = None,
+                 result_cache: Optional[ResultCache] = None, force_rerun: bool = False,
+                 snapshot_dir: Optional[str] = None, forkserver_socket: Optional[str] = None,
+                 in_process: bool = False, reuse_apps: bool = False, app_max_runs: int = 0) -> None:
+        """
+        Parameters:
+
+        in_process:
+         Execute runs by calling run_python_test.py's logic from this process
+         instead of starting it through the shell for every run. Concurrent
+         runs then share the stdout and the root logger of this process: their
+         output is not synchronized beyond single lines and interleaves
+
+        reuse_apps:
+         With in_process, keep apps running across runs using the same app
+         command, see AppPool
 
-    def run_test(self, py_test_file: str, dry_run: bool) -> None:
+        app_max_runs:
+         Number of runs a reused app serves before it is restarted, 0 means unlimited
+        """
+        self.metadata_reader = MetadataReader(env_yaml_file_path, metadata_index_path)
+        self.sandbox_manager = sandbox_manager
+        self.metrics_file = metrics_file
+        self.log_archive_dir = log_archive_dir
+        self.duration_history = duration_history
+        self.result_cache = result_cache
+        self.force_rerun = force_rerun
+        self.snapshot_dir = snapshot_dir
+        self.forkserver_socket = forkserver_socket
+        self.in_process = in_process
+        self.reuse_apps = reuse_apps
+        self.app_max_runs = app_max_runs
+        self.app_pool: Optional[AppPool] = None
+        # Identifier of the batch being executed, recorded with the metrics of its runs
+        self.metrics_batch: Optional[str] = None
+        # Runs of the last batch that actually executed, result cache hits excluded
+        self.executed_runs: List[Metadata] = []
+
+    def run_test(self, py_test_file: str, dry_run: bool) -> bool:
         """
         Runs a test script by first parsing it to extract run arguments. Then
         build an argument string from those run arguments and then passing
@@ -24,17 +78,219 @@ class TestRunner:
 
         dry_run:
          If true, we will just print the commond that we will send to shell
+
+        Return:
+
+        bool
+         True if every run passed
         """
 
-        for command in self.generate_run_commands(py_test_file):
-            if dry_run:
-                print(command)
+        return self.run_tests([py_test_file], dry_run)
 
-            else:
-                # add code to execute the commands here
-                pass
+    def run_tests(self, paths: Iterable[str], dry_run: bool,
+                  limits: Optional[ResourceLimits] = None) -> bool:
+        """
+        Expands test scripts and directories into runs and executes them
+        concurrently, printing the result of each run as soon as it finishes.
+
+        Parameters:
+
+        paths:
+         Paths to python test scripts or directories containing them
+
+        dry_run:
+         If true, we will just print the commands that we will send to shell
+
+        limits:
+         Concurrency limits used by the scheduler
+
+        Return:
+
+        bool
+         True if every run passed
+        """
+
+        return self.execute_runs(self.expand_runs(paths), dry_run, limits)
+
+    def expand_runs(self, paths: Iterable[str]) -> List[Metadata]:
+        """
+        Expands test scripts and directories into the runs they define.
+
+        Parameters:
+
+        paths:
+         Paths to python test scripts or directories containing them
+        """
+
+        runs = TestScheduler(self.metadata_reader, self.execute_run).expand_runs(paths)
+        self.metadata_reader.save_index()
+        return runs
+
+    def execute_runs(self, runs: List[Metadata], dry_run: bool,
+                     limits: Optional[ResourceLimits] = None) -> bool:
+        """
+        Executes already expanded runs concurrently, printing the result of
+        each run as soon as it finishes.
+
+        Parameters:
+
+        runs:
+         Runs to execute, for example read from a manifest
+
+        dry_run:
+         If true, we will just print the commands that we will send to shell
+
+        limits:
+         Concurrency limits used by the scheduler, runs execute one at a
+         time by default unless a sandbox manager isolates them
+
+        Return:
+
+        bool
+         True if every run passed
+        """
+
+        if limits is None and self.sandbox_manager is None:
+            # Unsandboxed runs share /tmp/chip*, their KVS, controller storage and port
+            limits = ResourceLimits(max_parallel_runs=1)
+        elif self.sandbox_manager is not None and not self.sandbox_manager.use_netns:
+            # Without a network namespace, the factory reset of a sandboxed run also clears the shared /tmp
+            limits = dataclasses.replace(limits or ResourceLimits(), exclusive_factory_resets=True)
+
+        scheduler = TestScheduler(self.metadata_reader, self.execute_run, limits)
+
+        if dry_run:
+            for run in runs:
+                if self.in_process:
+                    print(shlex.join(["run_python_test.py"] + self.generate_run_argv(run)))
+                else:
+                    print(self.generate_run_arg_string(run))
+            return True
+
+        cached, runs_to_execute, cache_keys = self.__lookup_cached__(runs)
+        self.executed_runs = runs_to_execute
+
+        metrics = MetricsWriter(self.metrics_file) if self.metrics_file else None
+        self.metrics_batch = uuid.uuid4().hex if metrics else None
+
+        if self.in_process and self.reuse_apps:
+            self.app_pool = AppPool(self.app_max_runs)
+
+        failed = []
+        app_exit_code = 0
+        try:
+            for result in scheduler.run(runs_to_execute):
+                self.report_result(result)
+                if not result.passed:
+                    failed.append(result)
+                elif cache_keys.get(id(result.run)):
+                    self.result_cache.store(cache_keys[id(result.run)], result.run, result.duration_sec)
+                if self.duration_history:
+                    self.duration_history.update(result.run, result.duration_sec)
+                if metrics:
+                    metrics.write({
+                        "type": SCHEDULED_RUN_RECORD,
+                        "batch": self.metrics_batch,
+                        "script": result.run.py_script_path,
+                        "run": result.run.run,
+                        "exit_code": result.exit_code,
+                        "timestamp": time.time(),
+                        "phases": {"scheduled_total": result.duration_sec},
+                    })
+        finally:
+            if self.app_pool:
+                app_exit_code = self.app_pool.shutdown()
+                self.app_pool = None
+
+        if app_exit_code != 0:
+            print(f"Reused apps exited with error {app_exit_code}")
+
+        if self.duration_history:
+            self.duration_history.save()
+
+        cached_note = f" ({len(cached)} cached)" if cached else ""
+        print(f"{len(runs) - len(failed)}/{len(runs)} runs passed{cached_note}")
+        for result in failed:
+            print(f"FAILED: {result.run.py_script_path} ({result.run.run})")
+
+        if metrics:
+            # Summarize the records of this batch only, the file may hold earlier and concurrent batches
+            records = [record for record in read_metrics(self.metrics_file)
+                       if record.get("batch") == self.metrics_batch]
+            summary = summarize(records)
+            summary["batch"] = self.metrics_batch
+            metrics.write(summary)
+            print(format_summary(summary))
+
+        return not failed and app_exit_code == 0
+
+    def __lookup_cached__(self, runs: List[Metadata]) -> Tuple[List[Metadata], List[Metadata], Dict[int, str]]:
+        """
+        Splits runs into the ones that passed before with identical inputs,
+        which are reported as cached passes, and the ones to execute along
+        with their cache keys.
+        """
+        if self.result_cache is None:
+            return [], runs, {}
+
+        cached = []
+        runs_to_execute = []
+        cache_keys = {}
+        for run in runs:
+            key = self.result_cache.key(run, self.metadata_reader.env_hash)
+            if key and not self.force_rerun and self.result_cache.lookup(key):
+                print(f"[PASS (cached)] {run.py_script_path} {run.run}")
+                cached.append(run)
+                continue
+            if key:
+                cache_keys[id(run)] = key
+            runs_to_execute.append(run)
+
+        sys.stdout.flush()
+        return cached, runs_to_execute, cache_keys
+
+    def execute_run(self, run: Metadata) -> int:
+        """
+        Executes a single run through the shell, or in this process when
+        in_process is set, and returns its exit code. When a sandbox manager
+        is set, the run executes in its own sandbox.
+
+        Parameters:
+
+        run
+         Object that contains all the run arguments
+        """
+
+        if self.sandbox_manager is None:
+            return self.__execute__(run)
+
+        with self.sandbox_manager.sandboxed(run) as sandboxed_run:
+            return self.__execute__(sandboxed_run)
+
+    def __execute__(self, run: Metadata) -> int:
+        if not self.in_process:
+            return subprocess.call(self.generate_run_arg_string(run), shell=True)
+
+        # Imported here so that runs through the shell do not need the dependencies of run_python_test
+        from run_python_test import run_metadata
+        try:
+            return run_metadata(run, app_pool=self.app_pool, metrics_file=self.metrics_file,
+                                log_archive_dir=self.log_archive_dir, snapshot_dir=self.snapshot_dir or DEFAULT_SNAPSHOT_DIR,
+                                forkserver_socket=self.forkserver_socket, metrics_batch=self.metrics_batch)
+        except Exception:
+            traceback.print_exc()
+            return 1
+
+    def report_result(self, result: RunResult) -> None:
+        """
+        Prints a one line summary of a finished run.
+        """
+
+        status = "PASS" if result.passed else f"FAIL ({result.exit_code})"
+        print(f"[{status}] {result.run.py_script_path} {result.run.run} "
+              f"in {result.duration_sec:.1f}s")
+        sys.stdout.flush()
 
-    
     def generate_run_commands(self, py_test_file: str) -> List[str]:
         """
         Parse a test script to extract run arguments. Then build an argument string 
@@ -109,32 +365,66 @@ class TestRunner:
         return run.script_args
 
     
-    def generate_run_arg_string(self, run: Metadata) -> str:
+    def generate_run_argv(self, run: Metadata) -> List[str]:
         """
-        Converts a run metadata object into a string format that
-        can be passed to shell for executing a test script.
+        Converts a run metadata object into the arguments of run_python_test.py,
+        one list item per argument so that values need no quoting.
 
         Parameters:
-        
+
         run
          Object that contains all the run arguments including app args
         """
 
         run_args = []
-        run_args.extend(self.__arg_values__("--app",run.app))
-        run_args.extend(self.__arg_values__("--factoryreset",run.factory_reset))
-        
-                        
+        run_args.extend(self.__arg_values__("--app", run.app))
+        run_args.extend(self.__arg_values__("--factoryreset", run.factoryreset))
+        run_args.extend(self.__arg_values__("--factoryreset-app-only", run.factoryreset_app_only))
+        run_args.extend(self.__arg_values__("--script-gdb", run.script_gdb))
+        run_args.extend(self.__arg_values__("--quiet", run.quiet))
+
         app_args = self.get_app_args(run)
         if app_args != "":
-            run_args.extend(['--app-args', f'"{app_args}"'])
+            run_args.extend(['--app-args', app_args])
 
         if run.py_script_path != None:
-            run_args.extend(['--script', f'"{str(run.py_script_path)}"'])
+            run_args.extend(['--script', str(run.py_script_path)])
 
         script_args = self.get_script_args(run)
         if script_args != "":
-            run_args.extend(['--script-args', f'"{script_args}"'])
+            run_args.extend(['--script-args', script_args])
+
+        run_args.extend(self.__arg_values__("--sandbox-dir", run.sandbox_dir))
+        run_args.extend(self.__arg_values__("--netns", run.netns))
+        run_args.extend(self.__arg_values__("--quiet-buffer-mb", run.quiet_buffer_mb))
+        run_args.extend(self.__arg_values__("--metrics-file", self.metrics_file))
+        run_args.extend(self.__arg_values__("--metrics-batch", self.metrics_batch))
+        run_args.extend(self.__arg_values__("--log-archive-dir", self.log_archive_dir))
+        run_args.extend(self.__arg_values__("--app-ready-pattern", run.app_ready_pattern))
+        run_args.extend(self.__arg_values__("--app-ready-port", run.app_ready_port))
+        run_args.extend(self.__arg_values__("--app-ready-timeout", run.app_ready_timeout))
+        run_args.extend(self.__arg_values__("--commissioned-snapshot", run.commissioned_snapshot))
+        run_args.extend(self.__arg_values__("--snapshot-dir", self.snapshot_dir))
+        run_args.extend(self.__arg_values__("--forkserver-socket", self.forkserver_socket))
+
+        return run_args
+
+    def generate_run_arg_string(self, run: Metadata) -> str:
+        """
+        Converts a run metadata object into a string format that
+        can be passed to shell for executing a test script.
+
+        Parameters:
+        
+        run
+         Object that contains all the run arguments including app args
+        """
+
+        run_args = []
+        quote_value = False
+        for arg in self.generate_run_argv(run):
+            run_args.append(f'"{arg}"' if quote_value else arg)
+            quote_value = not quote_value and arg in QUOTED_RUN_ARGS
 
         run_args_string = " ".join(run_args)
 
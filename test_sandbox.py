@@ -0,0 +1,153 @@
+import os
+import tempfile
+import textwrap
+import unittest
+
+from commission_snapshot import CommissionSnapshot, snapshot_key, state_files, strip_commissioning_args
+from metadata import Metadata
+from run_python_test import run_metadata
+from sandbox import SandboxManager, get_arg_value
+
+
+class TestSandboxManager(unittest.TestCase):
+
+    def make_run(self) -> Metadata:
+        return Metadata(
+            py_script_path="TC_SC_3_6.py",
+            run="run1",
+            app="out/chip-all-clusters-app",
+            app_args="--discriminator 1234 --KVS kvs1 --trace-to json:out/app.json",
+            app_ready_port=5540,
+            script_args="--storage-path admin_storage.json --commissioning-method on-network "
+                        "--discriminator 1234 --passcode 20202021",
+        )
+
+    def test_rewrite_isolates_runs(self):
+        manager = SandboxManager()
+        with manager.sandboxed(self.make_run()) as first, manager.sandboxed(self.make_run()) as second:
+            for run in (first, second):
+                self.assertTrue(os.path.isdir(os.path.join(run.sandbox_dir, "tmp")))
+                self.assertEqual(get_arg_value(run.app_args, "--KVS"), os.path.join(run.sandbox_dir, "kvs1"))
+                self.assertEqual(get_arg_value(run.script_args, "--storage-path"),
+                                 os.path.join(run.sandbox_dir, "admin_storage.json"))
+                self.assertEqual(get_arg_value(run.app_args, "--discriminator"),
+                                 get_arg_value(run.script_args, "--discriminator"))
+                self.assertEqual(get_arg_value(run.app_args, "--secured-device-port"), str(run.app_ready_port))
+                self.assertIn("--trace-to json:out/app.json", run.app_args)
+
+            self.assertNotEqual(first.sandbox_dir, second.sandbox_dir)
+            self.assertNotEqual(get_arg_value(first.app_args, "--discriminator"),
+                                get_arg_value(second.app_args, "--discriminator"))
+            self.assertNotEqual(get_arg_value(first.app_args, "--secured-device-port"),
+                                get_arg_value(second.app_args, "--secured-device-port"))
+
+        self.assertFalse(os.path.exists(first.sandbox_dir))
+
+    def test_rewrite_commissioning_codes(self):
+        manager = SandboxManager()
+        run = self.make_run()
+        run.script_args = "--commissioning-method on-network --passcode 20202021"
+        with manager.sandboxed(run) as sandboxed:
+            self.assertEqual(get_arg_value(sandboxed.app_args, "--discriminator"),
+                             get_arg_value(sandboxed.script_args, "--discriminator"))
+
+        run.script_args = "--commissioning-method on-network --qr-code MT:-24J0AFN00KA0648G00"
+        with self.assertRaises(ValueError):
+            with manager.sandboxed(run):
+                pass
+
+    def test_commissioned_snapshot(self):
+        manager = SandboxManager()
+        with manager.sandboxed(self.make_run()) as first, manager.sandboxed(self.make_run()) as second, \
+                tempfile.TemporaryDirectory() as snapshot_dir:
+            keys = [snapshot_key(run.app, run.app_args, run.script_args, run.sandbox_dir) for run in (first, second)]
+            self.assertEqual(keys[0], keys[1])
+
+            first_tmp = os.path.join(first.sandbox_dir, "tmp")
+            files = state_files(first.app_args, first.script_args, first_tmp)
+            for role, content in (("kvs", "app state"), ("storage", "controller state")):
+                with open(files[role], 'w') as fp:
+                    fp.write(content)
+            with open(os.path.join(first_tmp, "chip_counters.ini"), 'w') as fp:
+                fp.write("counters")
+
+            snapshot = CommissionSnapshot(snapshot_dir, keys[0])
+            self.assertFalse(snapshot.exists)
+            snapshot.capture(state_files(first.app_args, first.script_args, first_tmp))
+            self.assertTrue(snapshot.exists)
+
+            second_tmp = os.path.join(second.sandbox_dir, "tmp")
+            restored = snapshot.restore(state_files(second.app_args, second.script_args, second_tmp), second_tmp)
+            self.assertEqual(len(restored), 3)
+            with open(get_arg_value(second.app_args, "--KVS")) as fp:
+                self.assertEqual(fp.read(), "app state")
+            with open(os.path.join(second_tmp, "chip_counters.ini")) as fp:
+                self.assertEqual(fp.read(), "counters")
+
+        self.assertEqual(strip_commissioning_args(first.script_args),
+                         "--storage-path %s" % os.path.join(first.sandbox_dir, "admin_storage.json"))
+
+    def test_snapshot_restored_on_other_port(self):
+        # The app serves its KVS over UDP on its secured device port, the script finds that port the
+        # way operational discovery would and either commissions the app or checks it is commissioned
+        app_code = textwrap.dedent("""\
+            #!/usr/bin/env python3
+            import os, signal, socket, sys
+            signal.signal(signal.SIGINT, lambda *args: sys.exit(0))
+            kvs = sys.argv[sys.argv.index("--KVS") + 1]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", int(sys.argv[sys.argv.index("--secured-device-port") + 1])))
+            while True:
+                request, peer = sock.recvfrom(64)
+                if request == b"commission":
+                    with open(kvs, "w") as fp:
+                        fp.write("commissioned")
+                state = open(kvs).read() if os.path.exists(kvs) else "blank"
+                sock.sendto(state.encode(), peer)
+            """)
+        script_code = textwrap.dedent("""\
+            import socket, sys
+            app_pid = sys.argv[sys.argv.index("--app-pid") + 1]
+            with open("/proc/%s/cmdline" % app_pid, "rb") as fp:
+                app_argv = fp.read().decode().split("\\0")
+            port = int(app_argv[app_argv.index("--secured-device-port") + 1])
+            storage = sys.argv[sys.argv.index("--storage-path") + 1]
+            commissioning = "--commission-only" in sys.argv
+            if not commissioning:
+                assert "--commissioning-method" not in sys.argv
+                assert open(storage).read() == "commissioned"
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(10)
+            sock.sendto(b"commission" if commissioning else b"read", ("127.0.0.1", port))
+            assert sock.recv(64) == b"commissioned"
+            if commissioning:
+                with open(storage, "w") as fp:
+                    fp.write("commissioned")
+            """)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            app = os.path.join(temp_dir, "fake-app")
+            script = os.path.join(temp_dir, "TC_FAKE.py")
+            for path, content in ((app, app_code), (script, script_code)):
+                with open(path, 'w') as fp:
+                    fp.write(content)
+            os.chmod(app, 0o755)
+
+            run = Metadata(py_script_path=script, run="run1", app=app, app_args="--KVS kvs", factoryreset=True,
+                           script_args="--storage-path admin_storage.json --commissioning-method on-network "
+                                       "--discriminator 1234 --passcode 20202021",
+                           quiet=True, commissioned_snapshot=True, app_ready_port=5540)
+            snapshot_dir = os.path.join(temp_dir, "snapshots")
+            ports = []
+            manager = SandboxManager(base_dir=temp_dir, port_base=30000 + os.getpid() % 20000)
+            with manager.sandboxed(run) as first, manager.sandboxed(run) as second:
+                for sandboxed in (first, second):
+                    ports.append(sandboxed.app_ready_port)
+                    self.assertEqual(run_metadata(sandboxed, snapshot_dir=snapshot_dir), 0)
+                    self.assertEqual(len(os.listdir(snapshot_dir)), 1)
+
+            self.assertNotEqual(ports[0], ports[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import dataclasses
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from metadata import Metadata, MetadataReader
+from sandbox import SandboxManager
+from scheduler import DurationHistory, ResourceLimits, TestScheduler, shard_runs
+from test_runner import TestRunner
+
+
+class TestTestScheduler(unittest.TestCase):
+
+    env_file_content = '''
+    ALL_CLUSTERS_APP: out/chip-all-clusters-app
+    '''
+
+    def generate_temp_file(self, directory: str, file_name: str, file_content: str) -> str:
+        file_path = os.path.join(directory, file_name)
+        with open(file_path, 'w') as fp:
+            fp.write(file_content)
+        return file_path
+
+    def make_run(self, name: str, app: str = "") -> Metadata:
+        return Metadata(py_script_path=f"{name}.py", run=name, app=app, app_args="", script_args="")
+
+    def test_expand_directory(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = self.generate_temp_file(temp_dir, "env.yaml", self.env_file_content)
+            self.generate_temp_file(temp_dir, "TC_A.py", "# test-runner-runs: run1 run2\n")
+            self.generate_temp_file(temp_dir, "TC_B.py", "# test-runner-runs: run1\n")
+            self.generate_temp_file(temp_dir, "helper.py", "# test-runner-runs: run1\n")
+
+            scheduler = TestScheduler(MetadataReader(env_file), lambda run: 0)
+            runs = scheduler.expand_runs([temp_dir])
+
+            self.assertEqual([(os.path.basename(r.py_script_path), r.run) for r in runs],
+                             [("TC_A.py", "run1"), ("TC_A.py", "run2"), ("TC_B.py", "run1")])
+
+    def test_results_and_app_limit(self):
+        lock = threading.Lock()
+        active_apps = [0]
+        peak_apps = [0]
+
+        def execute(run: Metadata) -> int:
+            with lock:
+                if run.app:
+                    active_apps[0] += 1
+                    peak_apps[0] = max(peak_apps[0], active_apps[0])
+            time.sleep(0.02)
+            with lock:
+                if run.app:
+                    active_apps[0] -= 1
+            return 1 if run.run == "fail" else 0
+
+        runs = [self.make_run(f"run{i}", app="app") for i in range(6)]
+        runs.append(self.make_run("fail"))
+
+        limits = ResourceLimits(max_parallel_runs=4, max_apps=2)
+        scheduler = TestScheduler(None, execute, limits)
+        results = list(scheduler.run(runs))
+
+        self.assertEqual(len(results), len(runs))
+        self.assertEqual([r.run.run for r in results if not r.passed], ["fail"])
+        self.assertLessEqual(peak_apps[0], 2)
+
+    def test_memory_limit(self):
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def execute(run: Metadata) -> int:
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return 0
+
+        limits = ResourceLimits(max_parallel_runs=8, max_memory_mb=1024, memory_per_run_mb=512)
+        scheduler = TestScheduler(None, execute, limits)
+        list(scheduler.run([self.make_run(f"run{i}") for i in range(6)]))
+
+        self.assertEqual(peak[0], 2)
+
+    def test_unsandboxed_runs_are_serial(self):
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def execute(run: Metadata) -> int:
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            return 0
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = self.generate_temp_file(temp_dir, "env.yaml", self.env_file_content)
+            runner = TestRunner(env_file)
+            runner.execute_run = execute
+            self.assertTrue(runner.execute_runs([self.make_run(f"run{i}", app="app") for i in range(4)], False))
+        self.assertEqual(peak[0], 1)
+
+    def test_exclusive_factory_resets(self):
+        lock = threading.Lock()
+        active = []
+        overlaps = []
+
+        def execute(run: Metadata) -> int:
+            with lock:
+                active.append(run.run)
+                if len(active) > 1 and any(name.startswith("reset") for name in active):
+                    overlaps.append(list(active))
+            time.sleep(0.02)
+            with lock:
+                active.remove(run.run)
+            return 0
+
+        runs = [self.make_run(f"run{i}") for i in range(6)]
+        for i in (1, 4):
+            runs[i] = dataclasses.replace(runs[i], run=f"reset{i}", factoryreset=(i == 1), factoryreset_app_only=(i == 4))
+
+        results = list(TestScheduler(None, execute, ResourceLimits(max_parallel_runs=4,
+                                                                   exclusive_factory_resets=True)).run(runs))
+        self.assertEqual(len(results), len(runs))
+        self.assertEqual(overlaps, [])
+
+        # Sandboxes without a network namespace share /tmp, the runner makes their resets exclusive
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env_file = self.generate_temp_file(temp_dir, "env.yaml", self.env_file_content)
+            runner = TestRunner(env_file, SandboxManager(base_dir=temp_dir))
+            runner.execute_run = execute
+            self.assertTrue(runner.execute_runs(runs, False, ResourceLimits(max_parallel_runs=4)))
+        self.assertEqual(overlaps, [])
+
+    def test_sharding(self):
+        runs = [self.make_run(f"run{i}") for i in range(10)]
+
+        # Without history runs spread evenly and every run lands in exactly one shard
+        shards = [shard_runs(runs, i, 3) for i in range(3)]
+        self.assertEqual(sorted(len(shard) for shard in shards), [3, 3, 4])
+        self.assertEqual(sorted(r.run for shard in shards for r in shard), sorted(r.run for r in runs))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history_path = os.path.join(temp_dir, "history.json")
+            history = DurationHistory(history_path)
+            history.update(runs[0], 100.0)
+            for run in runs[1:8]:
+                history.update(run, 10.0)
+            history.save()
+
+            history = DurationHistory(history_path)
+            history.update(runs[0], 60.0)
+            self.assertEqual(history.get(runs[0]), 80.0)
+
+            # The long run gets a shard of its own, the unknown runs count as median runs
+            shards = [shard_runs(runs, i, 3, history) for i in range(3)]
+            self.assertIn([runs[0]], shards)
+            self.assertEqual(sorted(len(shard) for shard in shards), [1, 4, 5])
+
+
+if __name__ == "__main__":
+    unittest.main()
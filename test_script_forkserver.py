@@ -0,0 +1,85 @@
+import io
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from log_pump import LogPump
+from script_forkserver import ForkServerClient, ForkServerProcess, live_group_members
+
+
+class TestScriptForkServer(unittest.TestCase):
+
+    def test_forked_scripts(self):
+        script = (
+            "import logging, os, sys\n"
+            "print('argv', sys.argv[1:], os.environ.get('RUN_NAME'))\n"
+            "print('error line', file=sys.stderr)\n"
+            "print('state', len(logging.root.handlers), logging.root.level, %r in sys.path)\n"
+            "sys.exit(int(sys.argv[1]))\n"
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            script_path = os.path.join(temp_dir, "TC_FORK.py")
+            preload_path = os.path.join(temp_dir, "preload")
+            with open(script_path, 'w') as fp:
+                fp.write(script % os.path.abspath(preload_path))
+            socket_path = os.path.join(temp_dir, "forkserver.sock")
+            command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "script_forkserver.py"),
+                       "--socket", socket_path, "--preload", "json", "--preload-path", preload_path]
+
+            with ForkServerProcess(command, socket_path, start_timeout=30):
+                client = ForkServerClient(socket_path)
+                pump = LogPump()
+                output = io.BytesIO()
+                processes = [client.launch([script_path, str(code), "--storage-path", "a b.json"],
+                                           dict(os.environ, RUN_NAME=f"run{code}"))
+                             for code in (0, 3)]
+                streams = [stream for code, process in zip((0, 3), processes)
+                           for stream in pump.add_process(f"RUN{code}", process, output)]
+
+                self.assertEqual([process.wait(10) for process in processes], [0, 3])
+                for stream in streams:
+                    self.assertTrue(stream.done.wait(5))
+                pump.close()
+
+                lines = output.getvalue().split(b'\n')
+                self.assertTrue(any(line.endswith(b"argv ['3', '--storage-path', 'a b.json'] run3") for line in lines))
+                self.assertEqual(sum(line.endswith(b"error line") for line in lines), 2)
+                # Scripts start without the server's logging setup and preload paths
+                self.assertEqual(sum(line.endswith(b"state 0 30 False") for line in lines), 2)
+
+                # A script killed through its handle reports the signal like subprocess does
+                sleep_path = os.path.join(temp_dir, "TC_SLEEP.py")
+                with open(sleep_path, 'w') as fp:
+                    fp.write("import time\ntime.sleep(30)\n")
+                process = client.launch([sleep_path])
+                with self.assertRaises(subprocess.TimeoutExpired):
+                    process.wait(0.2)
+                process.kill()
+                self.assertEqual(process.wait(10), -9)
+                process.stdout.close()
+                process.stderr.close()
+            self.assertFalse(os.path.exists(socket_path))
+
+    def test_server_behind_shell_is_stopped(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            socket_path = os.path.join(temp_dir, "forkserver.sock")
+            # Like forkserver_command(), a shell that does not exec the server and does not forward signals
+            command = "%s %s --socket %s --preload json; exit $?" % (
+                shlex.quote(sys.executable), shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      "script_forkserver.py")),
+                shlex.quote(socket_path))
+
+            with ForkServerProcess(command, socket_path, start_timeout=30) as server:
+                shell_pid = server.process.pid
+                server_pids = [pid for pid in live_group_members(shell_pid) if pid != shell_pid]
+                self.assertEqual(len(server_pids), 1)
+
+            self.assertEqual(live_group_members(shell_pid), [])
+            self.assertFalse(os.path.exists(socket_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import io
+import json
+import os
+import tempfile
+import typing
+import unittest
+
+from metadata import Metadata
+from trace_metrics import check_traces, compare_metrics, extract_metrics, iter_json_array, iter_trace_events, run_trace_files
+
+
+class TestTraceMetrics(unittest.TestCase):
+
+    def write_trace(self, path: str, case_ms: typing.List[float], truncate: bool = False) -> None:
+        events = []
+        for i, duration in enumerate(case_ms):
+            start = 1000.0 * i
+            events.append({"event": "TraceBegin", "label": "EstablishSession", "group": "CASESession", "time_ms": start})
+            events.append({"event": "TraceInstant", "label": "Sigma1", "group": "CASESession", "time_ms": start + 1})
+            events.append({"event": "TraceEnd", "label": "EstablishSession", "group": "CASESession",
+                           "time_ms": start + duration})
+        events.append({"ph": "X", "name": "PairDevice", "cat": "DeviceCommissioner", "ts": 0, "dur": 250000})
+        content = "[\n" + ",\n".join(json.dumps(event, indent=1) for event in events) + "\n]\n"
+        with open(path, 'w') as fp:
+            fp.write(content[:content.rindex('"TraceEnd"')] if truncate else content)
+
+    def test_extract_and_compare(self):
+        self.assertEqual(list(iter_json_array(io.StringIO('[{"a": [1, 2]}, "]", 345]'), chunk_size=3)),
+                         [{"a": [1, 2]}, "]", 345])
+        for chunk_size in (1, 2, 64):
+            self.assertEqual(list(iter_json_array(io.StringIO(' [[1, 2], [3], [], [[4]] ] '), chunk_size)),
+                             [[1, 2], [3], [], [[4]]])
+        self.assertEqual(list(iter_json_array(io.StringIO('[[1, 2], [3'))), [[1, 2]])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trace_path = os.path.join(temp_dir, "test-TC_SC_3_6.json")
+            self.write_trace(trace_path, [100, 120, 110])
+            metrics = extract_metrics(trace_path)
+            self.assertEqual(metrics["case_session_establishment"], {"count": 3, "p50": 110, "p95": 120, "max": 120})
+            self.assertEqual(metrics["commissioning"]["max"], 250)
+
+            # A truncated trace keeps its complete events
+            self.write_trace(trace_path, [100, 120, 110], truncate=True)
+            self.assertEqual(extract_metrics(trace_path), {"case_session_establishment":
+                                                           {"count": 2, "p50": 100, "p95": 120, "max": 120}})
+
+            run = Metadata(py_script_path="src/python_testing/TC_SC_3_6.py", run="run1", app="",
+                           app_args="--trace-to json:%s/app-{SCRIPT_BASE_NAME}.json" % temp_dir,
+                           script_args="--trace-to json:%s/test-{SCRIPT_BASE_NAME}.json "
+                                       "--trace-to perfetto:%s/test.perfetto" % (temp_dir, temp_dir))
+            trace_paths = run_trace_files(run)
+            self.assertEqual(trace_paths, [os.path.join(temp_dir, "app-TC_SC_3_6.json"), trace_path])
+
+            baseline_path = os.path.join(temp_dir, "baseline.json")
+            self.write_trace(trace_path, [100, 120, 110])
+            self.assertEqual(check_traces(trace_paths, baseline_path, update_baseline=True), [])
+            self.assertEqual(check_traces(trace_paths, baseline_path), [])
+
+            self.write_trace(trace_path, [100, 200, 110])
+            findings = check_traces(trace_paths, baseline_path)
+            self.assertEqual([(f.metric, f.status) for f in findings],
+                             [("case_session_establishment.p95", "regressed"),
+                              ("case_session_establishment.max", "regressed")])
+            self.assertEqual(check_traces(trace_paths, baseline_path,
+                                          tolerances={"case_session_establishment.*": 1.0}), [])
+
+            baseline = {"test-TC_SC_3_6": {"report_processing": {"count": 1, "p50": 5, "p95": 5, "max": 5}}}
+            findings = compare_metrics({"test-TC_SC_3_6": extract_metrics(trace_path)}, baseline)
+            self.assertEqual({f.status for f in findings}, {"missing"})
+
+    def test_trace_events_object(self):
+        content = json.dumps({"displayTimeUnit": "ms", "otherData": {"version": "[1]"},
+                              "traceEvents": [{"ph": "B", "name": "PairDevice", "ts": 1000},
+                                              {"ph": "E", "name": "PairDevice", "ts": 51000}],
+                              "metadata": {"trailing": True}})
+        for chunk_size in (1, 5, 64):
+            self.assertEqual([event["ts"] for event in iter_trace_events(io.StringIO(content), chunk_size)],
+                             [1000, 51000])
+        self.assertEqual(list(iter_trace_events(io.StringIO('{"otherData": {}}'))), [])
+        self.assertEqual(list(iter_trace_events(io.StringIO(' [1, 2]'))), [1, 2])
+        with self.assertRaises(ValueError):
+            list(iter_trace_events(io.StringIO('"events"')))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trace_path = os.path.join(temp_dir, "trace.json")
+            with open(trace_path, 'w') as fp:
+                # Truncated by a killed app
+                fp.write(content[:content.rindex('"ph": "E"')])
+            self.assertEqual(extract_metrics(trace_path), {})
+            with open(trace_path, 'w') as fp:
+                fp.write(content)
+            self.assertEqual(extract_metrics(trace_path)["commissioning"]["max"], 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
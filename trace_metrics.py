@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+"""
+Extracts performance metrics from the JSON traces written by apps and test
+scripts run with `--trace-to json:<path>` and compares them against a stored
+baseline.
+
+Traces are parsed one event at a time, so that their size does not matter.
+Both the chip JSON tracing backend events (TraceBegin/TraceEnd with a label
+and a group) and Chrome trace events (B/E/X phases) are understood, the latter
+either as a JSON array or as the "traceEvents" of a JSON object. A metric
+is the duration of the spans whose label, and optionally group, match a
+pattern, summarized by count, p50, p95 and max in milliseconds.
+
+Example:
+
+    trace_metrics.py out/trace_data/*.json --baseline trace_baseline.json
+    trace_metrics.py out/trace_data/*.json --baseline trace_baseline.json --update-baseline
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import re
+import sys
+import tempfile
+import typing
+
+from metadata import Metadata, fill_placeholders
+from phase_timer import percentile
+
+FORMAT = 1
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Statistics compared against the baseline, counts vary with the test flow and are only reported
+COMPARED_STATS = ("p50", "p95", "max")
+
+DEFAULT_TOLERANCE = 0.25
+# Changes below this many milliseconds are noise whatever their relative size
+DEFAULT_ABSOLUTE_TOLERANCE_MS = 5.0
+
+TRACE_JSON_PTRN = re.compile(r"--trace-to(?:\s+|=)json:(?P<path>\S+)")
+
+# Key of a member of the JSON object format of Chrome traces, up to its value
+OBJECT_KEY_PTRN = re.compile(r'\s*("(?:[^"\\]|\\.)*")\s*:\s*')
+
+
+class MetricSpec(typing.NamedTuple):
+    """Spans measured by a metric, `label` and `group` are regular expressions."""
+    name: str
+    label: str
+    group: typing.Optional[str] = None
+
+
+DEFAULT_METRICS = (
+    MetricSpec("case_session_establishment", r"^(CASESession::)?EstablishSession$|^dut_case_session$"),
+    MetricSpec("commissioning", r"^(PairDevice|Commission|dut_commission)$"),
+    MetricSpec("report_processing", r"^(ProcessReportData|HandleReportData)$"),
+)
+
+
+class Finding(typing.NamedTuple):
+    trace: str
+    metric: str
+    baseline: typing.Optional[float]
+    current: typing.Optional[float]
+    tolerance: float
+    status: str
+
+    def format(self) -> str:
+        if self.status == "missing":
+            return f"MISSING {self.trace} {self.metric}: {self.baseline:.2f}ms in the baseline, not in the trace"
+        change = (self.current - self.baseline) / self.baseline * 100 if self.baseline else 0.0
+        return (f"{self.status.upper()} {self.trace} {self.metric}: {self.baseline:.2f}ms -> {self.current:.2f}ms "
+                f"({change:+.0f}%, tolerance {self.tolerance * 100:.0f}%)")
+
+
+def iter_json_array(stream: typing.TextIO, chunk_size: int = READ_CHUNK_SIZE,
+                    prefix: str = "") -> typing.Iterator[typing.Any]:
+    """
+    Yields the items of a JSON array one by one. Only one item and one
+    chunk are held in memory. A truncated array, e.g. written by an app that
+    was killed, yields its complete items. Reading stops at the end of the
+    array, `prefix` is text already read from the stream.
+    """
+    decoder = json.JSONDecoder()
+    buffer = prefix
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip the opening bracket and the separators between items, nested arrays are items
+        while position < len(buffer):
+            char = buffer[position]
+            if started and char == ']':
+                return
+            if char == '[' and not started:
+                started = True
+            elif not (char.isspace() or (started and char == ',')):
+                break
+            position += 1
+
+        if position < len(buffer) and started:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    return
+            else:
+                # A number ending the buffer may continue in the next chunk
+                if end < len(buffer) or eof:
+                    yield item
+                    position = end
+                    continue
+        elif position < len(buffer):
+            raise ValueError("Trace is not a JSON array")
+
+        if eof:
+            return
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+
+def iter_trace_events(stream: typing.TextIO, chunk_size: int = READ_CHUNK_SIZE) -> typing.Iterator[typing.Any]:
+    """
+    Yields the events of a trace one by one: the items of a JSON array, or
+    those of the "traceEvents" array of a JSON object. The other members of
+    such an object are decoded whole and skipped.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_object = False
+    eof = False
+
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or (in_object and buffer[position] == ',')):
+            position += 1
+
+        if position < len(buffer) and not in_object:
+            if buffer[position] == '[':
+                yield from iter_json_array(stream, chunk_size, buffer[position:])
+                return
+            if buffer[position] != '{':
+                raise ValueError("Trace is not a JSON array or object")
+            in_object = True
+            position += 1
+            continue
+
+        if position < len(buffer):
+            if buffer[position] == '}':
+                return
+            match = OBJECT_KEY_PTRN.match(buffer, position)
+            # The value must have started to tell the key is complete
+            if match and match.end() < len(buffer):
+                if json.loads(match.group(1)) == "traceEvents":
+                    yield from iter_json_array(stream, chunk_size, buffer[match.end():])
+                    return
+                try:
+                    _, end = decoder.raw_decode(buffer, match.end())
+                except ValueError:
+                    pass
+                else:
+                    if end < len(buffer) or eof:
+                        position = end
+                        continue
+
+        if eof:
+            return
+        chunk = stream.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        eof = not chunk
+
+
+def event_time_ms(event: typing.Dict[str, typing.Any]) -> typing.Optional[float]:
+    for field, scale in (("time_ms", 1.0), ("time_us", 1e-3), ("ts", 1e-3)):
+        value = event.get(field)
+        if isinstance(value, (int, float)):
+            return value * scale
+    return None
+
+
+def iter_spans(events: typing.Iterable[typing.Dict[str, typing.Any]]
+               ) -> typing.Iterator[typing.Tuple[str, str, float]]:
+    """
+    Pairs begin and end events into (label, group, duration in ms) spans.
+    Events without a timestamp are ignored.
+    """
+    open_spans: typing.Dict[typing.Tuple[str, str], typing.List[float]] = {}
+
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        label = event.get("label", event.get("name"))
+        group = event.get("group", event.get("cat", ""))
+        kind = event.get("event", event.get("ph"))
+        if label is None:
+            continue
+
+        if kind == "X" and isinstance(event.get("dur"), (int, float)):
+            yield label, group, event["dur"] * 1e-3
+            continue
+
+        time_ms = event_time_ms(event)
+        if time_ms is None:
+            continue
+        if kind in ("TraceBegin", "B"):
+            open_spans.setdefault((label, group), []).append(time_ms)
+        elif kind in ("TraceEnd", "E"):
+            starts = open_spans.get((label, group))
+            if starts:
+                yield label, group, time_ms - starts.pop()
+
+
+def summarize_durations(durations: typing.List[float]) -> typing.Dict[str, float]:
+    return {
+        "count": len(durations),
+        "p50": percentile(durations, 0.5),
+        "p95": percentile(durations, 0.95),
+        "max": max(durations),
+    }
+
+
+def extract_metrics(trace_path: str, specs: typing.Iterable[MetricSpec] = DEFAULT_METRICS
+                    ) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Measures the metrics of a JSON trace.
+
+    Return:
+
+    Dict
+     Statistics of every metric with at least one matching span, by metric name
+    """
+    compiled = [(spec.name, re.compile(spec.label), re.compile(spec.group) if spec.group else None) for spec in specs]
+    durations: typing.Dict[str, typing.List[float]] = {}
+
+    with open(trace_path, 'r', encoding='utf8', errors='replace') as stream:
+        for label, group, duration_ms in iter_spans(iter_trace_events(stream)):
+            for name, label_ptrn, group_ptrn in compiled:
+                if label_ptrn.search(label) and (group_ptrn is None or group_ptrn.search(group or "")):
+                    durations.setdefault(name, []).append(duration_ms)
+
+    return {name: summarize_durations(values) for name, values in durations.items()}
+
+
+def load_specs(spec_path: str) -> typing.List[MetricSpec]:
+    """
+    Reads metric definitions from a JSON list of {"name", "label", "group"} objects.
+    """
+    with open(spec_path, 'r', encoding='utf8') as stream:
+        return [MetricSpec(item["name"], item["label"], item.get("group")) for item in json.load(stream)]
+
+
+def trace_key(trace_path: str) -> str:
+    """Name of a trace in baselines, e.g. app-TC_SC_3_6 for out/trace_data/app-TC_SC_3_6.json."""
+    return os.path.splitext(os.path.basename(trace_path))[0]
+
+
+def run_trace_files(run: Metadata) -> typing.List[str]:
+    """
+    JSON trace files written by a run, with the placeholders resolved the way
+    run_python_test.py resolves them.
+    """
+    placeholders = {'SCRIPT_BASE_NAME': os.path.splitext(os.path.basename(run.py_script_path))[0]}
+    paths = []
+    for args in (run.app_args, run.script_args):
+        for match in TRACE_JSON_PTRN.finditer(fill_placeholders(args or "", placeholders)):
+            if match.group("path") not in paths:
+                paths.append(match.group("path"))
+    return paths
+
+
+def load_baseline(baseline_path: str) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]]:
+    """
+    Metrics by trace key stored in a baseline file, empty if there is none.
+    """
+    try:
+        with open(baseline_path, 'r', encoding='utf8') as stream:
+            content = json.load(stream)
+    except FileNotFoundError:
+        return {}
+    if content.get("format") != FORMAT:
+        raise ValueError(f"Unsupported trace baseline format {content.get('format')} in {baseline_path}")
+    return content.get("traces", {})
+
+
+def save_baseline(baseline_path: str, traces: typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]]) -> None:
+    directory = os.path.dirname(os.path.abspath(baseline_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, 'w', encoding='utf8') as stream:
+        json.dump({"format": FORMAT, "traces": traces}, stream, indent=2, sort_keys=True)
+    os.replace(temp_path, baseline_path)
+
+
+def tolerance_for(metric: str, tolerances: typing.Dict[str, float], default: float) -> float:
+    """
+    Relative tolerance of a "<metric>.<stat>" name, the first matching
+    fnmatch pattern of `tolerances` wins.
+    """
+    for pattern, tolerance in tolerances.items():
+        if fnmatch.fnmatchcase(metric, pattern):
+            return tolerance
+    return default
+
+
+def compare_metrics(current: typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]],
+                    baseline: typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]],
+                    tolerances: typing.Optional[typing.Dict[str, float]] = None,
+                    default_tolerance: float = DEFAULT_TOLERANCE,
+                    absolute_tolerance_ms: float = DEFAULT_ABSOLUTE_TOLERANCE_MS) -> typing.List[Finding]:
+    """
+    Compares the metrics of traces against their baseline. Only traces
+    present in both are compared.
+
+    Parameters:
+
+    tolerances:
+     Relative tolerance by "<metric>.<stat>" fnmatch pattern, e.g. {"commissioning.*": 0.5}
+
+    absolute_tolerance_ms:
+     Increases up to this many milliseconds are never regressions
+
+    Return:
+
+    List[Finding]
+     A "regressed" finding for every statistic slower than its baseline
+     beyond tolerance, an "improved" one for every statistic faster beyond
+     tolerance and a "missing" one for every baseline metric the trace lacks
+    """
+    findings = []
+    for trace, baseline_metrics in sorted(baseline.items()):
+        if trace not in current:
+            continue
+        for metric, baseline_stats in sorted(baseline_metrics.items()):
+            for stat in COMPARED_STATS:
+                name = f"{metric}.{stat}"
+                if stat not in baseline_stats:
+                    continue
+                tolerance = tolerance_for(name, tolerances or {}, default_tolerance)
+                reference = baseline_stats[stat]
+                value = current[trace].get(metric, {}).get(stat)
+                if value is None:
+                    findings.append(Finding(trace, name, reference, None, tolerance, "missing"))
+                elif value > reference * (1 + tolerance) + absolute_tolerance_ms:
+                    findings.append(Finding(trace, name, reference, value, tolerance, "regressed"))
+                elif value < reference * (1 - tolerance) - absolute_tolerance_ms:
+                    findings.append(Finding(trace, name, reference, value, tolerance, "improved"))
+    return findings
+
+
+def measure_traces(trace_paths: typing.Iterable[str], specs: typing.Iterable[MetricSpec] = DEFAULT_METRICS
+                   ) -> typing.Dict[str, typing.Dict[str, typing.Dict[str, float]]]:
+    """
+    Metrics of every existing trace by trace key. Unreadable traces are
+    reported and skipped.
+    """
+    specs = list(specs)
+    metrics = {}
+    for trace_path in trace_paths:
+        if not os.path.exists(trace_path):
+            continue
+        try:
+            metrics[trace_key(trace_path)] = extract_metrics(trace_path, specs)
+        except (OSError, ValueError) as e:
+            print(f"Skipping trace {trace_path}: {e}")
+    return metrics
+
+
+def check_traces(trace_paths: typing.Iterable[str], baseline_path: str, update_baseline: bool = False,
+                 specs: typing.Iterable[MetricSpec] = DEFAULT_METRICS, **compare_args) -> typing.List[Finding]:
+    """
+    Measures traces and compares them against a baseline file, printing
+    every finding. With update_baseline, the measured traces replace their
+    baseline entries instead.
+
+    Return:
+
+    List[Finding]
+     Findings of the comparison, empty when the baseline was updated
+    """
+    current = measure_traces(trace_paths, specs)
+    baseline = load_baseline(baseline_path)
+
+    if update_baseline:
+        baseline.update(current)
+        save_baseline(baseline_path, baseline)
+        print(f"Updated trace baseline {baseline_path} with {len(current)} traces")
+        return []
+
+    findings = compare_metrics(current, baseline, **compare_args)
+    for finding in findings:
+        print(finding.format())
+    regressed = sum(finding.status == "regressed" for finding in findings)
+    print(f"Trace metrics of {len(current)} traces: {regressed} regressions")
+    return findings
+
+
+def parse_tolerances(values: typing.Iterable[str]) -> typing.Dict[str, float]:
+    """Parses PATTERN=FRACTION command line tolerances."""
+    tolerances = {}
+    for value in values:
+        pattern, _, fraction = value.rpartition('=')
+        if not pattern:
+            raise argparse.ArgumentTypeError(f"Tolerance {value!r} is not PATTERN=FRACTION")
+        tolerances[pattern] = float(fraction)
+    return tolerances
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the metrics of JSON traces against a baseline.')
+    parser.add_argument('traces', nargs='+', help='JSON trace files')
+    parser.add_argument('--baseline', required=True, help='Baseline file of trace metrics')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Store the metrics of the traces in the baseline instead of comparing them')
+    parser.add_argument('--metrics-spec', default=None,
+                        help='JSON list of {"name", "label", "group"} metric definitions replacing the default ones')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative increase over the baseline tolerated by default')
+    parser.add_argument('--metric-tolerance', action='append', default=[], metavar='PATTERN=FRACTION',
+                        help='Relative tolerance of the metrics matching an fnmatch pattern, e.g. "commissioning.*=0.5"')
+    parser.add_argument('--absolute-tolerance-ms', type=float, default=DEFAULT_ABSOLUTE_TOLERANCE_MS,
+                        help='Increases below this many milliseconds are never regressions')
+    parser.add_argument('--warn-only', action='store_true', help='Report regressions without failing')
+    args = parser.parse_args()
+
+    specs = load_specs(args.metrics_spec) if args.metrics_spec else DEFAULT_METRICS
+    findings = check_traces(args.traces, args.baseline, args.update_baseline, specs,
+                            tolerances=parse_tolerances(args.metric_tolerance), default_tolerance=args.tolerance,
+                            absolute_tolerance_ms=args.absolute_tolerance_ms)
+    if not args.warn_only and any(finding.status == "regressed" for finding in findings):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()